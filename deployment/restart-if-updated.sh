@@ -29,6 +29,8 @@ if [[ "${reslog}" != "" ]]; then
     python3 manage.py migrate
     # Restart the server
     sudo systemctl restart gunicorn
+    sudo systemctl restart credo-comparison-worker
+    sudo systemctl restart credo-normalisation-worker
     echo update successful at `date`
 fi
 
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+
+# Benchmark of the sequence alignment comparison engine against xmldiff, on
+# the test scores and on scores made by repeating their measures. Reports
+# the time of each comparison, and how far the engines agree on which events
+# of the diff are changed.
+#
+# Run from the src directory with: python -m benchmarks.comparison_engines
+
+import os
+import tempfile
+import time
+
+import lxml.etree as et
+
+from benchmarks.comparison_memory import SCORE_A, SCORE_B, setup_django, \
+    write_repeated_score
+
+REPEATS = [1, 4, 16]
+ENGINES = ['tree', 'sequence']
+
+
+def changed_events(diff: et.ElementTree):
+    """
+    Return the events of the diff in the layers of a, and the sets of
+    changed events in the layers of a and b. Events are identified by their
+    measure, staff, layer and position in the layer.
+    """
+    from credo.utils.mei.sequence_comparison import \
+        SequenceAlignmentComparison
+    from utils.mei import queries
+
+    engine = SequenceAlignmentComparison()
+    a_events = set()
+    changed = set()
+    for bar_idx, bar in enumerate(queries.MEASURES(diff)):
+        for staff in queries.CHILD_STAFFS(bar):
+            for layer in queries.CHILD_LAYERS(staff):
+                # The layers of b have IDs m-b*, of a m-a* or m-r*
+                side = 'b' if layer.get(queries.XML_ID)[2] == 'b' else 'a'
+                events = []
+                engine._add_events(layer, events)
+                for event_idx, event in enumerate(events):
+                    key = (
+                        bar_idx,
+                        staff.get('n'),
+                        layer.get('n'),
+                        side,
+                        event_idx
+                    )
+                    if side == 'a':
+                        a_events.add(key)
+                    if event.get('color') is not None and \
+                            event.get('visible') != 'false':
+                        changed.add(key)
+
+    return a_events, changed
+
+
+def compare(engine_name: str, a_filename: str, b_filename: str):
+    from credo.utils.mei.engines import get_engine
+
+    parser = et.XMLParser(remove_blank_text=True)
+    a = et.parse(a_filename, parser)
+    b = et.parse(b_filename, parser)
+
+    start = time.perf_counter()
+    diff, _, _ = get_engine(engine_name).compare_trees(a, b)
+    return time.perf_counter() - start, changed_events(diff)
+
+
+def main():
+    setup_django()
+
+    print(f'{"repeats":>8} {"tree":>9} {"sequence":>9} {"speedup":>8} '
+          f'{"a agree":>8} {"changed":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        a_filename = os.path.join(directory, 'a.mei')
+        b_filename = os.path.join(directory, 'b.mei')
+        for repeats in REPEATS:
+            write_repeated_score(SCORE_A, a_filename, repeats)
+            write_repeated_score(SCORE_B, b_filename, repeats)
+
+            times = {}
+            events = {}
+            for name in ENGINES:
+                times[name], events[name] = compare(
+                    name,
+                    a_filename,
+                    b_filename
+                )
+
+            # Fraction of the events of a marked the same by both engines,
+            # and the overlap of the events marked as changed in a and b
+            a_events, tree_changed = events['tree']
+            _, sequence_changed = events['sequence']
+            a_changed = {key for key in tree_changed ^ sequence_changed
+                         if key[3] == 'a'}
+            a_agreement = 1 - len(a_changed) / max(len(a_events), 1)
+            changed_overlap = len(tree_changed & sequence_changed) / \
+                max(len(tree_changed | sequence_changed), 1)
+
+            print(f'{repeats:>8} {times["tree"]:>8.3f}s '
+                  f'{times["sequence"]:>8.3f}s '
+                  f'{times["tree"] / times["sequence"]:>7.1f}x '
+                  f'{a_agreement:>8.1%} {changed_overlap:>8.1%}')
+
+
+if __name__ == '__main__':
+    main()
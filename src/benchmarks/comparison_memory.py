@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+
+# Benchmark of the peak memory used by TreeComparison, against a comparison
+# which copies trees where the pipeline used to, on scores made by repeating
+# the measures of the test scores.
+#
+# Run from the src directory with: python -m benchmarks.comparison_memory
+
+import multiprocessing
+import os
+import resource
+import tempfile
+from copy import deepcopy
+
+import dotenv
+
+SCORE_A = 'tests/credo/utils/mei/data/test_a.mei'
+SCORE_B = 'tests/credo/utils/mei/data/test_b.mei'
+REPEATS = 10
+
+
+def setup_django():
+    dotenv.read_dotenv('../.env')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'credo.settings')
+    import django
+    django.setup()
+
+
+def get_engines():
+    from credo.utils.mei.tree_comparison import TreeComparison
+
+    class CopyingComparison(TreeComparison):
+        # Copies each tree where the pipeline did before MeiTransformer had
+        # borrow and take: reading MeiTransformer.tree for a and b and for
+        # each result, and copying a_modded and every layer when merging.
+
+        def compare_trees(self, a, b):
+            return tuple(
+                deepcopy(tree) for tree in super().compare_trees(a, b)
+            )
+
+        def _get_diff_tree(self, a, b):
+            return super()._get_diff_tree(deepcopy(a), deepcopy(b))
+
+        def _naive_layer_merge(self, a, b):
+            return super()._naive_layer_merge(deepcopy(a), deepcopy(b))
+
+    return {
+        'copying': CopyingComparison,
+        'borrowing': TreeComparison
+    }
+
+
+def write_repeated_score(source: str, filename: str, repeats: int = REPEATS):
+    """
+    Normalise a score and repeat its measures, writing it to filename.
+    """
+    from utils.mei import queries
+    from utils.mei.mei_transformer import MeiTransformer
+
+    transformer = MeiTransformer.from_xml_file(source)
+    transformer.normalise()
+    tree = transformer.take()
+
+    bars = queries.MEASURES(tree)
+    last = bars[-1]
+    for _ in range(repeats - 1):
+        for bar in bars:
+            last.addnext(deepcopy(bar))
+            last = last.getnext()
+
+    # The repeated measures have duplicate IDs
+    transformer = MeiTransformer(tree)
+    transformer.generate_ids()
+    transformer.save_xml_file(filename)
+
+
+def max_rss() -> int:
+    # Peak resident memory of this process, in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(engine_name: str, a_filename: str, b_filename: str) -> int:
+    """
+    Run in a new process, so that its peak memory is only that of the
+    comparison. Returns the peak memory of the comparison, on top of that of
+    the parsed scores.
+    """
+    setup_django()
+    import lxml.etree as et
+
+    parser = et.XMLParser(remove_blank_text=True)
+    a = et.parse(a_filename, parser)
+    b = et.parse(b_filename, parser)
+    parsed = max_rss()
+
+    get_engines()[engine_name]().compare_trees(a, b)
+    return max_rss() - parsed
+
+
+def main():
+    setup_django()
+
+    with tempfile.TemporaryDirectory() as directory:
+        a_filename = os.path.join(directory, 'a.mei')
+        b_filename = os.path.join(directory, 'b.mei')
+        write_repeated_score(SCORE_A, a_filename)
+        write_repeated_score(SCORE_B, b_filename)
+        print(f'Test scores with their measures repeated {REPEATS} times')
+
+        context = multiprocessing.get_context('spawn')
+        peaks = {}
+        for name in get_engines():
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                peaks[name] = pool.apply(
+                    measure,
+                    (name, a_filename, b_filename)
+                )
+            print(f'{name:>10}: {peaks[name] / 1024:7.1f} MB peak')
+
+        print(f'{"reduction":>10}: '
+              f'{peaks["copying"] / max(peaks["borrowing"], 1):7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
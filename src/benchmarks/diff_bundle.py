@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+
+# Benchmark of the payload size and encode time of the /diff JSON envelope
+# against the bundle format, with and without the sources, on scores made by
+# repeating the measures of the test scores.
+#
+# Run from the src directory with: python -m benchmarks.diff_bundle
+
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import lxml.etree as et
+
+from benchmarks.comparison_memory import SCORE_A, SCORE_B, setup_django, \
+    write_repeated_score
+
+REPEATS = [1, 10, 40]
+REPEAT = 5
+
+
+def best_time(fn):
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    setup_django()
+    from credo import diff_bundle
+    from credo.comparison_jobs import encode_comparison
+    from credo.json_stream import stream_json
+    from credo.utils.mei.comparison_cache import content_digest
+    from credo.utils.mei.tree_comparison import TreeComparison
+
+    parser = et.XMLParser(remove_blank_text=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for repeats in REPEATS:
+            trees = []
+            source_meis = []
+            for i, source in enumerate([SCORE_A, SCORE_B]):
+                filename = os.path.join(directory, f'{i}.mei')
+                write_repeated_score(source, filename, repeats)
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                trees.append(et.ElementTree(et.fromstring(data, parser)))
+                # Stands in for the MEI, which only needs an ID and hash
+                source_meis.append(SimpleNamespace(
+                    id=i,
+                    get_content_hash=lambda data=data: content_digest(data)
+                ))
+
+            out_meis = TreeComparison().compare_trees(*trees)
+            print(f'{repeats} repeats')
+
+            formats = [
+                ('json', lambda: b''.join(
+                    stream_json(encode_comparison(out_meis))
+                )),
+                ('bundle', lambda: diff_bundle.encode_comparison_bundle(
+                    out_meis
+                )),
+                ('bundle, no sources', lambda: (
+                    diff_bundle.encode_comparison_bundle(
+                        out_meis,
+                        source_meis=source_meis
+                    )
+                )),
+            ]
+            for level in [1, 6]:
+                diff_bundle.GZIP_LEVEL = level
+                for name, encode in formats:
+                    if name == 'json' and level != 1:
+                        continue
+                    if name != 'json':
+                        name = f'{name} (level {level})'
+                    seconds, payload = best_time(encode)
+                    print(
+                        f'{name:>30}: {len(payload) / 1024:9.1f} KB '
+                        f'{seconds * 1000:8.2f} ms'
+                    )
+
+
+if __name__ == '__main__':
+    main()
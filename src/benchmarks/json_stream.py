@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+# Benchmark of the peak memory allocated while encoding the JSON envelopes of
+# /mei and /diff whole, as they were before, against streaming them, on
+# scores made by repeating the measures of the test scores. Memory allocated
+# by libxml2 itself is not counted, so the diff trees are not either.
+#
+# Run from the src directory with: python -m benchmarks.json_stream
+
+import base64
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import lxml.etree as et
+
+from benchmarks.comparison_memory import SCORE_A, SCORE_B, setup_django, \
+    write_repeated_score
+
+REPEATS = [1, 10, 40]
+
+
+def encode_whole(out_meis):
+    diff, *sources = [et.tostring(mei, encoding='utf-8') for mei in out_meis]
+    return json.dumps({
+        'content': {
+            'diff': {
+                'detail': str(base64.b64encode(diff), encoding='utf-8'),
+                'encoding': 'base64'
+            },
+            'sources': [
+                {
+                    'detail': str(base64.b64encode(s), encoding='utf-8'),
+                    'encoding': 'base64'
+                }
+                for s in sources
+            ],
+            'tier': None,
+            'coarse': False
+        }
+    }).encode()
+
+
+def measure(fn):
+    """
+    Return the peak memory allocated and time taken by fn, and the number of
+    bytes it sent.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    sent = fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, seconds, sent
+
+
+def main():
+    setup_django()
+    from credo.comparison_jobs import encode_comparison
+    from credo.json_stream import Base64Chunks, read_chunks, stream_json
+    from credo.utils.mei.tree_comparison import TreeComparison
+
+    parser = et.XMLParser(remove_blank_text=True)
+
+    def send(chunks):
+        return sum(len(chunk) for chunk in chunks)
+
+    def mei_whole(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        data = str(base64.b64encode(data), encoding='utf-8')
+        return len(json.dumps({
+            'content': {'mei': {'detail': data, 'encoding': 'base64'}}
+        }).encode())
+
+    def mei_streamed(filename):
+        return send(stream_json({
+            'content': {
+                'mei': {
+                    'detail': Base64Chunks(read_chunks(open(filename, 'rb'))),
+                    'encoding': 'base64'
+                }
+            }
+        }))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for repeats in REPEATS:
+            trees = []
+            filenames = []
+            for i, source in enumerate([SCORE_A, SCORE_B]):
+                filename = os.path.join(directory, f'{i}.mei')
+                write_repeated_score(source, filename, repeats)
+                filenames.append(filename)
+                trees.append(et.parse(filename, parser))
+
+            out_meis = TreeComparison().compare_trees(*trees)
+            print(f'{repeats} repeats')
+
+            cases = [
+                ('/mei whole', lambda: mei_whole(filenames[0])),
+                ('/mei streamed', lambda: mei_streamed(filenames[0])),
+                ('/diff whole', lambda: len(encode_whole(out_meis))),
+                ('/diff streamed', lambda: send(
+                    stream_json(encode_comparison(out_meis))
+                )),
+            ]
+            for name, fn in cases:
+                peak, seconds, sent = measure(fn)
+                print(
+                    f'{name:>16}: {sent / 1024:9.1f} KB sent '
+                    f'{peak / 1024:9.1f} KB peak {seconds * 1000:8.2f} ms'
+                )
+
+
+if __name__ == '__main__':
+    main()
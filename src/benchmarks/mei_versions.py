@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+
+# Benchmark of the size of the versions stored by MEI.record_version for the
+# edits made to scores, as a delta and as a snapshot, on scores made by
+# repeating the measures of the test scores. Edits to normalised scores are
+# renormalised, which renumbers every ID after the edit.
+#
+# Run from the src directory with: python -m benchmarks.mei_versions
+
+import os
+import tempfile
+import time
+from copy import deepcopy
+from io import BytesIO
+
+import lxml.etree as et
+
+from benchmarks.comparison_memory import SCORE_A, SCORE_B, setup_django, \
+    write_repeated_score
+
+REPEATS = [1, 10, 40]
+
+
+def normalise(data: bytes, **options) -> bytes:
+    from utils.mei.stream_normaliser import StreamNormaliser
+
+    output = BytesIO()
+    StreamNormaliser(BytesIO(data), **options).normalise(output)
+    return output.getvalue()
+
+
+def edit(data: bytes, fn) -> bytes:
+    # Apply fn to the middle measure of a score, and renormalise it
+    from utils.mei import queries
+
+    tree = et.ElementTree(et.fromstring(data))
+    bars = queries.MEASURES(tree)
+    fn(bars[len(bars) // 2])
+    return normalise(et.tostring(tree, encoding='utf-8'))
+
+
+def add_note(bar):
+    from utils.mei import queries
+
+    note = next(bar.iter(queries.NOTE))
+    copy = deepcopy(note)
+    for node in copy.iter():
+        node.attrib.pop(queries.XML_ID, None)
+    note.addnext(copy)
+
+
+def remove_measure(bar):
+    bar.getparent().remove(bar)
+
+
+def label_measure(bar):
+    bar.set('label', 'x')
+
+
+def main():
+    setup_django()
+    from credo.utils.mei.tree_comparison import TreeComparison
+    from credo.utils.mei.version_delta import apply_delta, make_delta, \
+        make_snapshot
+
+    with tempfile.TemporaryDirectory() as directory:
+        for repeats in REPEATS:
+            scores = []
+            for i, source in enumerate([SCORE_A, SCORE_B]):
+                filename = os.path.join(directory, f'{i}.mei')
+                write_repeated_score(source, filename, repeats)
+                with open(filename, 'rb') as f:
+                    scores.append(normalise(f.read()))
+            score = scores[0]
+
+            # A revision is made from a comparison, keeping its colours and
+            # IDs until it is resolved and renormalised
+            parser = et.XMLParser(remove_blank_text=True)
+            trees = [et.ElementTree(et.fromstring(s, parser)) for s in scores]
+            diff = et.tostring(
+                TreeComparison().compare_trees(*trees)[0],
+                encoding='utf-8'
+            )
+            revision = normalise(diff, attribs=(), generate_ids=False)
+
+            edits = [
+                ('attribute', score, edit(score, label_measure)),
+                ('add note', score, edit(score, add_note)),
+                ('remove measure', score, edit(score, remove_measure)),
+                ('resolve', revision, normalise(revision)),
+            ]
+            print(f'{repeats} repeats, {len(score) / 1024:.1f} KB score')
+            for name, old, new in edits:
+                start = time.perf_counter()
+                delta = make_delta(old, new)
+                seconds = time.perf_counter() - start
+                snapshot = make_snapshot(new)
+                assert apply_delta(old, delta) == new
+                print(
+                    f'{name:>16}: {len(delta):8} B delta '
+                    f'{len(snapshot):8} B snapshot '
+                    f'{seconds * 1000:8.2f} ms'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+
+# Benchmark of MeiTransformer.normalise against the separate passes it
+# replaced, on the seed scores. Uploads are normalised by StreamNormaliser
+# instead, so this only affects the command line and the benchmarks.
+#
+# Run from the src directory with: python -m benchmarks.normalisation
+
+import glob
+import time
+from copy import deepcopy
+
+from utils.mei.mei_transformer import MeiTransformer
+
+SEED_GLOB = 'credo/migrations/seed_mei/*.mei'
+REPEAT = 15
+
+
+def load_seed_trees():
+    return [
+        MeiTransformer.from_xml_file(filename).tree
+        for filename in sorted(glob.glob(SEED_GLOB))
+    ]
+
+
+def separate_passes(transformer):
+    # How normalise worked previously
+    transformer.remove_metadata()
+    transformer.strip_attribs(['color', 'visible'])
+    transformer.generate_ids()
+
+
+def combined(transformer):
+    transformer.normalise()
+
+
+def best_time(fn, trees):
+    # Normalisation modifies the trees, so each run is given fresh copies.
+    # CPU time is used as wall time is too noisy on shared machines.
+    times = []
+    for _ in range(REPEAT):
+        transformers = [MeiTransformer(deepcopy(tree)) for tree in trees]
+        start = time.process_time()
+        for transformer in transformers:
+            fn(transformer)
+        times.append(time.process_time() - start)
+    return min(times)
+
+
+def main():
+    trees = load_seed_trees()
+    nodes = sum(sum(1 for _ in tree.iter()) for tree in trees)
+    print(f'{len(trees)} seed scores, {nodes} nodes')
+
+    results = {}
+    for name, fn in [
+            ('separate passes', separate_passes),
+            ('combined', combined)]:
+        results[name] = best_time(fn, trees)
+        print(f'{name:>20}: {results[name] * 1000:8.2f} ms per run')
+
+    speedup = results['separate passes'] / results['combined']
+    print(f'{"speedup":>20}: {speedup:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+
+# Times each comparison quality tier on scores made by repeating the measures
+# of the test scores, and fits the cost models in
+# credo.utils.mei.engines.COST_MODELS to the timings.
+#
+# Run from the src directory with: python -m benchmarks.quality_tiers
+
+import os
+import tempfile
+import time
+
+import lxml.etree as et
+import numpy as np
+
+from benchmarks.comparison_memory import SCORE_A, SCORE_B, setup_django, \
+    write_repeated_score
+
+REPEATS = [1, 2, 4, 8, 16]
+# The accurate tier takes minutes on the largest scores
+MAX_REPEATS = {'accurate': 8}
+
+
+def main():
+    setup_django()
+    from credo.utils.mei.engines import COST_MODELS, TIERS, \
+        estimate_cost, get_tier_engine
+    from credo.utils.mei.instrumentation import count_nodes
+
+    parser = et.XMLParser(remove_blank_text=True)
+    timings = {tier: [] for tier in TIERS}
+
+    print(f'{"tier":>9} {"nodes":>7} {"time":>9} {"estimate":>9}')
+    with tempfile.TemporaryDirectory() as directory:
+        a_filename = os.path.join(directory, 'a.mei')
+        b_filename = os.path.join(directory, 'b.mei')
+        for repeats in REPEATS:
+            write_repeated_score(SCORE_A, a_filename, repeats)
+            write_repeated_score(SCORE_B, b_filename, repeats)
+
+            for tier in TIERS:
+                if repeats > MAX_REPEATS.get(tier, repeats):
+                    continue
+
+                a = et.parse(a_filename, parser)
+                b = et.parse(b_filename, parser)
+                nodes = count_nodes(a, b)
+
+                start = time.perf_counter()
+                get_tier_engine(tier).compare_trees(a, b)
+                elapsed = time.perf_counter() - start
+
+                timings[tier].append((nodes, elapsed))
+                print(f'{tier:>9} {nodes:>7} {elapsed:>8.3f}s '
+                      f'{estimate_cost(tier, nodes):>8.3f}s')
+
+    print('\nFitted cost models (current in brackets)')
+    for tier, points in timings.items():
+        nodes, seconds = np.log(np.array(points)).T
+        exponent, intercept = np.polyfit(nodes, seconds, 1)
+        coefficient, current_exponent = COST_MODELS[tier]
+        print(f'{tier:>9}: ({np.exp(intercept):.2g}, {exponent:.2f}) '
+              f'[({coefficient:.2g}, {current_exponent:.2f})]')
+
+
+if __name__ == '__main__':
+    main()
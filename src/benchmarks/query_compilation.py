@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+
+# Micro-benchmark of compiling MEI queries per call against using the
+# precompiled queries in utils.mei.queries, on the seed scores.
+#
+# Run from the src directory with: python -m benchmarks.query_compilation
+
+import glob
+import timeit
+
+from lxml import etree
+
+from utils.mei import queries
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
+
+SEED_GLOB = 'credo/migrations/seed_mei/*.mei'
+REPEAT = 5
+
+
+def load_seed_trees():
+    trees = []
+    for filename in sorted(glob.glob(SEED_GLOB)):
+        transformer = MeiTransformer.from_xml_file(filename)
+        transformer.normalise()
+        trees.append(transformer.tree)
+    return trees
+
+
+def compiled_per_call(trees):
+    # The pattern previously used throughout the MEI utilities
+    for tree in trees:
+        bar_qry = etree.XPath('//mei:measure', namespaces=MEI_NS)
+        for bar in bar_qry(tree):
+            staff_qry = etree.XPath('child::mei:staff', namespaces=MEI_NS)
+            for staff in staff_qry(bar):
+                layer_qry = etree.XPath('child::mei:layer', namespaces=MEI_NS)
+                for layer in layer_qry(staff):
+                    note_qry = etree.XPath('.//mei:note', namespaces=MEI_NS)
+                    for note in note_qry(layer):
+                        for group in ['beam', 'chord']:
+                            group_qry = etree.XPath(
+                                f'ancestor::mei:{group}',
+                                namespaces=MEI_NS
+                            )
+                            group_qry(note)
+
+
+def precompiled(trees):
+    for tree in trees:
+        for bar in queries.MEASURES(tree):
+            for staff in queries.CHILD_STAFFS(bar):
+                for layer in queries.CHILD_LAYERS(staff):
+                    for note in queries.descendant_query('note')(layer):
+                        for group in ['beam', 'chord']:
+                            queries.ancestor_query(group)(note)
+
+
+def count_calls(trees):
+    # Number of queries evaluated by a single run over the trees
+    calls = 0
+    for tree in trees:
+        calls += 1
+        for bar in queries.MEASURES(tree):
+            calls += 1
+            for staff in queries.CHILD_STAFFS(bar):
+                calls += 1
+                for layer in queries.CHILD_LAYERS(staff):
+                    notes = queries.descendant_query('note')(layer)
+                    calls += 1 + 2 * len(notes)
+    return calls
+
+
+def main():
+    trees = load_seed_trees()
+    calls = count_calls(trees)
+    print(f'{len(trees)} seed scores, {calls} queries per run')
+
+    for name, fn in [
+            ('compiled per call', compiled_per_call),
+            ('precompiled', precompiled)]:
+        best = min(timeit.repeat(lambda: fn(trees), number=1, repeat=REPEAT))
+        print(f'{name:>20}: {best * 1000:8.2f} ms per run, '
+              f'{best / calls * 1e6:6.2f} us per query')
+
+
+if __name__ == '__main__':
+    main()
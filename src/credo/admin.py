@@ -3,8 +3,10 @@ from django.contrib import admin
 from .models import (Composer,
                      Song,
                      MEI,
+                     MEIVersion,
                      Edition,
                      Comment,
+                     ComparisonJob,
                      Revision)
 
 
@@ -20,6 +22,18 @@ class MEIAdmin(admin.ModelAdmin):
     list_display = ['id', 'created_at', 'updated_at']
 
 
+class MEIVersionAdmin(admin.ModelAdmin):
+    list_display = [
+            'id',
+            'mei',
+            'number',
+            'is_snapshot',
+            'size',
+            'created_at'
+    ]
+    exclude = ['data']
+
+
 class EditionAdmin(admin.ModelAdmin):
     list_display = [
             'id',
@@ -39,9 +53,24 @@ class RevisionAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'created_at', 'updated_at']
 
 
+class ComparisonJobAdmin(admin.ModelAdmin):
+    list_display = [
+            'id',
+            'mei_a',
+            'mei_b',
+            'status',
+            'attempts',
+            'worker',
+            'created_at',
+            'updated_at'
+    ]
+
+
 admin.site.register(Composer, ComposerAdmin)
 admin.site.register(Song, SongAdmin)
 admin.site.register(MEI, MEIAdmin)
+admin.site.register(MEIVersion, MEIVersionAdmin)
 admin.site.register(Edition, EditionAdmin)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(Revision, RevisionAdmin)
+admin.site.register(ComparisonJob, ComparisonJobAdmin)
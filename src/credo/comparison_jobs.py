@@ -0,0 +1,310 @@
+import logging
+import tempfile
+import threading
+import traceback
+import typing as t
+from datetime import timedelta
+
+import lxml.etree as et
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from credo.json_stream import Base64Chunks, serialise_chunks, stream_json
+from credo.models import ComparisonJob, ComparisonJobWaiter, MEI
+from credo.utils.mei.deadline import ComparisonCancelled, Deadline
+from credo.utils.mei.engines import TIERS, get_engine, get_tier_engine
+
+
+def encode_comparison(
+        out_meis: t.Tuple[et.ElementTree, et.ElementTree, et.ElementTree],
+        tier: t.Optional[str] = None,
+        coarse: bool = False) -> dict:
+    """
+    Encode the output of a comparison as the JSON envelope served by /diff,
+    along with the quality tier it was made with, if any, and whether it fell
+    back to a measure level diff. The MEIs are only serialised as the
+    envelope is encoded with stream_json.
+    """
+    diff, *sources = [
+        {
+            'detail': Base64Chunks(serialise_chunks(mei)),
+            'encoding': 'base64'
+        }
+        for mei in out_meis
+    ]
+
+    return {
+        'content': {
+            'diff': diff,
+            'sources': sources,
+            'tier': tier,
+            'coarse': coarse
+        }
+    }
+
+
+def submit_comparison(
+        a: MEI,
+        b: MEI,
+        engine: t.Optional[str] = None,
+        waiter: t.Optional[str] = None,
+        tier: t.Optional[str] = None) -> ComparisonJob:
+    """
+    Queue a comparison of two MEIs with the named engine, the engine of the
+    named quality tier, or the default engine, returning the existing job if
+    the same contents of the same pair of MEIs have already been submitted
+    for the same engine and tier.
+
+    Failed and cancelled jobs are re-queued when submitted again. If a waiter
+    token is given, it is recorded as waiting on the job, see
+    cancel_comparison.
+    """
+    fields = {
+        'mei_a': a,
+        'mei_b': b,
+        'a_hash': a.get_content_hash(),
+        'b_hash': b.get_content_hash(),
+        'engine': TIERS[tier][0] if tier is not None
+        else engine or settings.COMPARISON_ENGINE,
+        'tier': tier or '',
+    }
+
+    try:
+        with transaction.atomic():
+            job, _ = ComparisonJob.objects.get_or_create(**fields)
+    except IntegrityError:
+        # Another request created the same job concurrently
+        job = ComparisonJob.objects.get(**fields)
+
+    # The job is locked so that it cannot be cancelled by its last waiter
+    # between being re-queued and this waiter being added
+    requeued = [ComparisonJob.FAILED, ComparisonJob.CANCELLED]
+    with transaction.atomic():
+        job = ComparisonJob.objects.select_for_update().get(pk=job.pk)
+        if job.status in requeued:
+            # Any waiters were waiting on the earlier run
+            job.waiters.all().delete()
+            ComparisonJob.objects.filter(pk=job.pk).update(
+                status=ComparisonJob.PENDING,
+                error='',
+                attempts=0
+            )
+            job.refresh_from_db()
+        if waiter is not None:
+            ComparisonJobWaiter.objects.create(job=job, token=waiter)
+
+    return job
+
+
+def cancel_comparison(
+        job: ComparisonJob,
+        waiter: t.Optional[str] = None) -> ComparisonJob:
+    """
+    Cancel a pending or running job. A running job is stopped by its worker
+    within COMPARISON_JOBS['POLL_INTERVAL'] seconds.
+
+    If a waiter token is given, only that waiter stops waiting, and the job
+    is cancelled once no other waiter is left.
+    """
+    with transaction.atomic():
+        job = ComparisonJob.objects.select_for_update().get(pk=job.pk)
+        if waiter is not None:
+            job.waiters.filter(token=waiter).delete()
+            if job.waiters.exists():
+                return job
+
+        ComparisonJob.objects.filter(
+            pk=job.pk,
+            status__in=[ComparisonJob.PENDING, ComparisonJob.RUNNING]
+        ).update(status=ComparisonJob.CANCELLED)
+        job.refresh_from_db()
+    return job
+
+
+def clean_comparison_jobs(ttl: t.Optional[int] = None) -> int:
+    """
+    Delete finished jobs, along with their results, which finished more than
+    ttl seconds ago (COMPARISON_JOBS['RESULT_TTL'] by default), or which
+    compared contents that either MEI no longer has. Returns the number of
+    jobs deleted.
+    """
+    if ttl is None:
+        ttl = settings.COMPARISON_JOBS['RESULT_TTL']
+    expired = timezone.now() - timedelta(seconds=ttl)
+
+    # An MEI whose hash is unknown has not been rewritten since it was
+    # compared, as submitting a comparison stores the hashes
+    superseded = (
+        ~Q(a_hash=F('mei_a__content_hash')) & ~Q(mei_a__content_hash='')
+    ) | (
+        ~Q(b_hash=F('mei_b__content_hash')) & ~Q(mei_b__content_hash='')
+    )
+
+    jobs = ComparisonJob.objects \
+        .exclude(status__in=[ComparisonJob.PENDING, ComparisonJob.RUNNING]) \
+        .filter(Q(updated_at__lt=expired) | superseded)
+    # Deleted one at a time, so that each result is deleted with its job
+    deleted = 0
+    for job in jobs.iterator():
+        job.delete()
+        deleted += 1
+    return deleted
+
+
+def _fail_superseded(job: ComparisonJob) -> bool:
+    """
+    Fail a job, returning True, if either MEI no longer has the contents it
+    was submitted with. Their new contents are compared by a job of their
+    own.
+    """
+    job.mei_a.refresh_from_db()
+    job.mei_b.refresh_from_db()
+    if job.mei_a.get_content_hash() == job.a_hash and \
+            job.mei_b.get_content_hash() == job.b_hash:
+        return False
+
+    logging.getLogger(__name__).info(f'Comparison job {job.id} superseded')
+    # The job may have been cancelled in the meantime
+    ComparisonJob.objects.filter(
+        pk=job.pk,
+        status=ComparisonJob.RUNNING
+    ).update(
+        status=ComparisonJob.FAILED,
+        error='Superseded: an MEI has been rewritten since it was submitted.'
+    )
+    job.refresh_from_db()
+    return True
+
+
+def claim_comparison_job(worker: str) -> t.Optional[ComparisonJob]:
+    """
+    Claim the oldest pending job, or a running job whose worker appears to
+    have died, using SELECT ... FOR UPDATE SKIP LOCKED so that any number of
+    workers can poll the queue concurrently.
+    """
+    config = settings.COMPARISON_JOBS
+    now = timezone.now()
+    stale = now - timedelta(seconds=config['STALE_AFTER'])
+
+    with transaction.atomic():
+        job = ComparisonJob.objects \
+            .select_for_update(skip_locked=True) \
+            .filter(
+                Q(status=ComparisonJob.PENDING) |
+                Q(status=ComparisonJob.RUNNING, claimed_at__lt=stale)
+            ) \
+            .order_by('created_at') \
+            .first()
+
+        if job is None:
+            return None
+
+        job.status = ComparisonJob.RUNNING
+        job.worker = worker
+        job.claimed_at = now
+        job.attempts += 1
+        job.save()
+
+    return job
+
+
+def run_comparison_job(job: ComparisonJob) -> None:
+    """
+    Run a claimed job, storing the encoded comparison as its result.
+    """
+    logger = logging.getLogger(__name__)
+    config = settings.COMPARISON_JOBS
+
+    if job.attempts > config['MAX_ATTEMPTS']:
+        job.status = ComparisonJob.FAILED
+        job.error = 'Exceeded the maximum number of attempts.'
+        job.save()
+        return
+    if _fail_superseded(job):
+        return
+
+    engine = get_tier_engine(job.tier) if job.tier \
+        else get_engine(job.engine)
+    engine.deadline = Deadline(config['DEADLINE'])
+    stop_watching = threading.Event()
+    watcher = threading.Thread(
+        target=_watch_for_cancellation,
+        args=(job.pk, engine.deadline, stop_watching),
+        daemon=True
+    )
+    watcher.start()
+
+    # The envelope is written out as it is encoded, so it is never held in
+    # memory whole
+    data = tempfile.TemporaryFile()
+    try:
+        with engine.trace:
+            out_meis = engine.compare_meis(job.mei_a, job.mei_b)
+            with engine.trace.phase('encode'):
+                envelope = encode_comparison(
+                    out_meis,
+                    job.tier or None,
+                    engine.coarse
+                )
+                for chunk in stream_json(envelope):
+                    data.write(chunk)
+    except ComparisonCancelled:
+        logger.info(f'Comparison job {job.id} cancelled')
+        data.close()
+        job.refresh_from_db()
+        return
+    except Exception:
+        logger.exception(f'Comparison job {job.id} failed')
+        data.close()
+        job.status = ComparisonJob.FAILED
+        job.error = traceback.format_exc()
+        job.save()
+        return
+    finally:
+        stop_watching.set()
+        watcher.join()
+
+    # Either MEI may have been rewritten while it was being compared
+    if _fail_superseded(job):
+        data.close()
+        return
+
+    previous = job.result.name
+    with data:
+        job.result.save(f'comparison_{job.id}.json', File(data), save=False)
+    # The job may have been cancelled after the comparison finished
+    finished = ComparisonJob.objects.filter(
+        pk=job.pk,
+        status=ComparisonJob.RUNNING
+    ).update(status=ComparisonJob.DONE, result=job.result.name, error='')
+
+    if not finished:
+        job.result.delete(save=False)
+    elif previous and previous != job.result.name:
+        # The result of an earlier run of the job has been replaced
+        job.result.storage.delete(previous)
+    job.refresh_from_db()
+
+
+def _watch_for_cancellation(
+        job_id: int,
+        deadline: Deadline,
+        stop: threading.Event):
+    # Runs in its own thread while a job runs, cancelling the deadline of its
+    # comparison when the job is cancelled
+    poll_interval = settings.COMPARISON_JOBS['POLL_INTERVAL']
+    try:
+        while not stop.wait(poll_interval):
+            cancelled = ComparisonJob.objects.filter(
+                pk=job_id,
+                status=ComparisonJob.CANCELLED
+            ).exists()
+            if cancelled:
+                deadline.cancel()
+                return
+    finally:
+        # Each thread has its own database connection
+        connection.close()
@@ -0,0 +1,235 @@
+import logging
+import signal
+import threading
+import time
+import typing as t
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import lxml.etree as et
+from django.conf import settings
+
+from credo.utils.mei.deadline import ComparisonCancelled, Deadline
+from credo.utils.mei.measure_utils import merge_measure_layers
+
+# Extra seconds the web process waits for a result after a task's own
+# timeout, before assuming its worker is stuck
+TIMEOUT_GRACE = 5
+
+# Seconds a task with a deadline may run after the deadline, to fall back to
+# a coarser comparison, before it is abandoned
+DEADLINE_GRACE = 60
+
+# Seconds between checks for the cancellation of a task's deadline
+CANCEL_POLL_INTERVAL = 0.25
+
+
+class ComputeTimeout(Exception):
+    """
+    Raised when a task sent to the compute pool takes longer than its timeout.
+    """
+    pass
+
+
+class ComputeCrashed(Exception):
+    """
+    Raised when the worker process running a task dies.
+    """
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ComputeTimeout()
+
+
+def _run_task(timeout: t.Optional[float], fn: t.Callable, *args):
+    # Runs in the worker process, or inline in the calling process. The alarm
+    # interrupts the task between bytecodes, so a slow comparison does not
+    # keep a worker busy. The previous handler is restored afterwards, as
+    # inline tasks run in the main thread of a web or worker process.
+    if timeout is not None:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        return fn(*args)
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def _parse(data: bytes) -> et.ElementTree:
+    parser = et.XMLParser(remove_blank_text=True)
+    return et.ElementTree(et.fromstring(data, parser))
+
+
+def compare_task(engine, a: bytes, b: bytes) \
+        -> t.Tuple[t.Tuple[bytes, bytes, bytes], t.List[dict]]:
+    """
+    Compare two serialized MEI trees with a ComparisonStrategy, returning the
+    serialized diff, a and b, and the phases recorded by the engine's trace.
+    """
+    # Phases are returned rather than published from the pool process
+    engine.trace.phases.clear()
+    with engine.trace.phase('parse'):
+        trees = _parse(a), _parse(b)
+
+    result = engine.compare_trees(*trees)
+
+    with engine.trace.phase('serialize'):
+        blobs = tuple(et.tostring(tree, encoding='utf-8') for tree in result)
+
+    return blobs, engine.trace.as_list()
+
+
+def merge_measure_layers_task(measure: bytes) -> bytes:
+    """
+    Merge the layers of a serialized measure, returning the merged measure.
+    """
+    merged = merge_measure_layers(et.XML(measure))
+    return et.tostring(merged, encoding='utf-8')
+
+
+class ComputePool:
+    """
+    Bounded pool of processes for CPU bound MEI work, so that web workers
+    only wait on I/O. Tasks take and return serialized XML, which is cheap to
+    send between processes compared to pickling element trees.
+
+    With no processes, tasks are run in the calling process, still subject to
+    the timeout when called from the main thread.
+
+    If a worker dies, the pool is replaced and the task raises
+    ComputeCrashed. Tasks are not retried, as the input that killed a worker
+    would most likely kill the next one.
+    """
+
+    def __init__(self, processes: int = 0, timeout: t.Optional[float] = None):
+        self.logger = logging.getLogger(__name__)
+        self.processes = processes
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def run(
+            self,
+            fn: t.Callable,
+            *args,
+            timeout: t.Optional[float] = None,
+            deadline: t.Optional[Deadline] = None):
+        """
+        Run fn(*args) in the pool and return its result. fn must be a module
+        level function, and its arguments and result must be picklable.
+
+        Without a timeout, a task with a deadline may run until DEADLINE_GRACE
+        seconds after the deadline, however long or short the pool's timeout
+        is, so that it can fall back to a coarser comparison once the deadline
+        passes. Other tasks may run for the pool's timeout.
+
+        If the deadline is cancelled, ComparisonCancelled is raised without
+        waiting for the task. The task itself keeps running until it reaches
+        the deadline, as cancelling only affects this process.
+        """
+        if timeout is None:
+            remaining = None if deadline is None else deadline.remaining()
+            if remaining is not None:
+                timeout = remaining + DEADLINE_GRACE
+            else:
+                timeout = self.timeout
+
+        if self.processes == 0:
+            if threading.current_thread() is threading.main_thread():
+                return _run_task(timeout, fn, *args)
+            return fn(*args)
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(_run_task, timeout, fn, *args)
+            wait = None if timeout is None else timeout + TIMEOUT_GRACE
+            if deadline is None:
+                return future.result(wait)
+            return self._wait(future, wait, deadline)
+        except TimeoutError:
+            # The worker ignored its alarm, most likely as it is stuck in C
+            # code, so replace the pool rather than wait for it.
+            self.logger.error(f'Compute pool task {fn.__name__} is stuck')
+            self._replace_executor(executor)
+            raise ComputeTimeout()
+        except BrokenProcessPool:
+            self.logger.error(f'Compute pool crashed running {fn.__name__}')
+            self._replace_executor(executor)
+            raise ComputeCrashed()
+
+    def compare(self, engine, a: bytes, b: bytes) \
+            -> t.Tuple[t.Tuple[bytes, bytes, bytes], t.List[dict]]:
+        """
+        Compare two serialized MEI trees with a ComparisonStrategy.
+        """
+        return self.run(compare_task, engine, a, b, deadline=engine.deadline)
+
+    def merge_measure_layers(self, measure: bytes) -> bytes:
+        return self.run(merge_measure_layers_task, measure)
+
+    @staticmethod
+    def _wait(future, wait: t.Optional[float], deadline: Deadline):
+        # Wait for a result, raising TimeoutError after wait seconds, and
+        # checking for cancellation while waiting
+        started = time.monotonic()
+        while True:
+            if deadline.cancelled:
+                raise ComparisonCancelled()
+
+            poll = CANCEL_POLL_INTERVAL
+            if wait is not None:
+                left = wait - (time.monotonic() - started)
+                if left <= 0:
+                    raise TimeoutError()
+                poll = min(poll, left)
+
+            try:
+                return future.result(poll)
+            except TimeoutError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.processes)
+            return self._executor
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            # Another thread may have already replaced it
+            if self._executor is broken:
+                self._executor = None
+
+        # Kill any stuck workers, as the executor would otherwise wait on
+        # them forever. The executor does not expose its processes.
+        for process in list(getattr(broken, '_processes', {}).values()):
+            process.terminate()
+        broken.shutdown(wait=False)
+
+
+_compute_pool = None
+
+
+def get_compute_pool() -> ComputePool:
+    """
+    Return the compute pool of this process, configured by
+    settings.COMPUTE_POOL.
+    """
+    global _compute_pool
+    if _compute_pool is None:
+        config = settings.COMPUTE_POOL
+        _compute_pool = ComputePool(
+            processes=config['PROCESSES'],
+            timeout=config['TIMEOUT']
+        )
+    return _compute_pool
@@ -0,0 +1,74 @@
+import typing as t
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, responses are only gzipped without it
+    brotli = None
+
+CHUNK_SIZE = 64 * 2**10
+GZIP_LEVEL = 6
+# Brotli's default quality of 11 is far too slow to compress on the fly
+BROTLI_QUALITY = 5
+
+
+def get_encodings() -> t.List[str]:
+    """
+    Return the content encodings responses may be compressed with, in order
+    of preference.
+    """
+    if brotli is None:
+        return ['gzip']
+    return ['br', 'gzip']
+
+
+def choose_encoding(accept_encoding: str) -> t.Optional[str]:
+    """
+    Return the preferred content encoding accepted by an Accept-Encoding
+    header, or None if the response should not be compressed.
+    """
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+
+    for encoding in get_encodings():
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def encode_chunks(f: t.BinaryIO, encoding: str) -> t.Iterator[bytes]:
+    """
+    Read a file in chunks and yield it compressed with the given content
+    encoding, so that it is never held in memory.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + 15)
+        compress = compressor.compress
+        flush = compressor.flush
+    elif encoding == 'br' and brotli is not None:
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress = compressor.process
+        flush = compressor.finish
+    else:
+        raise ValueError(f'Unsupported content encoding {encoding}')
+
+    try:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            data = compress(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        f.close()
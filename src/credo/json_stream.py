@@ -0,0 +1,135 @@
+import base64
+import json
+import typing as t
+
+import lxml.etree as et
+
+from utils.mei.stream_normaliser import TreeSerialiser
+
+# A multiple of 3, so that each chunk is base64 encoded without padding
+CHUNK_SIZE = 48 * 2**10
+
+
+class Base64Chunks:
+    """
+    A string in a JSON value which is the base64 encoding of bytes that are
+    only read as the value is streamed.
+    """
+
+    def __init__(self, chunks: t.Iterable[bytes]):
+        self.chunks = chunks
+
+
+def read_chunks(f: t.BinaryIO) -> t.Iterator[bytes]:
+    """
+    Read a file in chunks, closing it once it has been read.
+    """
+    try:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+    finally:
+        f.close()
+
+
+def split_chunks(data: bytes) -> t.Iterator[memoryview]:
+    """
+    Split bytes into chunks without copying them.
+    """
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield view[start:start + CHUNK_SIZE]
+
+
+def serialise_chunks(
+        tree: et.ElementTree) -> t.Iterator[t.Union[bytes, memoryview]]:
+    """
+    Serialise an MEI tree in chunks of about CHUNK_SIZE bytes, as it would be
+    by et.tostring. Each chunk is only serialised as it is read, so the
+    serialised tree is never held in memory whole, unless it has a doctype,
+    which libxml2 only writes along with the whole tree.
+    """
+    pending = []
+    size = 0
+    for part in TreeSerialiser(tree).serialise():
+        if len(part) >= CHUNK_SIZE:
+            if pending:
+                yield ''.join(pending).encode()
+                pending = []
+                size = 0
+            yield from split_chunks(part.encode())
+            continue
+        pending.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            yield ''.join(pending).encode()
+            pending = []
+            size = 0
+    if pending:
+        yield ''.join(pending).encode()
+
+
+def encode_base64_chunks(chunks: t.Iterable[bytes]) -> t.Iterator[bytes]:
+    """
+    Base64 encode chunks of bytes one at a time, carrying over the bytes that
+    do not fill a 3 byte group to the next chunk.
+    """
+    remainder = b''
+    for chunk in chunks:
+        if remainder:
+            chunk = remainder + chunk
+        end = len(chunk) - len(chunk) % 3
+        if end:
+            yield base64.b64encode(chunk[:end])
+        remainder = bytes(chunk[end:])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
+def _encode_json(value) -> t.Iterator[bytes]:
+    if isinstance(value, Base64Chunks):
+        yield b'"'
+        yield from encode_base64_chunks(value.chunks)
+        yield b'"'
+    elif isinstance(value, dict):
+        yield b'{'
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield b', '
+            yield json.dumps(key).encode() + b': '
+            yield from _encode_json(item)
+        yield b'}'
+    elif isinstance(value, (list, tuple)):
+        yield b'['
+        for i, item in enumerate(value):
+            if i:
+                yield b', '
+            yield from _encode_json(item)
+        yield b']'
+    else:
+        yield json.dumps(value).encode()
+
+
+def stream_json(value) -> t.Iterator[bytes]:
+    """
+    Encode a value as JSON in chunks of about CHUNK_SIZE bytes. The output is
+    the same as json.dumps, with any Base64Chunks encoded as strings, which
+    are never held in memory whole. Dictionary keys must be strings.
+    """
+    pending = []
+    size = 0
+    for part in _encode_json(value):
+        # Chunks of base64 are sent as they are, rather than copied again
+        if len(part) >= CHUNK_SIZE:
+            if pending:
+                yield b''.join(pending)
+                pending = []
+                size = 0
+            yield part
+            continue
+        pending.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            yield b''.join(pending)
+            pending = []
+            size = 0
+    if pending:
+        yield b''.join(pending)
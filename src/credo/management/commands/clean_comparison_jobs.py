@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from credo.comparison_jobs import clean_comparison_jobs
+
+
+class Command(BaseCommand):
+    help = 'Delete finished comparison jobs and their results once they ' \
+        'have expired, or their MEIs have changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl',
+            type=int,
+            default=settings.COMPARISON_JOBS['RESULT_TTL'],
+            help='Seconds finished jobs are kept for.'
+        )
+
+    def handle(self, *args, **options):
+        if options['ttl'] < 0:
+            raise CommandError('The TTL cannot be negative')
+
+        deleted = clean_comparison_jobs(options['ttl'])
+        self.stdout.write(f'Deleted {deleted} comparison jobs')
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from credo.models import MEI
+
+
+class Command(BaseCommand):
+    help = 'Delete old versions of MEI files, keeping the latest versions ' \
+        'of each.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=settings.MEI_VERSIONS['KEEP'],
+            help='Number of versions of each MEI to keep.'
+        )
+        parser.add_argument(
+            '--mei',
+            type=int,
+            action='append',
+            help='ID of an MEI to compact. Defaults to all MEIs.'
+        )
+
+    def handle(self, *args, **options):
+        keep = options['keep']
+        if keep < 1:
+            raise CommandError('At least one version must be kept')
+
+        meis = MEI.objects.filter(versions__number__isnull=False).distinct()
+        if options['mei']:
+            meis = meis.filter(id__in=options['mei'])
+
+        total = 0
+        for mei in meis.iterator():
+            deleted = mei.compact_versions(keep)
+            if deleted:
+                self.stdout.write(
+                    f'Deleted {deleted} versions of MEI {mei.id}'
+                )
+            total += deleted
+
+        self.stdout.write(f'Deleted {total} versions')
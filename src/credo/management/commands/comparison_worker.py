@@ -0,0 +1,53 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from credo.comparison_jobs import claim_comparison_job, run_comparison_job
+
+
+class Command(BaseCommand):
+    help = 'Run queued comparison jobs. Any number of workers may be run ' \
+        'against the same database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty, instead of polling.'
+        )
+        parser.add_argument(
+            '--name',
+            default=f'{socket.gethostname()}:{os.getpid()}',
+            help='Name recorded on jobs claimed by this worker.'
+        )
+
+    def handle(self, *args, **options):
+        poll_interval = settings.COMPARISON_JOBS['POLL_INTERVAL']
+        worker = options['name']
+
+        self.stdout.write(f'Comparison worker {worker} started')
+
+        try:
+            while True:
+                close_old_connections()
+                job = claim_comparison_job(worker)
+
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                self.stdout.write(f'Running comparison job {job.id}')
+                run_comparison_job(job)
+                self.stdout.write(
+                    f'Comparison job {job.id} finished: {job.status}'
+                )
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(f'Comparison worker {worker} stopped')
@@ -0,0 +1,53 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from credo.normalisation_jobs import claim_normalisation, run_normalisation
+
+
+class Command(BaseCommand):
+    help = 'Normalise saved MEI files. Any number of workers may be run ' \
+        'against the same database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty, instead of polling.'
+        )
+        parser.add_argument(
+            '--name',
+            default=f'{socket.gethostname()}:{os.getpid()}',
+            help='Name logged for MEIs claimed by this worker.'
+        )
+
+    def handle(self, *args, **options):
+        poll_interval = settings.NORMALISATION_JOBS['POLL_INTERVAL']
+        worker = options['name']
+
+        self.stdout.write(f'Normalisation worker {worker} started')
+
+        try:
+            while True:
+                close_old_connections()
+                mei = claim_normalisation(worker)
+
+                if mei is None:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                self.stdout.write(f'Normalising MEI {mei.id}')
+                run_normalisation(mei)
+                self.stdout.write(
+                    f'Normalisation of MEI {mei.id} finished: {mei.status}'
+                )
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(f'Normalisation worker {worker} stopped')
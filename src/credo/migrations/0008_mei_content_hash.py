@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0007_mei_normalisation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mei',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
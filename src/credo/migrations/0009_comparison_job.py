@@ -0,0 +1,40 @@
+# Generated by Django 2.2.4 on 2026-10-18 05:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0008_mei_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComparisonJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('a_hash', models.CharField(max_length=64)),
+                ('b_hash', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('result', models.FileField(blank=True, null=True, upload_to='comparison_results')),
+                ('error', models.TextField(blank=True, default='')),
+                ('attempts', models.IntegerField(default=0)),
+                ('worker', models.TextField(blank=True, default='')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('mei_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='credo.MEI')),
+                ('mei_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='credo.MEI')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='comparisonjob',
+            index=models.Index(fields=['status', 'created_at'], name='credo_compa_status_899bed_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='comparisonjob',
+            constraint=models.UniqueConstraint(fields=('mei_a', 'mei_b', 'a_hash', 'b_hash'), name='unique_comparison_job'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0009_comparison_job'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='comparisonjob',
+            name='unique_comparison_job',
+        ),
+        migrations.AddField(
+            model_name='comparisonjob',
+            name='engine',
+            field=models.CharField(default='tree', max_length=16),
+        ),
+        migrations.AddConstraint(
+            model_name='comparisonjob',
+            constraint=models.UniqueConstraint(fields=('mei_a', 'mei_b', 'a_hash', 'b_hash', 'engine'), name='unique_comparison_job'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0010_comparison_job_engine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mei',
+            name='node_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0011_mei_node_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comparisonjob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=16),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0012_comparison_job_cancelled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mei',
+            name='intermediate',
+            field=models.FileField(blank=True, null=True, upload_to='mei_intermediate'),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='intermediate_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='layer_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='measure_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='staff_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
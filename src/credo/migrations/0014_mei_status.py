@@ -0,0 +1,37 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0013_mei_intermediate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mei',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='normalisation_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='normalisation_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='mei',
+            name='status',
+            field=models.CharField(choices=[('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='mei',
+            index=models.Index(fields=['status', 'updated_at'], name='credo_mei_status_d58e2d_idx'),
+        ),
+    ]
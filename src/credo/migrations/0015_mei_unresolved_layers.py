@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0014_mei_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mei',
+            name='unresolved_layers',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.4 on 2026-10-18 06:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0015_mei_unresolved_layers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MEIVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('is_snapshot', models.BooleanField()),
+                ('data', models.BinaryField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('size', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('mei', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='credo.MEI')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='meiversion',
+            constraint=models.UniqueConstraint(fields=('mei', 'number'), name='unique_mei_version'),
+        ),
+    ]
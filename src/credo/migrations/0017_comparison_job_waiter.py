@@ -0,0 +1,23 @@
+# Generated by Django 2.2.4 on 2026-10-18 07:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0016_mei_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComparisonJobWaiter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waiters', to='credo.ComparisonJob')),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.4 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('credo', '0017_comparison_job_waiter'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='comparisonjob',
+            name='unique_comparison_job',
+        ),
+        migrations.AddField(
+            model_name='comparisonjob',
+            name='tier',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddConstraint(
+            model_name='comparisonjob',
+            constraint=models.UniqueConstraint(fields=('mei_a', 'mei_b', 'a_hash', 'b_hash', 'engine', 'tier'), name='unique_comparison_job'),
+        ),
+    ]
@@ -1,9 +1,22 @@
 import os
-from django.db import models
-from django.db.models.signals import post_save
+import tempfile
+import typing as t
+from django.conf import settings
+from django.core.files.base import File
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from utils.mei.mei_transformer import MeiTransformer
+from django.utils import timezone
+from utils.mei.stream_normaliser import StreamIntermediate, StreamNormaliser
+from credo.utils.mei.comparison_cache import content_digest, \
+    get_comparison_cache
+from credo.utils.mei.instrumentation import count_serialized_nodes
+from credo.utils.mei.measure_patch import patch_measures
+from credo.utils.mei.resolve_utils import count_unresolved_layers, \
+    count_unresolved_layers_in_file
+from credo.utils.mei.version_delta import apply_delta, make_delta, \
+    make_snapshot, read_snapshot
 
 
 class Composer(models.Model):
@@ -30,36 +43,578 @@ class Song(models.Model):
 
 
 class MEI(models.Model):
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
     data = models.FileField(upload_to='mei_files')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     normalised = models.BooleanField(default=True)
+    # Whether the stored file has been normalised since it was last saved,
+    # see credo/normalisation_jobs.py
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=READY
+    )
+    # Set while a normalisation_worker is processing the file
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    normalisation_attempts = models.IntegerField(default=0)
+    normalisation_error = models.TextField(blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # Number of nodes in the stored file, used to estimate comparison costs
+    node_count = models.IntegerField(null=True, blank=True)
+    # The stored file in the intermediate representation compared by
+    # TreeComparison, and the content hash it was derived from
+    intermediate = models.FileField(
+        upload_to='mei_intermediate',
+        null=True,
+        blank=True
+    )
+    intermediate_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        default=''
+    )
+    # Structural summary of the stored file
+    measure_count = models.IntegerField(null=True, blank=True)
+    staff_count = models.IntegerField(null=True, blank=True)
+    layer_count = models.IntegerField(null=True, blank=True)
+    # Number of layers of an unnormalised file which are yet to be resolved
+    unresolved_layers = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
 
     def __str__(self):
         file_id = os.path.split(self.data.name)[-1].split("_")[-1]
         return f'MEI object {file_id} created at {self.created_at}'
 
+    @property
+    def is_ready(self) -> bool:
+        return self.status == MEI.READY
+
+    def update_content_hash(self) -> str:
+        """
+        Recompute the digest and node count of the stored file, dropping any
+        cached comparisons made against its previous contents.
+        """
+        with self.data.storage.open(self.data.name, 'rb') as f:
+            data = f.read()
+        digest = content_digest(data)
+
+        if digest != self.content_hash or self.node_count is None:
+            # Comparisons of the old contents still hold for any forks
+            # sharing them
+            if digest != self.content_hash and \
+                    not self._is_shared('content_hash', self.content_hash):
+                get_comparison_cache().invalidate(self.content_hash)
+            self.content_hash = digest
+            self.node_count = count_serialized_nodes(data)
+            # Update the columns directly, to avoid re-triggering post_save
+            MEI.objects.filter(pk=self.pk).update(
+                content_hash=digest,
+                node_count=self.node_count
+            )
+
+        return digest
+
+    def get_content_hash(self) -> str:
+        """
+        Return the digest of the stored file, computing it if it is unknown.
+        """
+        if not self.content_hash:
+            return self.update_content_hash()
+        return self.content_hash
+
+    def get_node_count(self) -> int:
+        """
+        Return the number of nodes in the stored file, counting them if they
+        are unknown.
+        """
+        if self.node_count is None:
+            self.update_content_hash()
+        return self.node_count
+
+    def get_unresolved_layers(self) -> int:
+        """
+        Return the number of layers of the stored file which are yet to be
+        resolved, counting them if they are unknown.
+        """
+        if self.unresolved_layers is None:
+            with self.data.storage.open(self.data.name, 'rb') as f:
+                self.unresolved_layers = count_unresolved_layers_in_file(f)
+            # Update the columns directly, to avoid re-triggering post_save
+            MEI.objects.filter(pk=self.pk).update(
+                unresolved_layers=self.unresolved_layers
+            )
+        return self.unresolved_layers
+
+    def patch_measures(self, measures: t.Dict[str, str]):
+        """
+        Replace the measures of the stored file with the given IDs, without
+        parsing or re-normalising the rest of the file, and update the
+        derived fields. Raises ValueError if a measure is invalid or is not
+        in the file.
+
+        Unlike saving, IDs are kept as they are, so a patched measure should
+        only reuse IDs from the measure it replaces.
+        """
+        with transaction.atomic():
+            # Patches lock the row, and reload the MEI, so that concurrent
+            # patches read and rewrite the file and unresolved_layers in turn
+            MEI.objects.select_for_update().get(pk=self.pk)
+            self.refresh_from_db()
+
+            if not self.normalised:
+                unresolved = self.get_unresolved_layers()
+
+            self._unshare_data()
+            with self.data.storage.open(self.data.name, 'rb') as f:
+                data = f.read()
+            # Normalised files have the attributes stripped by normalisation
+            data, new_measures, old_measures = patch_measures(
+                data,
+                measures,
+                attribs=('color', 'visible') if self.normalised else ()
+            )
+            _replace_file(self.data.path, data)
+
+            self.updated_at = timezone.now()
+            MEI.objects.filter(pk=self.pk).update(updated_at=self.updated_at)
+            self.update_content_hash()
+            self.record_version()
+
+            if self.normalised:
+                self.update_intermediate()
+            else:
+                # Only the patched measures need to be checked
+                self.unresolved_layers = unresolved \
+                    + sum(map(count_unresolved_layers, new_measures)) \
+                    - sum(map(count_unresolved_layers, old_measures))
+                MEI.objects.filter(pk=self.pk).update(
+                    unresolved_layers=self.unresolved_layers
+                )
+
+    def record_version(self) -> t.Optional['MEIVersion']:
+        """
+        Append the stored file to the version history, as a delta from the
+        latest version unless a snapshot is due or the delta would be no
+        smaller. Returns the latest version, which is left as it is if the
+        file has not changed since.
+        """
+        config = settings.MEI_VERSIONS
+        if not config['ENABLED']:
+            return None
+
+        with self.data.storage.open(self.data.name, 'rb') as f:
+            data = f.read()
+        digest = self.get_content_hash()
+
+        with transaction.atomic():
+            # Lock the MEI, so that concurrent saves number their versions in
+            # turn
+            MEI.objects.select_for_update().filter(pk=self.pk).exists()
+            latest = self.versions.order_by('-number').first()
+            if latest is not None and latest.content_hash == digest:
+                return latest
+
+            version = MEIVersion(
+                mei=self,
+                number=latest.number + 1 if latest else 1,
+                content_hash=digest,
+                size=len(data),
+                is_snapshot=True,
+                data=make_snapshot(data)
+            )
+            # Snapshots bound the number of deltas applied to rebuild any
+            # version
+            if latest is not None and version.number - \
+                    self._get_snapshot_number(latest.number) < \
+                    config['SNAPSHOT_INTERVAL']:
+                delta = make_delta(self.get_version(latest.number), data)
+                if len(delta) < len(version.data):
+                    version.is_snapshot = False
+                    version.data = delta
+            version.save()
+
+        return version
+
+    def get_version(self, number: int) -> bytes:
+        """
+        Rebuild a version of the stored file from the snapshot before it and
+        the deltas since. Raises MEIVersion.DoesNotExist if there is no such
+        version, or if it has been compacted away.
+        """
+        versions = self.versions \
+            .filter(
+                number__gte=self._get_snapshot_number(number),
+                number__lte=number
+            ) \
+            .order_by('number')
+
+        data = None
+        for version in versions:
+            if version.is_snapshot:
+                data = read_snapshot(version.data)
+            else:
+                data = apply_delta(data, version.data)
+
+        if data is None or version.number != number:
+            raise MEIVersion.DoesNotExist(f'No version {number} of {self}')
+        if content_digest(data) != version.content_hash:
+            raise ValueError(f'Version {number} of {self} is corrupt')
+        return data
+
+    def compact_versions(self, keep: int) -> int:
+        """
+        Delete all but the latest keep versions, turning the earliest kept
+        version into a snapshot if it is a delta. Returns the number of
+        versions deleted.
+        """
+        with transaction.atomic():
+            MEI.objects.select_for_update().filter(pk=self.pk).exists()
+            numbers = list(
+                self.versions
+                .order_by('-number')
+                .values_list('number', flat=True)[:keep]
+            )
+            if not numbers:
+                return 0
+
+            first = self.versions.get(number=numbers[-1])
+            if not first.is_snapshot:
+                first.data = make_snapshot(self.get_version(first.number))
+                first.is_snapshot = True
+                first.save(update_fields=['data', 'is_snapshot'])
+
+            deleted, _ = self.versions \
+                .filter(number__lt=first.number) \
+                .delete()
+        return deleted
+
+    def _get_snapshot_number(self, number: int) -> int:
+        snapshot_number = self.versions \
+            .filter(is_snapshot=True, number__lte=number) \
+            .order_by('-number') \
+            .values_list('number', flat=True) \
+            .first()
+        if snapshot_number is None:
+            raise MEIVersion.DoesNotExist(f'No version {number} of {self}')
+        return snapshot_number
+
+    def update_intermediate(self):
+        """
+        Store the stored file in the intermediate representation, with its
+        measure, staff and layer counts, so comparisons need not convert it.
+        The file is converted as it is streamed, so that large scores are
+        never held in memory.
+        """
+        with self.data.storage.open(self.data.name, 'rb') as f, \
+                tempfile.TemporaryFile() as output:
+            converter = StreamIntermediate(f)
+            converter.convert(output)
+            output.seek(0)
+
+            self.measure_count = converter.measure_count
+            self.staff_count = converter.staff_count
+            self.layer_count = converter.layer_count
+
+            self._delete_intermediate()
+            self.intermediate.save(
+                os.path.basename(self.data.name),
+                File(output),
+                save=False
+            )
+        self.intermediate_hash = self.get_content_hash()
+        self._update_intermediate_columns()
+
+    def clear_intermediate(self):
+        """
+        Delete the intermediate representation and structural summary, which
+        no longer describe the stored file.
+        """
+        self._delete_intermediate()
+        self.intermediate = None
+        self.intermediate_hash = ''
+        self.measure_count = None
+        self.staff_count = None
+        self.layer_count = None
+        self._update_intermediate_columns()
+
+    def has_intermediate(self) -> bool:
+        """
+        Whether the intermediate representation was derived from the current
+        contents of the stored file.
+        """
+        return bool(self.intermediate) and \
+            self.intermediate_hash == self.get_content_hash()
+
+    def fork(self) -> 'MEI':
+        """
+        Create an MEI sharing the stored file, intermediate representation
+        and derived fields of this one, without reading or writing any file.
+        The stored file is copied when either MEI is first rewritten.
+        """
+        fork = MEI(
+            data=self.data.name,
+            normalised=self.normalised,
+            status=self.status,
+            content_hash=self.content_hash,
+            node_count=self.node_count,
+            intermediate=self.intermediate.name or None,
+            intermediate_hash=self.intermediate_hash,
+            measure_count=self.measure_count,
+            staff_count=self.staff_count,
+            layer_count=self.layer_count,
+            unresolved_layers=self.unresolved_layers
+        )
+        # The shared file is already normalised, so is not normalised again
+        fork._skip_normalisation = True
+        fork.save()
+        return fork
+
+    def _is_shared(self, field: str, name: str) -> bool:
+        return MEI.objects \
+            .filter(**{field: name}) \
+            .exclude(pk=self.pk) \
+            .exists()
+
+    def _unshare_data(self):
+        """
+        Copy the stored file if it is shared with a fork, so that it can be
+        rewritten in place.
+        """
+        if not self._is_shared('data', self.data.name):
+            return
+
+        storage = self.data.storage
+        with storage.open(self.data.name, 'rb') as f:
+            name = storage.save(self.data.name, f)
+        # Assigning the name drops the field's file, which is still open on
+        # the shared file
+        self.data = name
+        MEI.objects.filter(pk=self.pk).update(data=name)
+
+    def _delete_intermediate(self):
+        # Forks share the intermediate representation until it is replaced
+        if self.intermediate and \
+                not self._is_shared('intermediate', self.intermediate.name):
+            self.intermediate.storage.delete(self.intermediate.name)
+
+    def _update_intermediate_columns(self):
+        # Update the columns directly, to avoid re-triggering post_save
+        MEI.objects.filter(pk=self.pk).update(
+            intermediate=self.intermediate.name or None,
+            intermediate_hash=self.intermediate_hash,
+            measure_count=self.measure_count,
+            staff_count=self.staff_count,
+            layer_count=self.layer_count
+        )
+
 
 @receiver(post_save, sender=MEI)
 def normalise_callback(sender, instance, *args, **kwargs):
-    mei_file = instance.data.file.open()
-    transformer = MeiTransformer.from_xml_file(mei_file)
+    # Set by MEI.fork, whose file is already normalised
+    if getattr(instance, '_skip_normalisation', False):
+        instance._skip_normalisation = False
+        return
+
+    if settings.NORMALISATION_JOBS['ENABLED']:
+        # Leave the file to a normalisation_worker. Saving the MEI again
+        # before it is normalised re-queues it.
+        instance.status = MEI.PROCESSING
+        instance.claimed_at = None
+        instance.normalisation_attempts = 0
+        instance.normalisation_error = ''
+        # Update the columns directly, to avoid re-triggering post_save
+        MEI.objects.filter(pk=instance.pk).update(
+            status=MEI.PROCESSING,
+            claimed_at=None,
+            normalisation_attempts=0,
+            normalisation_error=''
+        )
+        return
+
+    try:
+        normalise_mei(instance)
+    except Exception:
+        instance.status = MEI.FAILED
+        MEI.objects.filter(pk=instance.pk).update(status=MEI.FAILED)
+        raise
+
+    if not instance.is_ready:
+        instance.status = MEI.READY
+        MEI.objects.filter(pk=instance.pk).update(status=MEI.READY)
+
 
+def normalise_mei(
+        instance: MEI,
+        claim: t.Optional[models.QuerySet] = None) -> bool:
+    """
+    Normalise the stored file of an MEI in place, re-key the comments on its
+    revisions to the new IDs, and update the content hash and intermediate
+    representation.
+
+    The normalised file and derived fields are only written while the MEI's
+    row is locked, and only if it still has the stored file which was
+    normalised and, given a claim, the claim still matches it. Otherwise the
+    work was superseded, so it is dropped and False is returned.
+    """
+    name = instance.data.name
+
+    # The file is normalised as it is streamed to a temporary file, so that
+    # large scores are never held in memory
     if instance.normalised:
-        transformer.normalise()
-        id_map = transformer.get_id_map()
-        # get the comments which need to be re-keyed
+        normaliser = StreamNormaliser(instance.data.file.open())
+        # Only the IDs of comments need to be mapped
         revision_set = instance.revision_set.all()
-        relevant_comments = Comment.objects.filter(
-                revision__in=revision_set,
-                mei_element_id__in=id_map)
-        for comment in relevant_comments:
-            comment.mei_element_id = id_map[comment.mei_element_id]
-            comment.save()
+        comment_ids = Comment.objects.filter(
+                revision__in=revision_set).values_list(
+                'mei_element_id', flat=True)
     else:
-        transformer.remove_metadata()
+        normaliser = StreamNormaliser(
+            instance.data.file.open(), attribs=(), generate_ids=False)
+        comment_ids = []
+
+    directory, filename = os.path.split(instance.data.path)
+    with tempfile.NamedTemporaryFile(
+            dir=directory,
+            prefix=f'.{filename}.',
+            delete=False) as output:
+        try:
+            normaliser.normalise(output, tracked_ids=comment_ids)
+        except Exception:
+            os.remove(output.name)
+            raise
+        finally:
+            instance.data.file.close()
+
+    try:
+        with transaction.atomic():
+            current = claim if claim is not None \
+                else MEI.objects.filter(pk=instance.pk)
+            if current.select_for_update().filter(data=name).first() is None:
+                os.remove(output.name)
+                return False
+
+            # Copying a shared file only now leaves it alone if the work is
+            # dropped
+            instance._unshare_data()
+            os.replace(output.name, instance.data.path)
+            # Reopen the field's file, which still refers to the replaced
+            # file
+            instance.data.open('rb')
 
-    transformer.save_xml_file(instance.data.name)
+            _update_normalised(instance, normaliser)
+    except Exception:
+        if os.path.exists(output.name):
+            os.remove(output.name)
+        raise
+    return True
+
+
+def _update_normalised(instance: MEI, normaliser: StreamNormaliser):
+    # Update the fields derived from a newly normalised file
+    if instance.normalised:
+        _rekey_comments(instance.revision_set.all(), normaliser.get_id_map())
+
+    instance.update_content_hash()
+    instance.record_version()
+
+    # Unresolved layers are only counted in unnormalised files, which are
+    # still being resolved
+    instance.unresolved_layers = None
+    MEI.objects.filter(pk=instance.pk).update(unresolved_layers=None)
+    if not instance.normalised:
+        instance.get_unresolved_layers()
+
+    # Only normalised files are compared, so only they are worth converting
+    # to the intermediate representation up front. Saving an unchanged file
+    # keeps its current artifact.
+    if instance.normalised:
+        if not instance.has_intermediate():
+            instance.update_intermediate()
+    else:
+        instance.clear_intermediate()
+
+
+def _replace_file(path: str, data: bytes):
+    # Write to a temporary file and rename it over the stored file, so the
+    # stored file is never partly written
+    directory, basename = os.path.split(path)
+    with tempfile.NamedTemporaryFile(
+            dir=directory,
+            prefix=f'.{basename}.',
+            delete=False) as output:
+        try:
+            output.write(data)
+        except Exception:
+            os.remove(output.name)
+            raise
+    os.replace(output.name, path)
+
+
+def _rekey_comments(revision_set, id_map: t.Dict[str, str]):
+    """
+    Point the comments on the revisions at the new IDs of their elements, in
+    a single UPDATE whatever the number of comments.
+    """
+    with transaction.atomic():
+        comments = list(
+            Comment.objects
+            .select_for_update()
+            .filter(revision__in=revision_set, mei_element_id__in=id_map)
+            .only('id', 'mei_element_id')
+        )
+        if not comments:
+            return
+
+        # bulk_update skips auto_now, which save would have set
+        now = timezone.now()
+        for comment in comments:
+            comment.mei_element_id = id_map[comment.mei_element_id]
+            comment.updated_at = now
+        Comment.objects.bulk_update(comments, ['mei_element_id', 'updated_at'])
+
+
+class MEIVersion(models.Model):
+    """
+    A version of the stored file of an MEI, kept as a compressed snapshot or
+    as a delta from the version before it.
+    """
+    mei = models.ForeignKey(
+        MEI,
+        on_delete=models.CASCADE,
+        related_name='versions'
+    )
+    number = models.IntegerField()
+    is_snapshot = models.BooleanField()
+    # Compressed, see credo.utils.mei.version_delta
+    data = models.BinaryField()
+    content_hash = models.CharField(max_length=64)
+    # Size of the file, rather than of the snapshot or delta
+    size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['mei', 'number'],
+                name='unique_mei_version'
+            )
+        ]
+
+    def __str__(self):
+        return f'Version {self.number} of {self.mei}'
 
 
 class Edition(models.Model):
@@ -99,3 +654,91 @@ class Comment(models.Model):
 
     def __str__(self):
         return f'Comment on {self.revision} by {self.user}'
+
+
+class ComparisonJob(models.Model):
+    """
+    A comparison of two MEI files, run in the background by the
+    comparison_worker management command.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    mei_a = models.ForeignKey(MEI, on_delete=models.CASCADE, related_name='+')
+    mei_b = models.ForeignKey(MEI, on_delete=models.CASCADE, related_name='+')
+    # Content hashes of the MEIs when the job was submitted. Rewriting either
+    # MEI gives a new pair of hashes, and so a new job.
+    a_hash = models.CharField(max_length=64)
+    b_hash = models.CharField(max_length=64)
+    # Name of the comparison engine, see credo.utils.mei.engines, and the
+    # quality tier it was chosen by, if any, which also sets its options
+    engine = models.CharField(max_length=16, default='tree')
+    tier = models.CharField(max_length=16, blank=True, default='')
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=PENDING
+    )
+    result = models.FileField(
+        upload_to='comparison_results',
+        null=True,
+        blank=True
+    )
+    error = models.TextField(blank=True, default='')
+    attempts = models.IntegerField(default=0)
+    worker = models.TextField(blank=True, default='')
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    'mei_a', 'mei_b', 'a_hash', 'b_hash', 'engine', 'tier'
+                ],
+                name='unique_comparison_job'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f'Comparison of {self.mei_a_id} and {self.mei_b_id} ' \
+            f'({self.status})'
+
+
+class ComparisonJobWaiter(models.Model):
+    """
+    A page waiting on the result of a comparison job. Jobs are shared by
+    everyone comparing the same contents, so a job is only cancelled once no
+    page is waiting on it.
+    """
+    job = models.ForeignKey(
+        ComparisonJob,
+        on_delete=models.CASCADE,
+        related_name='waiters'
+    )
+    # Secret given to the page that submitted the job, which it cancels with
+    token = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Waiter on comparison job {self.job_id}'
+
+
+@receiver(post_delete, sender=ComparisonJob)
+def delete_comparison_result(sender, instance, *args, **kwargs):
+    if instance.result:
+        instance.result.delete(save=False)
@@ -0,0 +1,92 @@
+import logging
+import traceback
+import typing as t
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from credo.models import MEI, normalise_mei
+
+
+def claim_normalisation(worker: str) -> t.Optional[MEI]:
+    """
+    Claim the MEI which has been waiting longest to be normalised, or one
+    whose worker appears to have died, using SELECT ... FOR UPDATE SKIP
+    LOCKED so that any number of workers can poll the queue concurrently.
+    """
+    config = settings.NORMALISATION_JOBS
+    now = timezone.now()
+    stale = now - timedelta(seconds=config['STALE_AFTER'])
+
+    with transaction.atomic():
+        mei = MEI.objects \
+            .select_for_update(skip_locked=True) \
+            .filter(
+                Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale),
+                status=MEI.PROCESSING
+            ) \
+            .order_by('updated_at') \
+            .first()
+
+        if mei is None:
+            return None
+
+        mei.claimed_at = now
+        mei.normalisation_attempts += 1
+        # Update the columns directly, to avoid re-triggering post_save
+        MEI.objects.filter(pk=mei.pk).update(
+            claimed_at=mei.claimed_at,
+            normalisation_attempts=mei.normalisation_attempts
+        )
+
+    logging.getLogger(__name__).info(
+        f'MEI {mei.id} claimed for normalisation by {worker}'
+    )
+    return mei
+
+
+def run_normalisation(mei: MEI) -> None:
+    """
+    Normalise a claimed MEI, marking it as ready, or as failed if it could
+    not be normalised.
+    """
+    logger = logging.getLogger(__name__)
+    config = settings.NORMALISATION_JOBS
+
+    # Only finish the claim made by this worker. If the MEI is saved again
+    # while it is normalised, it is re-queued and left for the next claim.
+    claim = MEI.objects.filter(
+        pk=mei.pk,
+        status=MEI.PROCESSING,
+        claimed_at=mei.claimed_at
+    )
+
+    if mei.normalisation_attempts > config['MAX_ATTEMPTS']:
+        claim.update(
+            status=MEI.FAILED,
+            normalisation_error='Exceeded the maximum number of attempts.'
+        )
+        mei.refresh_from_db()
+        return
+
+    try:
+        normalised = normalise_mei(mei, claim)
+    except Exception:
+        logger.exception(f'Normalisation of MEI {mei.id} failed')
+        claim.update(
+            status=MEI.FAILED,
+            normalisation_error=traceback.format_exc()
+        )
+        mei.refresh_from_db()
+        return
+
+    if not normalised:
+        logger.info(f'Normalisation of MEI {mei.id} was superseded')
+        mei.refresh_from_db()
+        return
+
+    claim.update(status=MEI.READY, claimed_at=None)
+    mei.refresh_from_db()
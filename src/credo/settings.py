@@ -157,6 +157,117 @@ LOGOUT_REDIRECT_URL = 'index'
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
+# Comparison engine
+# The engine used by /diff and background comparisons when a request does
+# not name one. One of the names in credo.utils.mei.engines.ENGINES.
+COMPARISON_ENGINE = os.environ.get('COMPARISON_ENGINE', 'tree')
+# Set COMPARISON_QUALITY_TIER to a tier in credo.utils.mei.engines.TIERS, or
+# to auto, to choose engines by quality tier instead. Auto picks the most
+# accurate tier expected to take at most COMPARISON_LATENCY_BUDGET seconds.
+COMPARISON_QUALITY_TIER = os.environ.get('COMPARISON_QUALITY_TIER') or None
+COMPARISON_LATENCY_BUDGET = float(
+    os.environ.get('COMPARISON_LATENCY_BUDGET', '10')
+)
+# Seconds a comparison requested by a page may take before it falls back to
+# a measure level diff. Keep it below the proxy's timeout, so that the result
+# is still read.
+COMPARISON_DEADLINE = float(os.environ.get('COMPARISON_DEADLINE', '50'))
+
+# Comparison result cache
+# The memory tier is per process, the disk tier is shared by every process
+# pointed at the same directory. Leave COMPARISON_CACHE_DIR unset to disable
+# the disk tier.
+COMPARISON_CACHE = {
+    'MEMORY_ENTRIES': int(
+        os.environ.get('COMPARISON_CACHE_MEMORY_ENTRIES', '16')
+    ),
+    'DISK_DIR': os.environ.get('COMPARISON_CACHE_DIR') or None,
+    'DISK_MAX_BYTES': int(
+        os.environ.get('COMPARISON_CACHE_DISK_MAX_BYTES', str(256 * 2**20))
+    ),
+}
+
+# Background comparison jobs
+# When enabled, the compare page queues its comparison and polls for the
+# result, which is computed by `python manage.py comparison_worker`.
+COMPARISON_JOBS = {
+    'ENABLED': os.environ.get('COMPARISON_JOBS_ENABLED', 'false') == 'true',
+    # Seconds a worker sleeps when the queue is empty
+    'POLL_INTERVAL': float(
+        os.environ.get('COMPARISON_JOBS_POLL_INTERVAL', '1')
+    ),
+    # Seconds after which a running job is assumed to have lost its worker
+    'STALE_AFTER': int(os.environ.get('COMPARISON_JOBS_STALE_AFTER', '600')),
+    'MAX_ATTEMPTS': int(os.environ.get('COMPARISON_JOBS_MAX_ATTEMPTS', '3')),
+    # Seconds a job may take before it falls back to a measure level diff,
+    # which should be less than STALE_AFTER
+    'DEADLINE': float(os.environ.get('COMPARISON_JOBS_DEADLINE', '300')),
+    # Seconds a finished job and its result are kept before
+    # `python manage.py clean_comparison_jobs` deletes them
+    'RESULT_TTL': int(os.environ.get('COMPARISON_JOBS_RESULT_TTL', '86400')),
+}
+
+# Background normalisation
+# When enabled, saving an MEI marks it as processing and returns, and its file
+# is normalised by `python manage.py normalisation_worker`. Otherwise files
+# are normalised in the request that saves them.
+NORMALISATION_JOBS = {
+    'ENABLED': os.environ.get('NORMALISATION_JOBS_ENABLED', 'false') == 'true',
+    # Seconds a worker sleeps when the queue is empty
+    'POLL_INTERVAL': float(
+        os.environ.get('NORMALISATION_JOBS_POLL_INTERVAL', '1')
+    ),
+    # Seconds after which a claimed MEI is assumed to have lost its worker
+    'STALE_AFTER': int(
+        os.environ.get('NORMALISATION_JOBS_STALE_AFTER', '600')
+    ),
+    'MAX_ATTEMPTS': int(
+        os.environ.get('NORMALISATION_JOBS_MAX_ATTEMPTS', '3')
+    ),
+}
+
+# MEI version history
+# When enabled, every change to the stored file of an MEI is kept, mostly as
+# deltas from the version before. Rebuilding a version applies fewer than
+# SNAPSHOT_INTERVAL deltas to the snapshot before it. Old versions are deleted
+# with `python manage.py compact_mei_versions`, which keeps the latest KEEP
+# versions of each MEI by default. It is off by default until the storage it
+# takes in production is known; see benchmarks/mei_versions.py for the sizes
+# of versions.
+MEI_VERSIONS = {
+    'ENABLED': os.environ.get('MEI_VERSIONS_ENABLED', 'false') == 'true',
+    'SNAPSHOT_INTERVAL': int(
+        os.environ.get('MEI_VERSIONS_SNAPSHOT_INTERVAL', '20')
+    ),
+    'KEEP': int(os.environ.get('MEI_VERSIONS_KEEP', '100')),
+}
+
+# Compute pool
+# Comparisons and layer merges are run in a pool of this many processes, so
+# that web workers only wait on I/O. Size it to the number of cores available
+# to the server. With 0 processes, work is done in the web worker itself.
+COMPUTE_POOL = {
+    'PROCESSES': int(os.environ.get('COMPUTE_POOL_PROCESSES', '0')),
+    # Seconds a single task may run before it is abandoned. Comparisons with a
+    # deadline may instead run until shortly after their deadline.
+    'TIMEOUT': float(os.environ.get('COMPUTE_POOL_TIMEOUT', '120')),
+}
+
+# Comparison instrumentation
+# Each comparison's phase timings are sent to these sinks. Set
+# COMPARISON_TRACE_TREES=true to also log every intermediate tree at DEBUG
+# level, which is slow for large scores.
+COMPARISON_INSTRUMENTATION = {
+    'SINKS': [
+        'credo.utils.mei.instrumentation.LogSink',
+        'credo.utils.mei.instrumentation.MetricsSink',
+    ],
+}
+if os.environ.get('COMPARISON_TRACE_TREES', 'false') == 'true':
+    COMPARISON_INSTRUMENTATION['SINKS'].append(
+        'credo.utils.mei.instrumentation.TreeTraceSink'
+    )
+
 # Test related settings
 TEST_RUNNER = 'xmlrunner.extra.djangotestrunner.XMLTestRunner'
 TEST_OUTPUT_VERBOSE = True
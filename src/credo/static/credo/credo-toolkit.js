@@ -28,6 +28,7 @@ class CredoToolkit {
 
   resolveModalInstance
   resolveMeasureId // ID of the measure we're resolving
+  changedMeasureIds // IDs of the measures resolved since the last save
   eliminatedIds // IDs to eliminate
 
   nameModalInstance
@@ -88,6 +89,7 @@ class CredoToolkit {
     this.resolutionUrl = resolutionUrl
     this.renderDiv = renderDiv
     this.saveUrl = saveUrl
+    this.changedMeasureIds = new Set()
 
     this.verovioToolkit = new verovio.toolkit()
 
@@ -479,6 +481,7 @@ class CredoToolkit {
 
         // Update measure on meiDocument
         meiMeasure.outerHTML = new XMLSerializer().serializeToString(resolvedMeasure)
+        this.changedMeasureIds.add(this.resolveMeasureId)
 
         // Update the mei string and rerender
         this.mei = new XMLSerializer().serializeToString(this.meiDocument)
@@ -646,16 +649,35 @@ class CredoToolkit {
    * @return {Promise<string>} A promise resolving to the MEI.
    */
   loadMei () {
-    return jsonRequest(this.meiUrl)
+    if (this.meiUrl.endsWith('/raw')) {
+      return textRequest(this.meiUrl)
+    }
+    return this.requestMeiJson()
       .then(json => {
         if (json.content.mei) {
-          return atob(json.content.mei.detail)
+          return decodeDetail(json.content.mei)
         } else if (json.content.diff) {
-          return atob(json.content.diff.detail)
+          return decodeDetail(json.content.diff)
         }
       })
   }
 
+  /**
+   * Requests the JSON envelope containing the MEI. Comparisons queued as
+   * background jobs are submitted, then polled until their result is ready.
+   *
+   * @return {Promise<Object>} A promise resolving to the JSON envelope.
+   */
+  requestMeiJson () {
+    if (this.meiUrl.startsWith('/diff/jobs')) {
+      return comparisonJobRequest(this.meiUrl, this.csrftoken)
+    }
+    if (this.meiUrl.includes('format=bundle')) {
+      return bundleRequest(this.meiUrl)
+    }
+    return jsonRequest(this.meiUrl)
+  }
+
   /**
    * Loads the MEI, and stores it on the object  and the Verovio toolkit.
    *
@@ -737,14 +759,14 @@ class CredoToolkit {
    * Renders the MEI diffs, to a list of inline SVGs.
    */
   async renderDiff () {
-    const meiJson = await jsonRequest(this.meiUrl)
+    const meiJson = await this.requestMeiJson()
     const childDivs = Array.from(document.querySelectorAll(`#${this.renderDiv} > div`))
     childDivs.forEach((div, index) => {
       if (index === 0) {
-        const diff = atob(meiJson.content.diff.detail)
+        const diff = decodeDetail(meiJson.content.diff)
         div.innerHTML = this.verovioToolkit.renderData(diff, {svgViewBox: true, adjustPageHeight: true})
       } else {
-        const source = atob(meiJson.content.sources[index - 1].detail)
+        const source = decodeDetail(meiJson.content.sources[index - 1])
         div.innerHTML = this.verovioToolkit.renderData(source, {svgViewBox: true, adjustPageHeight: true})
       }
     })
@@ -919,7 +941,8 @@ class CredoToolkit {
 
   /**
    * Save revision by making a request to the server, giving the revision ID
-   * that we are saving over.
+   * that we are saving over. Only the measures resolved since the last save
+   * are sent.
    */
   saveRevision () {
     // no saving URL, nothing to do here
@@ -927,6 +950,19 @@ class CredoToolkit {
       return
     }
 
+    const measureIds = Array.from(this.changedMeasureIds)
+    const measures = {}
+    measureIds.forEach(measureId => {
+      const meiMeasure = this.meiDocument.evaluate(
+        `//mei:measure[@xml:id="${measureId}"]`,
+        this.meiDocument,
+        this.namespaceResolver,
+        XPathResult.ANY_TYPE,
+        null
+      ).iterateNext()
+      measures[measureId] = new XMLSerializer().serializeToString(meiMeasure)
+    })
+
     const savingModalInstance = this.savingModalInstance
 
     savingModalInstance.el.innerHTML = `
@@ -946,7 +982,7 @@ class CredoToolkit {
         if (this.readyState === 4) {
           if (this.status === 200) {
             // successfully saved
-            resolve()
+            resolve(JSON.parse(this.responseText))
           } else {
             // an error occured
             reject()
@@ -954,14 +990,27 @@ class CredoToolkit {
         }
       }
 
-      xhttp.open('POST', this.saveUrl, true)
+      xhttp.open('PATCH', this.saveUrl, true)
       xhttp.setRequestHeader('X-CSRFToken', this.csrftoken)
       xhttp.setRequestHeader('Content-Type', 'application/json')
       xhttp.send(JSON.stringify({
-        mei: this.mei,
+        measures: measures,
         comments: this.comments
       }))
     })
+      .then(json => {
+        measureIds.forEach(measureId => this.changedMeasureIds.delete(measureId))
+
+        // Resolving the last measure renumbers the IDs of the revision, so
+        // reload it once it has been normalised
+        if (json.renormalised) {
+          return waitUntilReady(json.status, json.status_url).then(() => {
+            this.mei = null
+            this.comments = null
+            this.render()
+          })
+        }
+      })
       .then(() => {
         savingModalInstance.el.innerHTML = `
           <div class="modal-content">
@@ -1035,6 +1084,180 @@ const jsonRequest = url =>
     xhttp.send()
   })
 
+/**
+ * Decodes an MEI in a JSON envelope.
+ *
+ * @param {Object} part The MEI, with its detail and encoding.
+ * @return {string} The MEI.
+ */
+const decodeDetail = part =>
+  part.encoding === 'base64' ? atob(part.detail) : part.detail
+
+/**
+ * Decodes a part of a diff bundle.
+ *
+ * @param {Uint8Array} payload The payload of the part.
+ * @param {string} encoding How the payload is compressed.
+ * @return {Promise<string>} The text of the part.
+ */
+const decodeBundlePart = (payload, encoding) => {
+  if (encoding !== 'gzip') {
+    return Promise.resolve(new TextDecoder().decode(payload))
+  }
+  const stream = new Blob([payload]).stream()
+    .pipeThrough(new DecompressionStream('gzip'))
+  return new Response(stream).text()
+}
+
+/**
+ * Requests a diff in the bundle format (see credo/diff_bundle.py), and
+ * resolves to the same content as the JSON envelope, or rejects if the
+ * request did not succeed. Sources which are referred to rather than sent
+ * are requested from their URLs.
+ *
+ * @param {string} url The URL to request.
+ * @return {Promise<Object>} The content of the bundle.
+ */
+const bundleRequest = url =>
+  fetch(url, { credentials: 'same-origin' })
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(`Could not load ${url}: ${response.status}`)
+      }
+      return response.arrayBuffer()
+    })
+    .then(buffer => {
+      const view = new DataView(buffer)
+      let offset = 4
+      const readBlock = () => {
+        const length = view.getUint32(offset)
+        const block = new Uint8Array(buffer, offset + 4, length)
+        offset += 4 + length
+        return block
+      }
+
+      const header = JSON.parse(new TextDecoder().decode(readBlock()))
+      // Blocks are read in order, before any part is decoded
+      const parts = header.parts.map(part =>
+        part.url ? textRequest(part.url) : decodeBundlePart(readBlock(), part.encoding)
+      )
+      return Promise.all(parts).then(texts => {
+        const [diff, ...sources] = texts.map(detail => ({ detail, encoding: 'text' }))
+        return {
+          content: {
+            diff,
+            sources,
+            tier: header.tier,
+            coarse: header.coarse
+          }
+        }
+      })
+    })
+
+/**
+ * Makes a GET request, and resolves to the text of the response, or rejects
+ * if the request did not succeed. The browser revalidates cached responses
+ * with their ETag.
+ *
+ * @param {string} url The URL to request.
+ * @return {Promise<string>} The text of the response.
+ */
+const textRequest = url =>
+  new Promise((resolve, reject) => {
+    const xhttp = new XMLHttpRequest()
+    xhttp.onreadystatechange = function () {
+      if (this.readyState === 4) {
+        if (this.status === 200) {
+          resolve(this.responseText)
+        } else {
+          reject(new Error(`Could not load ${url}: ${this.status}`))
+        }
+      }
+    }
+
+    xhttp.open('GET', url, true)
+    xhttp.send()
+  })
+
+/**
+ * Polls the status of an MEI until it has been normalised, rejecting if it
+ * could not be.
+ *
+ * @param {string} status The status of the MEI when it was saved.
+ * @param {string} url The URL of the MEI's status.
+ * @param {number} interval Milliseconds to wait between polls.
+ * @return {Promise<void>} A promise to resolve once the MEI is ready.
+ */
+const waitUntilReady = (status, url, interval = 1000) => {
+  if (status === 'ready') {
+    return Promise.resolve()
+  }
+  if (status === 'failed') {
+    return Promise.reject(new Error('Could not normalise MEI'))
+  }
+  return new Promise(resolve => setTimeout(resolve, interval))
+    .then(() => fetch(url, { credentials: 'same-origin' }))
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(`Could not load ${url}: ${response.status}`)
+      }
+      return response.json()
+    })
+    .then(json => waitUntilReady(json.content.status, url, interval))
+}
+
+/**
+ * Submits a comparison job, polls its status until it has finished, and
+ * resolves to the comparison result. If the page is closed before then, it
+ * stops waiting on the job, which is cancelled to free its worker once no
+ * other page is waiting on it.
+ *
+ * @param {string} url The URL to submit the job to.
+ * @param {string} csrftoken The CSRF token to submit the job with.
+ * @param {number} interval Milliseconds to wait between polls.
+ * @return {Promise<Object>} The comparison result.
+ */
+const comparisonJobRequest = (url, csrftoken, interval = 1000) =>
+  new Promise((resolve, reject) => {
+    const xhttp = new XMLHttpRequest()
+    xhttp.onreadystatechange = function () {
+      if (this.readyState === 4) {
+        if (this.status === 202) {
+          resolve(JSON.parse(this.responseText).content.job)
+        } else {
+          reject(new Error('Could not submit comparison'))
+        }
+      }
+    }
+
+    xhttp.open('POST', url, true)
+    xhttp.setRequestHeader('X-CSRFToken', csrftoken)
+    xhttp.send()
+  })
+    .then(job => {
+      const cancel = () => fetch(job.cancel_url, {
+        method: 'POST',
+        headers: { 'X-CSRFToken': csrftoken },
+        keepalive: true
+      })
+      window.addEventListener('pagehide', cancel)
+
+      const poll = () => jsonRequest(job.status_url)
+        .then(json => {
+          const status = json.content.job.status
+          if (status === 'done') {
+            window.removeEventListener('pagehide', cancel)
+            return jsonRequest(job.result_url)
+          } else if (status === 'failed' || status === 'cancelled') {
+            window.removeEventListener('pagehide', cancel)
+            throw new Error(`Comparison ${status}`)
+          }
+          return new Promise(resolve => setTimeout(resolve, interval))
+            .then(poll)
+        })
+      return poll()
+    })
+
 /**
  * Gets the value of a cookie with given name.
  *
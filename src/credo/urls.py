@@ -48,7 +48,17 @@ urlpatterns = [
     path('revisions/<revision_id>/download', views.download_revision),
     path('compare', views.compare),
     path('mei/<mei_id>', views.mei),
+    path('mei/<mei_id>/raw', views.mei_raw),
+    path('mei/<mei_id>/status', views.mei_status),
+    path('mei/<mei_id>/versions', views.mei_versions),
+    path('mei/<mei_id>/versions/<number>', views.mei_version),
     path('diff', views.diff),
+    path('diff/cache', views.comparison_cache_stats),
+    path('diff/metrics', views.comparison_metrics),
+    path('diff/jobs', views.submit_comparison_job),
+    path('diff/jobs/<job_id>', views.comparison_job_status),
+    path('diff/jobs/<job_id>/result', views.comparison_job_result),
+    path('diff/jobs/<job_id>/cancel', views.cancel_comparison_job),
     path('signup', views.signup, name='signup'),
     path('revise', views.make_revision),
     path('merge', views.merge_measure_layers_json),
@@ -0,0 +1,265 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import typing as t
+
+from django.conf import settings
+
+# A cached comparison result is the serialized diff, A and B trees
+CachedResult = t.Tuple[bytes, bytes, bytes]
+
+
+def content_digest(data: bytes) -> str:
+    """
+    Return the digest used to identify the contents of an MEI file.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class ComparisonCache:
+    """
+    Two tier cache of comparison results, keyed by the content digests of the
+    compared MEI files and the options of the engine that compared them.
+
+    The memory tier is a per-process LRU. The disk tier is shared between all
+    processes using the same directory, and evicts the least recently used
+    entries once it grows beyond its size limit.
+    """
+
+    DISK_SUFFIX = '.cmp'
+    _HEADER = struct.Struct('>III')
+
+    def __init__(
+            self,
+            memory_entries: int = 16,
+            disk_dir: t.Optional[str] = None,
+            disk_max_bytes: int = 256 * 1024 * 1024):
+
+        self.logger = logging.getLogger(__name__)
+        self.memory_entries = memory_entries
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'evictions': 0,
+        }
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(digest_a: str, digest_b: str, engine_key: str) -> str:
+        """
+        Build a cache key for comparing MEI contents a and b with an engine.
+
+        The content digests are kept verbatim in the key, so that every entry
+        involving a digest can be found again when invalidating it.
+        """
+        engine_digest = hashlib.sha256(engine_key.encode()).hexdigest()[:16]
+        return f'{digest_a}-{digest_b}-{engine_digest}'
+
+    def get(self, key: str) -> t.Optional[CachedResult]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return self._memory[key]
+
+        result = self._disk_get(key)
+
+        with self._lock:
+            if result is None:
+                self._counters['misses'] += 1
+            else:
+                self._counters['disk_hits'] += 1
+                self._memory_put(key, result)
+
+        return result
+
+    def put(self, key: str, result: CachedResult) -> None:
+        with self._lock:
+            self._memory_put(key, result)
+        self._disk_put(key, result)
+
+    def invalidate(self, digest: str) -> None:
+        """
+        Remove every entry that was computed from the given content digest.
+        """
+        if not digest:
+            return
+
+        with self._lock:
+            for key in [k for k in self._memory if digest in k.split('-')]:
+                del self._memory[key]
+                self._counters['invalidations'] += 1
+
+        if self.disk_dir is None:
+            return
+
+        for entry in os.scandir(self.disk_dir):
+            name = entry.name[:-len(ComparisonCache.DISK_SUFFIX)]
+            if entry.name.endswith(ComparisonCache.DISK_SUFFIX) and \
+                    digest in name.split('-'):
+                self._remove_file(entry.path)
+                with self._lock:
+                    self._counters['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+
+        if self.disk_dir is None:
+            return
+
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(ComparisonCache.DISK_SUFFIX):
+                self._remove_file(entry.path)
+
+    def stats(self) -> t.Dict[str, int]:
+        """
+        Return the hit/miss counters of this process, and the current size of
+        each tier.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._memory)
+
+        stats['disk_entries'] = 0
+        stats['disk_bytes'] = 0
+        for _, size, _ in self._disk_entries():
+            stats['disk_entries'] += 1
+            stats['disk_bytes'] += size
+
+        return stats
+
+    def _memory_put(self, key: str, result: CachedResult) -> None:
+        # Must be called with self._lock held
+        if self.memory_entries <= 0:
+            return
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ComparisonCache.DISK_SUFFIX)
+
+    def _disk_get(self, key: str) -> t.Optional[CachedResult]:
+        if self.disk_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Touch the entry, so eviction is least recently used
+            os.utime(path)
+        except OSError:
+            return None
+
+        header_size = ComparisonCache._HEADER.size
+        try:
+            lengths = ComparisonCache._HEADER.unpack_from(data)
+        except struct.error:
+            self._remove_file(path)
+            return None
+
+        if header_size + sum(lengths) != len(data):
+            self.logger.warning(f'Removing corrupt cache entry {path}')
+            self._remove_file(path)
+            return None
+
+        parts = []
+        offset = header_size
+        for length in lengths:
+            parts.append(data[offset:offset + length])
+            offset += length
+
+        return tuple(parts)
+
+    def _disk_put(self, key: str, result: CachedResult) -> None:
+        if self.disk_dir is None:
+            return
+
+        header = ComparisonCache._HEADER.pack(*[len(part) for part in result])
+
+        # Write to a temporary file first, so that other processes never see
+        # a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                for part in result:
+                    f.write(part)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            self.logger.warning(f'Could not write cache entry {key}')
+            self._remove_file(tmp_path)
+            return
+
+        self._evict_disk()
+
+    def _disk_entries(self) -> t.List[t.Tuple[float, int, str]]:
+        if self.disk_dir is None:
+            return []
+
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if not entry.name.endswith(ComparisonCache.DISK_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self) -> None:
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(path)
+            total -= size
+            with self._lock:
+                self._counters['evictions'] += 1
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_comparison_cache = None
+_comparison_cache_lock = threading.Lock()
+
+
+def get_comparison_cache() -> ComparisonCache:
+    """
+    Return the comparison cache of this process, configured from the
+    COMPARISON_CACHE setting.
+    """
+    global _comparison_cache
+    with _comparison_cache_lock:
+        if _comparison_cache is None:
+            config = settings.COMPARISON_CACHE
+            _comparison_cache = ComparisonCache(
+                memory_entries=config['MEMORY_ENTRIES'],
+                disk_dir=config['DISK_DIR'],
+                disk_max_bytes=config['DISK_MAX_BYTES']
+            )
+        return _comparison_cache
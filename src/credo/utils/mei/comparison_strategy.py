@@ -3,24 +3,124 @@ import lxml.etree as et
 from credo.models import MEI
 import typing as t
 
+from credo.compute_pool import get_compute_pool
+from .comparison_cache import get_comparison_cache
+from .deadline import Deadline
+from .instrumentation import ComparisonTrace, count_nodes
+
 
 class ComparisonStrategy(ABC):
 
+    # Whether compare_trees accepts MEI in the intermediate representation,
+    # so the intermediate files precomputed by MEI.update_intermediate can be
+    # compared in place of the stored files
+    uses_intermediate = False
+
     def __init__(self):
-        return
+        # Timings of the current comparison, see instrumentation.py
+        self.trace = ComparisonTrace()
+        # Time by which the comparison should finish, see deadline.py
+        self.deadline = Deadline()
+
+    @property
+    def coarse(self) -> bool:
+        """
+        Whether the comparison in the current trace ran out of time, and fell
+        back to a coarser diff. Coarse diffs are not cached.
+        """
+        return False
+
+    def cache_key(self) -> str:
+        """
+        Return a string identifying this engine and every option that affects
+        its output. Comparisons are cached per content digest and cache key.
+        """
+        return type(self).__qualname__
 
     def compare_meis(self, a: MEI, b: MEI) \
             -> t.Tuple[et.ElementTree, et.ElementTree, et.ElementTree]:
 
+        with self.trace:
+            return self._compare_meis(a, b)
+
+    def _compare_meis(self, a: MEI, b: MEI) \
+            -> t.Tuple[et.ElementTree, et.ElementTree, et.ElementTree]:
+
+        cache = get_comparison_cache()
+        with self.trace.phase('cache_lookup'):
+            key = cache.make_key(
+                a.get_content_hash(),
+                b.get_content_hash(),
+                self.cache_key()
+            )
+            cached = cache.get(key)
+
         parser = et.XMLParser(remove_blank_text=True)
 
-        with a.data.open() as f:
-            tree_a = et.parse(f, parser)
+        if cached is not None:
+            with self.trace.phase('parse'):
+                return tuple(
+                    et.ElementTree(et.fromstring(blob, parser))
+                    for blob in cached
+                )
+
+        file_a = self._get_source_file(a)
+        file_b = self._get_source_file(b)
+
+        pool = get_compute_pool()
+        if pool.processes == 0:
+            with self.trace.phase('parse') as phase:
+                with file_a.open() as f:
+                    tree_a = et.parse(f, parser)
+
+                with file_b.open() as f:
+                    tree_b = et.parse(f, parser)
+                phase.nodes += count_nodes(tree_a, tree_b)
+
+            result = pool.run(
+                self.compare_trees,
+                tree_a,
+                tree_b,
+                deadline=self.deadline
+            )
+
+            if not self.coarse:
+                with self.trace.phase('serialize'):
+                    cache.put(key, tuple(
+                        et.tostring(tree, encoding='utf-8') for tree in result
+                    ))
+
+            return result
+
+        # Send the files to the pool as they are stored, and parse the
+        # serialized results that come back.
+        with self.trace.phase('read'):
+            with file_a.open('rb') as f:
+                data_a = f.read()
+
+            with file_b.open('rb') as f:
+                data_b = f.read()
+
+        with self.trace.phase('compute_pool'):
+            blobs, phases = pool.compare(self, data_a, data_b)
+        self.trace.extend(phases)
+        if not self.coarse:
+            cache.put(key, blobs)
 
-        with b.data.open() as f:
-            tree_b = et.parse(f, parser)
+        with self.trace.phase('parse'):
+            return tuple(
+                et.ElementTree(et.fromstring(blob, parser))
+                for blob in blobs
+            )
 
-        return self.compare_trees(tree_a, tree_b)
+    def _get_source_file(self, mei: MEI):
+        """
+        Return the file of mei to compare, which is its precomputed
+        intermediate representation if it is current and can be used.
+        """
+        if self.uses_intermediate and mei.has_intermediate():
+            return mei.intermediate
+        return mei.data
 
     @abstractmethod
     def compare_trees(self, a: et.ElementTree, b: et.ElementTree) \
@@ -0,0 +1,69 @@
+import time
+import typing as t
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised at a cancellation point of a comparison whose deadline has passed.
+    """
+    pass
+
+
+class ComparisonCancelled(DeadlineExceeded):
+    """
+    Raised at a cancellation point of a comparison which has been cancelled.
+    """
+    pass
+
+
+class Deadline:
+    """
+    A time by which a comparison should finish, and a flag to cancel it.
+
+    Comparisons call check at cancellation points in their slow loops, so
+    they stop soon after the deadline passes or they are cancelled, rather
+    than running to completion. check is called in tight loops, so only
+    reads the clock every CHECK_INTERVAL calls.
+
+    The deadline is a wall clock time, so it still holds when the engine is
+    pickled and sent to a compute pool process. Cancelling only affects the
+    process it is called in, which ComputePool watches for while it waits.
+    """
+
+    CHECK_INTERVAL = 64
+
+    def __init__(self, seconds: t.Optional[float] = None):
+        self.expires_at = None if seconds is None else time.time() + seconds
+        self.cancelled = False
+        self._calls = 0
+
+    def cancel(self):
+        """
+        Cancel the comparison, from any thread.
+        """
+        self.cancelled = True
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def remaining(self) -> t.Optional[float]:
+        """
+        Return the seconds left before the deadline, or None if there is no
+        deadline.
+        """
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.time(), 0.0)
+
+    def check(self):
+        """
+        Raise ComparisonCancelled if cancelled, or DeadlineExceeded if the
+        deadline has passed.
+        """
+        if self.cancelled:
+            raise ComparisonCancelled()
+
+        self._calls += 1
+        if self._calls % Deadline.CHECK_INTERVAL == 0 and self.expired:
+            raise DeadlineExceeded()
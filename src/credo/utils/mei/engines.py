@@ -0,0 +1,95 @@
+import typing as t
+
+from django.conf import settings
+
+from .comparison_strategy import ComparisonStrategy
+from .measure_comparison import MeasureAlignedComparison
+from .sequence_comparison import SequenceAlignmentComparison
+from .tree_comparison import TreeComparison
+
+# Comparison engines selectable by name, e.g. with the engine parameter of
+# /diff
+ENGINES: t.Dict[str, t.Type[ComparisonStrategy]] = {
+    'tree': TreeComparison,
+    'measure': MeasureAlignedComparison,
+    'sequence': SequenceAlignmentComparison,
+}
+
+
+# Quality tiers, from the fastest to the most accurate, as the engine each
+# uses and the xmldiff options it is given
+TIERS: t.Dict[str, t.Tuple[str, dict]] = {
+    'fast': ('sequence', {}),
+    'balanced': ('measure', {'ratio_mode': 'faster', 'fast_match': True}),
+    'accurate': ('tree', {}),
+}
+
+# Chooses the most accurate tier expected to finish within the latency budget
+AUTO_TIER = 'auto'
+
+# Each tier is expected to take COEFFICIENT * nodes ** EXPONENT seconds to
+# compare scores with the given number of nodes between them. Fitted by
+# python -m benchmarks.quality_tiers.
+COST_MODELS: t.Dict[str, t.Tuple[float, float]] = {
+    'fast': (1.6e-5, 1.07),
+    'balanced': (4.6e-5, 1.01),
+    'accurate': (4.8e-7, 1.89),
+}
+
+
+def get_engine(name: t.Optional[str] = None) -> ComparisonStrategy:
+    """
+    Return a new comparison engine with the given name, or the engine set by
+    settings.COMPARISON_ENGINE if no name is given. Raises ValueError if
+    there is no engine with the name.
+    """
+    if name is None:
+        name = settings.COMPARISON_ENGINE
+
+    try:
+        engine_class = ENGINES[name]
+    except KeyError:
+        raise ValueError(f'Unknown comparison engine {name}')
+
+    return engine_class()
+
+
+def get_tier_engine(tier: str) -> ComparisonStrategy:
+    """
+    Return a new comparison engine for a quality tier. Raises ValueError if
+    there is no such tier.
+    """
+    try:
+        name, diff_options = TIERS[tier]
+    except KeyError:
+        raise ValueError(f'Unknown quality tier {tier}')
+
+    engine = get_engine(name)
+    if diff_options:
+        engine.diff_options.update(diff_options)
+    return engine
+
+
+def estimate_cost(tier: str, nodes: int) -> float:
+    """
+    Return the expected seconds taken by a tier to compare scores with the
+    given number of nodes between them.
+    """
+    coefficient, exponent = COST_MODELS[tier]
+    return coefficient * nodes ** exponent
+
+
+def choose_tier(nodes: int, budget: t.Optional[float] = None) -> str:
+    """
+    Return the most accurate tier expected to compare scores with the given
+    number of nodes between them within budget seconds, or the fastest tier
+    if none are. The budget defaults to settings.COMPARISON_LATENCY_BUDGET.
+    """
+    if budget is None:
+        budget = settings.COMPARISON_LATENCY_BUDGET
+
+    tiers = list(TIERS)
+    for tier in reversed(tiers):
+        if estimate_cost(tier, nodes) <= budget:
+            return tier
+    return tiers[0]
@@ -0,0 +1,291 @@
+import json
+import logging
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import lxml.etree as et
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class PhaseStats:
+    """
+    Totals for every run of one phase of a comparison.
+    """
+    __slots__ = ('name', 'calls', 'wall', 'cpu', 'nodes', 'actions')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.nodes = 0
+        self.actions = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'phase': self.name,
+            'calls': self.calls,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'nodes': self.nodes,
+            'actions': self.actions
+        }
+
+
+class ComparisonTrace:
+    """
+    Records the wall time, CPU time, node count and action count of each
+    phase of a comparison, and publishes them to the configured sinks.
+
+    The trace is published when the outermost `with trace:` block exits, so
+    callers can add their own phases (e.g. encoding the response) to those
+    recorded by the comparison strategy.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._depth = 0
+
+    @property
+    def tracing(self) -> bool:
+        """
+        Whether a sink wants copies of the intermediate trees. Anything
+        expensive done only for tracing should be skipped otherwise.
+        """
+        return any(sink.traces_trees for sink in get_sinks())
+
+    @contextmanager
+    def phase(self, name: str) -> t.Iterator[PhaseStats]:
+        """
+        Time a phase. The yielded stats may be used to add node and action
+        counts. Phases with the same name are summed.
+        """
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.calls += 1
+            stats.wall += time.perf_counter() - wall
+            stats.cpu += time.process_time() - cpu
+
+    def stream_phase(self, name: str, chunks: t.Iterable) -> t.Iterator:
+        """
+        Time a phase which is run as chunks are read, e.g. encoding a
+        streamed response, without the time spent between reads. The trace
+        is held open until the last chunk is read, and published if this was
+        the outermost `with trace:` block; it is dropped if no chunk is ever
+        read.
+        """
+        self.__enter__()
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+        return self._stream_phase(stats, iter(chunks))
+
+    def _stream_phase(self, stats: PhaseStats, chunks: t.Iterator):
+        stats.calls += 1
+        try:
+            while True:
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    stats.wall += time.perf_counter() - wall
+                    stats.cpu += time.process_time() - cpu
+                yield chunk
+        finally:
+            self.__exit__(None, None, None)
+
+    def extend(self, phases: t.List[dict]):
+        """
+        Add phases recorded elsewhere, e.g. in a compute pool process.
+        """
+        for phase in phases:
+            stats = self.phases.get(phase['phase'])
+            if stats is None:
+                stats = self.phases[phase['phase']] = PhaseStats(
+                    phase['phase']
+                )
+            for field in ['calls', 'wall', 'cpu', 'nodes', 'actions']:
+                setattr(stats, field, getattr(stats, field) + phase[field])
+
+    def trace_trees(self, trees: t.List[t.Tuple[str, et.ElementTree]]):
+        for sink in get_sinks():
+            if sink.traces_trees:
+                for title, tree in trees:
+                    sink.trace_tree(title, tree)
+
+    def as_list(self) -> t.List[dict]:
+        return [stats.as_dict() for stats in self.phases.values()]
+
+    def publish(self):
+        """
+        Send the recorded phases to every sink, and start a new trace.
+        """
+        phases = self.as_list()
+        self.phases = OrderedDict()
+        if len(phases) == 0:
+            return
+
+        for sink in get_sinks():
+            sink.publish(phases)
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            self.publish()
+
+
+def count_nodes(*trees) -> int:
+    return sum(sum(1 for _ in tree.iter()) for tree in trees)
+
+
+def count_serialized_nodes(data: bytes) -> int:
+    """
+    Estimate the number of nodes count_nodes would find in serialized XML,
+    without parsing it, by counting its start tags and comments.
+    """
+    return data.count(b'<') - data.count(b'</') - data.count(b'<?') - \
+        data.count(b'<!DOCTYPE')
+
+
+class InstrumentationSink:
+    """
+    Base class for the sinks listed in COMPARISON_INSTRUMENTATION['SINKS'].
+    """
+
+    # Whether trace_tree should be called with the intermediate trees
+    traces_trees = False
+
+    def publish(self, phases: t.List[dict]):
+        pass
+
+    def trace_tree(self, title: str, tree: et.ElementTree):
+        pass
+
+
+class LogSink(InstrumentationSink):
+    """
+    Logs each comparison's phases as a JSON object at INFO level.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    def publish(self, phases: t.List[dict]):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                'Comparison phases: %s',
+                json.dumps({'phases': phases}),
+                extra={'phases': phases}
+            )
+
+
+class MetricsSink(InstrumentationSink):
+    """
+    Adds each comparison's phases to the process' MetricsRegistry.
+    """
+
+    def publish(self, phases: t.List[dict]):
+        get_metrics_registry().record(phases)
+
+
+class TreeTraceSink(InstrumentationSink):
+    """
+    Logs every intermediate tree of a comparison at DEBUG level. This is very
+    slow for large scores, so should only be enabled to debug the engine.
+    """
+    traces_trees = True
+
+    def __init__(self):
+        self.logger = logging.getLogger(f'{__name__}.trees')
+
+    def trace_tree(self, title: str, tree: et.ElementTree):
+        self.logger.debug('\n{}:\n{}\n'.format(
+            title,
+            et.tostring(tree, pretty_print=True).decode()
+        ))
+
+
+class MetricsRegistry:
+    """
+    Running totals of comparison phases across the lifetime of a process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.comparisons = 0
+        self.phases = OrderedDict()
+
+    def record(self, phases: t.List[dict]):
+        with self._lock:
+            self.comparisons += 1
+            for phase in phases:
+                totals = self.phases.get(phase['phase'])
+                if totals is None:
+                    totals = self.phases[phase['phase']] = {
+                        'calls': 0,
+                        'wall': 0.0,
+                        'wall_max': 0.0,
+                        'cpu': 0.0,
+                        'nodes': 0,
+                        'actions': 0
+                    }
+                for field in ['calls', 'wall', 'cpu', 'nodes', 'actions']:
+                    totals[field] += phase[field]
+                totals['wall_max'] = max(totals['wall_max'], phase['wall'])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'comparisons': self.comparisons,
+                'phases': {
+                    name: dict(totals)
+                    for name, totals in self.phases.items()
+                }
+            }
+
+    def clear(self):
+        with self._lock:
+            self.comparisons = 0
+            self.phases = OrderedDict()
+
+
+_sinks = None
+_metrics_registry = None
+
+
+def get_sinks() -> t.List[InstrumentationSink]:
+    """
+    Return the sinks configured by settings.COMPARISON_INSTRUMENTATION.
+    """
+    global _sinks
+    if _sinks is None:
+        _sinks = [
+            import_string(path)()
+            for path in settings.COMPARISON_INSTRUMENTATION['SINKS']
+        ]
+    return _sinks
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    global _metrics_registry
+    if _metrics_registry is None:
+        _metrics_registry = MetricsRegistry()
+    return _metrics_registry
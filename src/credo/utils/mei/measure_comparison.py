@@ -0,0 +1,82 @@
+from copy import deepcopy
+import lxml.etree as et
+
+from .tree_comparison import TreeComparison
+from utils.mei import queries
+
+
+class MeasureAlignedComparison(TreeComparison):
+    """
+    Comparison strategy which aligns the measures of both trees, and diffs
+    each aligned pair of measures independently. As the cost of xmldiff grows
+    super-linearly with the size of its input, this keeps the cost of a
+    comparison close to linear in the length of the score.
+
+    Only measures are compared. Any differences outside of measures, such as
+    in the initial scoreDef, are not shown in the diff.
+    """
+
+    def _get_diff_tree(self, a: et.ElementTree, b: et.ElementTree) \
+            -> et.ElementTree:
+
+        diff = deepcopy(a)
+        diff_bars = queries.MEASURES(diff)
+        b_bars = queries.MEASURES(b)
+
+        id_idx = 0
+        bar_idx = 0
+        previous = None
+        for a_idx, b_idx in self._align_measures(diff_bars, b_bars):
+            if a_idx is None:
+                # Measure only exists in b, so compare it against an empty
+                # measure with the same staves and layers.
+                a_bar = self._hollow_measure(b_bars[b_idx])
+            else:
+                a_bar = diff_bars[a_idx]
+
+            if b_idx is None:
+                b_bar = self._hollow_measure(a_bar)
+            else:
+                b_bar = b_bars[b_idx]
+
+            a_modded, b_modded = self._get_modded_trees(
+                et.ElementTree(deepcopy(a_bar)),
+                et.ElementTree(deepcopy(b_bar))
+            )
+
+            merged = a_modded.getroot()
+            with self.trace.phase('merge'):
+                id_idx = self._merge_measure(
+                    merged,
+                    b_modded.getroot(),
+                    bar_idx,
+                    id_idx
+                )
+
+            if a_idx is None:
+                # Insert after the previously merged measure, or before the
+                # first measure of a if there is none.
+                if previous is not None:
+                    previous.addnext(merged)
+                elif len(diff_bars) > 0:
+                    diff_bars[0].addprevious(merged)
+                else:
+                    continue
+            else:
+                a_bar.getparent().replace(a_bar, merged)
+
+            previous = merged
+            bar_idx += 1
+
+        self._log_trees([
+            ('A Original', a),
+            ('B Original', b),
+            ('Difference', diff)
+        ])
+
+        # TEMPORARY: Strip all trill tags from the diff
+        # TODO: Resolve trill IDs in _merge_measure
+        for elem in queries.TRILLS(diff):
+            elem.getparent().remove(elem)
+
+        return diff
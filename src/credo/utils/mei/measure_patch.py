@@ -0,0 +1,132 @@
+import re
+import typing as t
+
+import lxml.etree as et
+
+from utils.mei import queries
+from utils.mei.xml_namespaces import MEI_NS
+
+# Stored files declare their namespaces once, on the root element
+NS_DECLARATION = f' xmlns="{MEI_NS["mei"]}"'.encode()
+NS_DECLARATIONS = re.compile(rb'\sxmlns(?::[\w.-]+)?="[^"]*"')
+ROOT_START = re.compile(rb'<[^?!/][^>]*>')
+MEASURE_START = rb'<measure\b[^>]*?\sxml:id="%s"[^>]*>'
+MEASURE_END = b'</measure>'
+
+
+def get_namespaces(data: bytes) -> bytes:
+    """
+    Return the namespace declarations of the root element of a stored MEI
+    file, as they are written in its start tag.
+    """
+    root = ROOT_START.search(data)
+    if root is None:
+        return NS_DECLARATION
+    return b''.join(NS_DECLARATIONS.findall(root.group()))
+
+
+def parse_measure(
+        measure: t.Union[str, bytes],
+        namespaces: bytes = NS_DECLARATION) -> et.Element:
+    """
+    Parse a serialized measure in the scope of the given namespace
+    declarations, so it may omit them. Raises ValueError if it is not a
+    single measure.
+    """
+    if isinstance(measure, str):
+        measure = measure.encode()
+
+    wrapper = b'<mei' + namespaces + b'>' + measure + b'</mei>'
+    try:
+        elements = list(et.fromstring(wrapper))
+    except et.XMLSyntaxError as e:
+        raise ValueError(f'Invalid measure: {e}')
+
+    if len(elements) != 1 or elements[0].tag != queries.MEASURE:
+        raise ValueError('Expected a single measure')
+    return elements[0]
+
+
+def serialize_measure(
+        measure: et.Element,
+        namespaces: bytes = NS_DECLARATION) -> bytes:
+    """
+    Serialize a measure to be written in the scope of the given namespace
+    declarations, leaving them out of its start tag.
+    """
+    data = et.tostring(
+        measure,
+        encoding='utf-8',
+        xml_declaration=False,
+        with_tail=False
+    )
+    # '>' is always escaped in attribute values
+    end = data.index(b'>')
+    start_tag = data[:end]
+    for declaration in NS_DECLARATIONS.findall(namespaces):
+        start_tag = start_tag.replace(declaration, b'', 1)
+    return start_tag + data[end:]
+
+
+def find_measure(data: bytes, measure_id: str) -> t.Tuple[int, int]:
+    """
+    Return the start and end offsets of the measure with the given ID in a
+    stored MEI file, without parsing the file. Raises ValueError if there is
+    no such measure.
+
+    Measures do not nest, and '>' is always escaped in attribute values, so
+    the measure ends at the first closing tag after its start tag.
+    """
+    pattern = MEASURE_START % re.escape(measure_id.encode())
+    start_tag = re.search(pattern, data)
+    if start_tag is None:
+        raise ValueError(f'No measure with ID {measure_id}')
+
+    if start_tag.group().endswith(b'/>'):
+        return start_tag.start(), start_tag.end()
+
+    end = data.find(MEASURE_END, start_tag.end())
+    if end == -1:
+        raise ValueError(f'Unclosed measure {measure_id}')
+    return start_tag.start(), end + len(MEASURE_END)
+
+
+def patch_measures(
+        data: bytes,
+        measures: t.Dict[str, t.Union[str, bytes]],
+        attribs: t.Sequence[str] = ()) \
+        -> t.Tuple[bytes, t.List[et.Element], t.List[et.Element]]:
+    """
+    Replace the measures of a stored MEI file with the given IDs by the
+    serialized measures, stripping attribs from them as normalisation would.
+    Returns the patched file, and the new and old measures. Only the patched
+    measures are parsed. Raises ValueError if a measure is invalid or is not
+    in the file.
+    """
+    namespaces = get_namespaces(data)
+
+    spans = []
+    for measure_id, measure in measures.items():
+        start, end = find_measure(data, measure_id)
+        new_measure = parse_measure(measure, namespaces)
+        if attribs:
+            et.strip_attributes(new_measure, *attribs)
+        spans.append((start, end, new_measure))
+    spans.sort(key=lambda span: span[0])
+
+    parts = []
+    new_measures = []
+    old_measures = []
+    position = 0
+    for start, end, new_measure in spans:
+        if start < position:
+            raise ValueError('Measures overlap')
+        old_measures.append(parse_measure(data[start:end], namespaces))
+        new_measures.append(new_measure)
+
+        parts.append(data[position:start])
+        parts.append(serialize_measure(new_measure, namespaces))
+        position = end
+    parts.append(data[position:])
+
+    return b''.join(parts), new_measures, old_measures
@@ -1,27 +1,25 @@
 import lxml.etree as et
-from typing import List
+from typing import List, Optional
+from fractions import Fraction
 from math import inf
 from copy import deepcopy
 import logging
 
+from utils.mei import queries
 from utils.mei.xml_namespaces import MEI_NS
 from utils.mei.id_formatters import get_formatted_xml_id
 
 
 def merge_measure_layers(measure: et.ElementTree):
-    id_attrib = et.QName(MEI_NS['xml'], 'id')
-
     # Loop through all staves, merging layers for each
-    staff_qry = et.XPath('child::mei:staff', namespaces=MEI_NS)
-    staves = staff_qry(measure)
+    staves = queries.CHILD_STAFFS(measure)
     for staff in staves:
-        layer_qry = et.XPath('child::mei:layer', namespaces=MEI_NS)
-        layers = layer_qry(staff)
+        layers = queries.CHILD_LAYERS(staff)
 
         # Split layers into corresponding pairs/groups and try to merge each
         layer_groups = {}
         for layer in layers:
-            xml_id = layer.get(id_attrib.text)
+            xml_id = layer.get(queries.XML_ID)
             num_id = ''.join([s for s in xml_id if s.isdigit()])
             if num_id in layer_groups.keys():
                 layer_groups[num_id].append(layer)
@@ -98,8 +96,7 @@ def _merge_layers(num_id, layers):
         visible = visible_tag is None or visible_tag == 'true'
 
         # 'space' events are regarded as invisible
-        if et.QName(duration_info.event).localname == 'space' \
-                and et.QName(duration_info.event).namespace == MEI_NS['mei']:
+        if duration_info.event.tag == queries.SPACE:
             visible = False
 
         if visible:
@@ -115,14 +112,14 @@ def _merge_layers(num_id, layers):
         # All events mergeable, sort by start times and add copies to
         # a new layer and return.
         mergeable_events = sorted(mergeable_events, key=lambda e: e.start)
-        new_layer = et.Element(et.QName(MEI_NS['mei'], 'layer'))
+        new_layer = et.Element(queries.LAYER)
 
         for event_info in mergeable_events:
             new_layer.append(deepcopy(event_info.event))
 
         # Set id of new layer.
         new_layer.set(
-            et.QName(MEI_NS['xml'], 'id').text,
+            queries.XML_ID,
             get_formatted_xml_id(num_id, 'r')
         )
         return new_layer
@@ -130,6 +127,97 @@ def _merge_layers(num_id, layers):
     raise ValueError('Could not merge layers, since they had overlaps.')
 
 
+# Spaces are at most as short as the shortest duration MEI allows
+MAX_SPACE_DUR = 2048
+
+
+def compact_hidden_events(layer: et.Element) -> int:
+    """
+    Replace each run of hidden events in a layer with spaces of the same
+    total duration, so that the visible events keep their place in the
+    measure while the hidden ones need not be sent or laid out. Events are
+    hidden if none of their elements are visible. Events without a known
+    duration, and elements which are not events, such as clef changes, are
+    kept. Returns the number of events replaced.
+    """
+    replaced = 0
+    run = []
+
+    def replace_run():
+        nonlocal replaced
+        durations = _get_space_durations(
+            sum(_get_timed_duration(e) for e in run)
+        )
+        if durations is not None:
+            for dur in durations:
+                # Made as a child of the layer so it takes its namespace
+                space = et.SubElement(layer, queries.SPACE, dur=str(dur))
+                run[0].addprevious(space)
+            for event in run:
+                layer.remove(event)
+            replaced += len(run)
+        run.clear()
+
+    for child in list(layer):
+        hidden = isinstance(child.tag, str) and \
+            _get_timed_duration(child) is not None and \
+            all(elem.get('visible') != 'true'
+                for elem in child.iter(tag=et.Element))
+        if hidden:
+            run.append(child)
+        elif run:
+            replace_run()
+    if run:
+        replace_run()
+
+    return replaced
+
+
+def _get_timed_duration(event: et.Element) -> Optional[float]:
+    """
+    Return the duration of an event if it is fully known, or None. Grace
+    notes take no time, and beams are only timed if every child is.
+    """
+    tag = et.QName(event)
+    if tag.namespace != MEI_NS['mei'] or event.get('grace') is not None:
+        return None
+
+    if tag.localname == 'beam':
+        durations = [
+            _get_timed_duration(child)
+            for child in event.iterchildren(tag=et.Element)
+        ]
+        if len(durations) == 0 or None in durations:
+            return None
+        return sum(durations)
+
+    if tag.localname in ['note', 'rest', 'space', 'chord']:
+        return _get_duration(event)
+    return None
+
+
+def _get_space_durations(duration: float) -> Optional[List[int]]:
+    """
+    Return the durations of the fewest spaces with the given total duration,
+    longest first, or None if it cannot be made of spaces.
+    """
+    # Durations of events are sums of powers of two, which floats hold
+    # exactly
+    remaining = Fraction(duration)
+    durations = []
+    dur = 1
+    while remaining > 0 and dur <= MAX_SPACE_DUR:
+        if Fraction(1, dur) <= remaining:
+            durations.append(dur)
+            remaining -= Fraction(1, dur)
+        else:
+            dur *= 2
+
+    if remaining != 0:
+        return None
+    return durations
+
+
 class MEIEventDurationInfo:
     def __init__(self, event, start, duration):
         self.event = event
@@ -160,26 +248,22 @@ def _get_duration_info(
         event_group_names: list
         ) -> List[MEIEventDurationInfo]:
 
+    # Events are found in document order, so that they are timed in the
+    # order they are played, whatever their kind
+    event_tags = [queries.mei_tag(e_name) for e_name in event_names]
     events = []
-    for e_name in event_names:
-        e_qry = et.XPath(f'.//mei:{e_name}', namespaces=MEI_NS)
-        events_result = e_qry(layer)
-        for event in events_result:
-            part_of_group = False
-            # Check if elem has ancestor in event_group
-            for group_name in event_group_names:
-                group_qry = et.XPath(
-                    f'ancestor::mei:{group_name}',
-                    namespaces=MEI_NS
-                )
-                group = group_qry(event)
-                if len(group) > 0:
-                    if group[0] not in events:
-                        events.append(group[0])
-                    part_of_group = True
-                    break
-            if not part_of_group:
-                events.append(event)
+    for event in layer.iterdescendants(*event_tags):
+        part_of_group = False
+        # Check if elem has ancestor in event_group
+        for group_name in event_group_names:
+            group = queries.ancestor_query(group_name)(event)
+            if len(group) > 0:
+                if group[0] not in events:
+                    events.append(group[0])
+                part_of_group = True
+                break
+        if not part_of_group:
+            events.append(event)
 
     # Events that are returned first re displayed first,
     # so assume the first event in the list occurs first etc.
@@ -211,18 +295,18 @@ def _get_duration(event):
     ]
 
     # Check if we are getting the duration of a grouped element
-    if et.QName(event).localname in event_group_names and \
-            et.QName(event).namespace == MEI_NS['mei']:
+    tag = et.QName(event)
+    if tag.localname in event_group_names and \
+            tag.namespace == MEI_NS['mei']:
         sub_events = []
         for e_name in event_names:
-            e_qry = et.XPath(f'child::mei:{e_name}', namespaces=MEI_NS)
-            sub_events += e_qry(event)
+            sub_events += queries.child_query(e_name)(event)
 
         # Duration is sum of contained elements
         return sum([_get_duration(e) for e in sub_events])
 
-    elif et.QName(event).localname in event_names and \
-            et.QName(event).namespace == MEI_NS['mei']:
+    elif tag.localname in event_names and \
+            tag.namespace == MEI_NS['mei']:
         # Get relevant attributes
         dur = event.get('dur')
         dots = event.get('dots')
@@ -239,12 +323,8 @@ def _get_duration(event):
             return 1/dur
         else:
             dots = int(dots)
-            length = 1/dur
-            mod = 1
-            for _ in range(dots):
-                mod /= 2
-                length += mod*length
-            return length
+            # Each dot adds half the length added by the one before it
+            return (2 - 0.5**dots)/dur
 
     else:
         return None
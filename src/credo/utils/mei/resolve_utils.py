@@ -1,19 +1,42 @@
 import lxml.etree as et
+import typing as t
 from re import match
 
-from utils.mei.xml_namespaces import MEI_NS
+from utils.mei import queries
 
 
 def is_resolved(mei: et.ElementTree) -> bool:
     # Check all layers have IDs of the form 'm-r[0-9]+',
-    layer_qry = et.XPath('//mei:layer', namespaces=MEI_NS)
-    layers = layer_qry(mei)
+    return count_unresolved_layers(mei) == 0
 
-    id_attrib = et.QName(MEI_NS['xml'], 'id').text
 
-    resolved = True
-    for layer in layers:
-        if not match('m-r[0-9]+', layer.get(id_attrib)):
-            resolved = False
+def count_unresolved_layers(
+        mei: t.Union[et.ElementTree, et.Element]) -> int:
+    """
+    Return the number of layers in an MEI tree, or a part of one such as a
+    measure, which have not been resolved.
+    """
+    return sum(
+        1 for layer in mei.iter(queries.LAYER)
+        if not match('m-r[0-9]+', layer.get(queries.XML_ID, ''))
+    )
 
-    return resolved
+
+def count_unresolved_layers_in_file(f: t.BinaryIO) -> int:
+    """
+    Return the number of layers in an MEI file which have not been resolved,
+    parsing it incrementally so that only the current element's ancestors
+    are kept in memory.
+    """
+    count = 0
+    for _, elem in et.iterparse(f, events=('end',)):
+        if elem.tag == queries.LAYER and \
+                not match('m-r[0-9]+', elem.get(queries.XML_ID, '')):
+            count += 1
+        # Drop the element, and the siblings before it, once it has ended
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+    return count
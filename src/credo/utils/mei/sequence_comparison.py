@@ -0,0 +1,320 @@
+from copy import deepcopy
+import lxml.etree as et
+import numpy as np
+import typing as t
+
+from .deadline import Deadline
+from .measure_comparison import MeasureAlignedComparison
+from utils.mei import queries
+
+# Containers whose children are the events of a layer
+EVENT_CONTAINERS = {queries.BEAM, queries.TUPLET, queries.GRACE_GRP}
+
+# Attributes which do not change how an event is compared
+IGNORED_ATTRIBS = {queries.XML_ID, 'color', 'visible'}
+
+# Above this many cells the LCS table is not kept, and Hirschberg's
+# algorithm is used to find the matches in linear memory
+FULL_TABLE_CELLS = 2**22
+
+# A voice is identified by its staff and layer numbers
+VoiceKey = t.Tuple[str, str]
+
+
+def lcs_matches(
+        a: np.ndarray,
+        b: np.ndarray,
+        deadline: t.Optional[Deadline] = None) -> t.List[t.Tuple[int, int]]:
+    """
+    Return the (a index, b index) pairs of a longest common subsequence of
+    two arrays of integer tokens, in order. The deadline, if any, is checked
+    before each row of the LCS table.
+
+    Each row of the LCS table is computed from the previous one with NumPy.
+    Since a row never increases by more than one from one column to the
+    next, the usual recurrence is a running maximum over the row of matches
+    with the previous row.
+    """
+    # Common prefixes and suffixes are always part of an LCS
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+
+    if deadline is None:
+        deadline = Deadline()
+
+    matches = [(i, i) for i in range(prefix)]
+    middle = _lcs(
+        a[prefix:len(a) - suffix],
+        b[prefix:len(b) - suffix],
+        prefix,
+        prefix,
+        deadline
+    )
+    matches.extend(middle)
+    matches.extend(
+        (len(a) - suffix + i, len(b) - suffix + i) for i in range(suffix)
+    )
+    return matches
+
+
+def _lcs(
+        a: np.ndarray,
+        b: np.ndarray,
+        a_offset: int,
+        b_offset: int,
+        deadline: Deadline) -> t.List[t.Tuple[int, int]]:
+    if len(a) == 0 or len(b) == 0:
+        return []
+
+    if len(a) * len(b) <= FULL_TABLE_CELLS or len(a) == 1:
+        return _lcs_table(a, b, a_offset, b_offset, deadline)
+
+    # Hirschberg: split a in half, and b where the LCS of the first half of
+    # a with the start of b and the second half with the rest is longest
+    mid = len(a) // 2
+    forward = _last_row(a[:mid], b, deadline)
+    backward = _last_row(a[mid:][::-1], b[::-1], deadline)[::-1]
+    split = int(np.argmax(forward + backward))
+
+    return _lcs(a[:mid], b[:split], a_offset, b_offset, deadline) + \
+        _lcs(a[mid:], b[split:], a_offset + mid, b_offset + split, deadline)
+
+
+def _next_row(row: np.ndarray, token: int, b: np.ndarray) -> np.ndarray:
+    following = np.zeros_like(row)
+    following[1:] = np.maximum.accumulate(
+        np.where(b == token, row[:-1] + 1, row[1:])
+    )
+    return following
+
+
+def _last_row(a: np.ndarray, b: np.ndarray, deadline: Deadline) \
+        -> np.ndarray:
+    row = np.zeros(len(b) + 1, dtype=np.int32)
+    for token in a:
+        deadline.check()
+        row = _next_row(row, token, b)
+    return row
+
+
+def _lcs_table(
+        a: np.ndarray,
+        b: np.ndarray,
+        a_offset: int,
+        b_offset: int,
+        deadline: Deadline) -> t.List[t.Tuple[int, int]]:
+    table = np.zeros((len(a) + 1, len(b) + 1), dtype=np.int32)
+    for i, token in enumerate(a):
+        deadline.check()
+        table[i + 1] = _next_row(table[i], token, b)
+
+    matches = []
+    i, j = len(a), len(b)
+    while i > 0 and j > 0:
+        if a[i - 1] == b[j - 1]:
+            matches.append((a_offset + i - 1, b_offset + j - 1))
+            i -= 1
+            j -= 1
+        elif table[i - 1, j] >= table[i, j - 1]:
+            i -= 1
+        else:
+            j -= 1
+
+    matches.reverse()
+    return matches
+
+
+class SequenceAlignmentComparison(MeasureAlignedComparison):
+    """
+    Comparison strategy which flattens each voice of the score into a
+    sequence of note events, and aligns the sequences of a and b with a
+    longest common subsequence. Events outside the LCS are coloured as
+    deleted from a or inserted into b.
+
+    Notes are compared by their pitch, duration, dots and accidentals, and
+    chords by their duration, dots and notes. Any other event is compared by
+    its tag and attributes. Changes to anything else, such as stem
+    directions, are not shown in the diff.
+
+    Measures are aligned first, as in MeasureAlignedComparison, so a measure
+    inserted into b is added to the diff rather than failing the merge.
+    """
+
+    def _get_diff_tree(self, a: et.ElementTree, b: et.ElementTree) \
+            -> et.ElementTree:
+
+        a_modded = deepcopy(a)
+        b_modded = deepcopy(b)
+
+        with self.trace.phase('align') as phase:
+            bars = self._pair_measures(a_modded, b_modded)
+            phase.nodes += len(bars)
+
+        with self.trace.phase('tokenise') as phase:
+            a_voices = self._get_voices(bar for bar, _ in bars)
+            b_voices = self._get_voices(bar for _, bar in bars)
+
+            vocabulary = {}
+            sequences = {}
+            for key in a_voices.keys() | b_voices.keys():
+                a_events = a_voices.get(key, [])
+                b_events = b_voices.get(key, [])
+                sequences[key] = (
+                    a_events,
+                    b_events,
+                    self._tokenise(a_events, vocabulary),
+                    self._tokenise(b_events, vocabulary)
+                )
+                phase.nodes += len(a_events) + len(b_events)
+
+        with self.trace.phase('diff') as phase:
+            unmatched_a = []
+            unmatched_b = []
+            for a_events, b_events, a_tokens, b_tokens in sequences.values():
+                a_matched = set()
+                b_matched = set()
+                matches = lcs_matches(a_tokens, b_tokens, self.deadline)
+                for a_idx, b_idx in matches:
+                    a_matched.add(a_idx)
+                    b_matched.add(b_idx)
+
+                unmatched_a.extend(
+                    event for idx, event in enumerate(a_events)
+                    if idx not in a_matched
+                )
+                unmatched_b.extend(
+                    event for idx, event in enumerate(b_events)
+                    if idx not in b_matched
+                )
+                phase.nodes += len(a_tokens) + len(b_tokens)
+            phase.actions += len(unmatched_a) + len(unmatched_b)
+
+        with self.trace.phase('colour') as phase:
+            self._hide(b_modded)
+            node_groups = ['chord', 'beam']
+            for event in unmatched_a:
+                for elem in event.iter(tag=et.Element):
+                    elem.set('color', self.a_colour_str)
+                self._apply_color_to_group(
+                    event,
+                    node_groups,
+                    self.a_colour_str
+                )
+            for event in unmatched_b:
+                for elem in event.iter(tag=et.Element):
+                    elem.set('color', self.b_colour_str)
+                    elem.set('visible', 'true')
+                self._apply_color_to_group(
+                    event,
+                    node_groups,
+                    self.b_colour_str
+                )
+            phase.nodes += len(unmatched_a) + len(unmatched_b)
+
+        self._log_trees([
+            ('A Original', a),
+            ('B Original', b),
+            ('A Modded', a_modded),
+            ('B Modded', b_modded)
+        ])
+
+        # Merge b_modded into a_modded, which becomes the diff tree
+        with self.trace.phase('merge'):
+            diff = self._naive_layer_merge(a_modded, b_modded)
+
+        self._log_trees([('Difference', diff)])
+
+        # TEMPORARY: Strip all trill tags from the diff
+        # TODO: Resolve trill IDs in _naive_layer_merge
+        for elem in queries.TRILLS(diff):
+            elem.getparent().remove(elem)
+
+        return diff
+
+    def _get_voices(self, bars: t.Iterable[et.Element]) \
+            -> t.Dict[VoiceKey, t.List[et.Element]]:
+        """
+        Return the events of each voice, from every measure in order.
+        """
+        voices = {}
+        for bar in bars:
+            for staff_idx, staff in enumerate(queries.CHILD_STAFFS(bar)):
+                staff_n = staff.get('n', str(staff_idx + 1))
+                for layer_idx, layer in enumerate(
+                        queries.CHILD_LAYERS(staff)):
+                    key = (staff_n, layer.get('n', str(layer_idx + 1)))
+                    events = voices.setdefault(key, [])
+                    self._add_events(layer, events)
+        return voices
+
+    def _add_events(self, parent: et.Element, events: t.List[et.Element]):
+        for child in parent:
+            if not isinstance(child.tag, str):
+                # Comments and processing instructions
+                continue
+            if child.tag in EVENT_CONTAINERS:
+                self._add_events(child, events)
+            else:
+                events.append(child)
+
+    def _tokenise(
+            self,
+            events: t.List[et.Element],
+            vocabulary: t.Dict[tuple, int]) -> np.ndarray:
+        """
+        Return an array of the tokens of events, numbering new tokens in
+        vocabulary, which is shared by a and b.
+        """
+        tokens = np.empty(len(events), dtype=np.int32)
+        for idx, event in enumerate(events):
+            key = self._event_key(event)
+            tokens[idx] = vocabulary.setdefault(key, len(vocabulary))
+        return tokens
+
+    def _event_key(self, event: et.Element) -> tuple:
+        if event.tag == queries.NOTE:
+            return (
+                event.tag,
+                event.get('octname'),
+                event.get('dur'),
+                event.get('dots'),
+                self._accidentals(event)
+            )
+        if event.tag == queries.CHORD:
+            return (
+                event.tag,
+                event.get('dur'),
+                event.get('dots'),
+                tuple(sorted(
+                    (
+                        self._event_key(note)
+                        for note in queries.child_query('note')(event)
+                    ),
+                    key=str
+                ))
+            )
+        return (
+            event.tag,
+            tuple(sorted(
+                (name, value) for name, value in event.attrib.items()
+                if name not in IGNORED_ATTRIBS
+            ))
+        )
+
+    @staticmethod
+    def _accidentals(note: et.Element) -> tuple:
+        # Accidentals may be attributes of the note or accid children
+        accidentals = []
+        for elem in [note] + queries.child_query('accid')(note):
+            for name in ['accid', 'accid.ges']:
+                value = elem.get(name)
+                if value is not None:
+                    accidentals.append(f'{name}={value}')
+        return tuple(sorted(accidentals))
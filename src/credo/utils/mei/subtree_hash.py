@@ -0,0 +1,76 @@
+import hashlib
+import lxml.etree as et
+import typing as t
+
+from utils.mei import queries
+
+# Subtrees of the intermediate MEI form that are hashed by default
+HASHED_TAGS = frozenset([queries.MEASURE, queries.STAFF, queries.LAYER])
+
+
+def subtree_hashes(
+        tree: et.ElementTree,
+        tags: t.AbstractSet[str] = HASHED_TAGS
+        ) -> t.Dict[et.Element, bytes]:
+    """
+    Compute a canonical content hash of every subtree in the tree, returning
+    the hashes of the elements with the given tags.
+
+    Hashes are built bottom up from the hashes of each element's children, so
+    the whole tree is hashed in a single pass. The hash of an element covers
+    its tag, its attributes in sorted order except for xml:id, its text, and
+    the hashes and tails of its children. Two subtrees with equal hashes
+    therefore have equal contents, regardless of their IDs.
+    """
+    if isinstance(tree, et._ElementTree):
+        tree = tree.getroot()
+
+    hashes = {}
+    child_hashes = {}
+    for _, elem in et.iterwalk(tree, events=('end',)):
+        digest = _start_hash(elem)
+
+        for child in elem:
+            if child in child_hashes:
+                digest.update(child_hashes.pop(child))
+            else:
+                # iterwalk does not visit comments and processing
+                # instructions, so hash them in place
+                digest.update(_leaf_hash(child))
+            digest.update(_encode(child.tail))
+
+        child_hashes[elem] = digest.digest()
+        if elem.tag in tags:
+            hashes[elem] = child_hashes[elem]
+
+    return hashes
+
+
+def _start_hash(elem: et.Element):
+    # Hash of an element's own tag, attributes and text
+    digest = hashlib.sha1()
+
+    if isinstance(elem.tag, str):
+        digest.update(_encode(elem.tag))
+        for name, value in sorted(elem.attrib.items()):
+            if name != queries.XML_ID:
+                digest.update(_encode(name))
+                digest.update(_encode(value))
+    else:
+        # Comments and processing instructions
+        digest.update(_encode(type(elem).__name__))
+
+    digest.update(_encode(elem.text))
+    return digest
+
+
+def _leaf_hash(elem: et.Element) -> bytes:
+    return _start_hash(elem).digest()
+
+
+def _encode(value: t.Optional[str]) -> bytes:
+    # Length prefixed, so that adjacent values can not be confused
+    if value is None:
+        return b'\xff'
+    data = value.encode()
+    return len(data).to_bytes(4, 'big') + data
@@ -1,11 +1,24 @@
+import re
+import typing as t
+from itertools import islice
+
 from lxml import etree
 from xmldiff.patch import Patcher
 from copy import deepcopy
 
+from .deadline import Deadline
+
+# Paths made only of element steps, e.g. /*/*[2]/*[3], which is how xmldiff
+# addresses namespaced elements. These are resolved through the path cache.
+CACHEABLE_PATH = re.compile(r'^(/\*(\[\d+\])?)+$')
+ELEMENT_STEP = re.compile(r'^\*(?:\[(\d+)\])?$')
+
 
 class TrackedPatcher(Patcher):
 
     class TrackedNode:
+        __slots__ = ('original', 'modified', 'modifications')
+
         def __init__(self, original, modified):
             self.original = original
             self.modified = modified
@@ -14,99 +27,175 @@ class TrackedPatcher(Patcher):
         def register_modification(self, action):
             self.modifications.append(action)
 
-    def __init__(self):
+    def __init__(self, deadline: t.Optional[Deadline] = None):
+        self.deadline = deadline
         self.nodes = []
+        # Tracked nodes keyed by their element in the patched tree. Elements
+        # hash by identity, and the tracked node keeps each one alive, so
+        # lxml returns the same proxy object whenever it is found again.
+        self._tracked = {}
+        # Elements keyed by path. Cached paths are also indexed by the
+        # element they were resolved through, and by their parent path, so
+        # they can be dropped when that element's children change.
+        self._path_cache = {}
+        self._dependent_paths = {}
+        self._cached_children = {}
 
     def patch(self, actions, tree):
 
         result = deepcopy(tree)
 
-        original_iter = tree.iter()
-        result_iter = result.iter()
+        self._path_cache = {}
+        self._dependent_paths = {}
+        self._cached_children = {}
 
         # Associate each node in tree with each node in result
-        while True:
-            try:
-                original_node = original_iter.__next__()
-                result_node = result_iter.__next__()
-                self.nodes.append(
-                    TrackedPatcher.TrackedNode(original_node, result_node)
-                )
-            except StopIteration:
-                break
+        for original_node, result_node in zip(tree.iter(), result.iter()):
+            tracked = TrackedPatcher.TrackedNode(original_node, result_node)
+            self.nodes.append(tracked)
+            self._tracked[result_node] = tracked
 
         for action in actions:
+            if self.deadline is not None:
+                self.deadline.check()
             self.handle_action(action, result)
 
         return result
 
     def register_modification(self, action, tree, node):
-        modified_nodes = [x.modified for x in self.nodes]
-        if node in modified_nodes:
-            i = modified_nodes.index(node)
-            self.nodes[i].register_modification(action)
-        else:
-            modified_node = TrackedPatcher.TrackedNode(None, node)
-            modified_node.register_modification(action)
-            self.nodes.append(modified_node)
+        tracked = self._tracked.get(node)
+        if tracked is None:
+            tracked = TrackedPatcher.TrackedNode(None, node)
+            self.nodes.append(tracked)
+            self._tracked[node] = tracked
+        tracked.register_modification(action)
 
     def handle_action(self, action, tree):
         super().handle_action(action, tree)
 
+    def _find(self, tree, path):
+        """
+        Return the element at an xmldiff path, using the path cache where
+        possible.
+        """
+        node = self._path_cache.get(path)
+        if node is None and CACHEABLE_PATH.match(path):
+            node = self._resolve(tree, path)
+        if node is None:
+            node = tree.xpath(path)[0]
+        return node
+
+    def _resolve(self, tree, path):
+        """
+        Resolve a path one step at a time, caching the element found for it
+        and each of its prefixes. Returns None if a step does not identify a
+        single element, in which case XPath must be used.
+        """
+        parent_path, _, step = path.rpartition('/')
+        position = ELEMENT_STEP.match(step).group(1)
+
+        if parent_path == '':
+            parent = None
+            node = tree.xpath('/*')[0]
+        else:
+            parent = self._path_cache.get(parent_path)
+            if parent is None:
+                parent = self._resolve(tree, parent_path)
+            if parent is None:
+                return None
+
+            children = parent.iterchildren(etree.Element)
+            if position is None:
+                # A step without a position selects every child element, so
+                # it only identifies an element if there is exactly one.
+                found = list(islice(children, 2))
+                if len(found) != 1:
+                    return None
+                node = found[0]
+            else:
+                node = next(islice(children, int(position) - 1, None), None)
+                if node is None:
+                    return None
+
+        self._path_cache[path] = node
+        self._dependent_paths.setdefault(parent, set()).add(path)
+        self._cached_children.setdefault(parent_path, set()).add(path)
+        return node
+
+    def _invalidate_children(self, parent):
+        """
+        Drop the cached paths of every descendant of an element whose
+        children have changed, as their positions may have changed.
+
+        Only inserting, deleting and moving elements changes paths, since
+        xmldiff addresses elements by position rather than by tag.
+        """
+        stack = list(self._dependent_paths.pop(parent, ()))
+        while len(stack) > 0:
+            path = stack.pop()
+            self._path_cache.pop(path, None)
+            stack.extend(self._cached_children.pop(path, ()))
+
     def _handle_DeleteNode(self, action, tree):
-        node = tree.xpath(action.node)[0]
-        node.getparent().remove(node)
+        node = self._find(tree, action.node)
+        parent = node.getparent()
+        parent.remove(node)
+        self._invalidate_children(parent)
         self.register_modification(action, tree, node)
 
     def _handle_InsertNode(self, action, tree):
-        target = tree.xpath(action.target)[0]
+        target = self._find(tree, action.target)
         node = target.makeelement(action.tag)
         target.insert(action.position, node)
+        self._invalidate_children(target)
         self.register_modification(action, tree, node)
 
     def _handle_RenameNode(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         node.tag = action.tag
         self.register_modification(action, tree, node)
 
     def _handle_MoveNode(self, action, tree):
-        node = tree.xpath(action.node)[0]
-        target = tree.xpath(action.target)[0]
-        node.getparent().remove(node)
+        node = self._find(tree, action.node)
+        target = self._find(tree, action.target)
+        parent = node.getparent()
+        parent.remove(node)
         target.insert(action.position, node)
+        self._invalidate_children(parent)
+        self._invalidate_children(target)
         self.register_modification(action, tree, node)
 
     def _handle_UpdateTextIn(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         node.text = action.text
         self.register_modification(action, tree, node)
 
     def _handle_UpdateTextAfter(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         node.tail = action.text
         self.register_modification(action, tree, node)
 
     def _handle_UpdateAttrib(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         # This should not be used to insert new attributes.
         assert action.name in node.attrib
         node.attrib[action.name] = action.value
         self.register_modification(action, tree, node)
 
     def _handle_DeleteAttrib(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         del node.attrib[action.name]
         self.register_modification(action, tree, node)
 
     def _handle_InsertAttrib(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         # This should not be used to update existing attributes.
         assert action.name not in node.attrib
         node.attrib[action.name] = action.value
         self.register_modification(action, tree, node)
 
     def _handle_RenameAttrib(self, action, tree):
-        node = tree.xpath(action.node)[0]
+        node = self._find(tree, action.node)
         assert action.oldname in node.attrib
         assert action.newname not in node.attrib
         node.attrib[action.newname] = node.attrib[action.oldname]
@@ -114,7 +203,7 @@ class TrackedPatcher(Patcher):
         self.register_modification(action, tree, node)
 
     def _handle_InsertComment(self, action, tree):
-        target = tree.xpath(action.target)[0]
+        target = self._find(tree, action.target)
         node = etree.Comment(action.text)
         target.insert(action.position, node)
         self.register_modification(action, tree, node)
@@ -1,25 +1,70 @@
-from xmldiff import main, actions
+from xmldiff import actions
+from xmldiff.diff import Differ
 import lxml.etree as et
 import typing as t
 from pprint import pformat
 from copy import deepcopy
+from difflib import SequenceMatcher
 import logging
 from colorsys import rgb_to_hls
 
 from .comparison_strategy import ComparisonStrategy
+from .deadline import ComparisonCancelled, Deadline, DeadlineExceeded
+from .instrumentation import count_nodes
+from .measure_utils import compact_hidden_events
+from .subtree_hash import subtree_hashes
 from .tracked_patcher import TrackedPatcher
 from utils.mei.mei_transformer import MeiTransformer
-from utils.mei.xml_namespaces import MEI_NS
+from utils.mei import queries
 from utils.mei.id_formatters import get_formatted_xml_id
 
 
+class DeadlineDiffer(Differ):
+    """
+    xmldiff Differ which checks a deadline as it matches nodes, where nearly
+    all of the time of a diff is spent.
+    """
+
+    def __init__(self, deadline: Deadline, **diff_options):
+        super().__init__(**diff_options)
+        self.deadline = deadline
+
+    def node_ratio(self, left, right):
+        self.deadline.check()
+        return super().node_ratio(left, right)
+
+
 class TreeComparison(ComparisonStrategy):
 
     DEFAULT_A_RGB = (0.400, 0.702, 1.000)
     DEFAULT_B_RGB = (1.000, 0.400, 0.529)
 
+    DEFAULT_DIFF_OPTIONS = {
+        'F': 0.5,
+        'ratio_mode': 'accurate',
+        'uniqueattrs': []  # Ignore xml:id attributes
+    }
+
+    uses_intermediate = True
+
+    # Phase recorded when a comparison falls back to a measure level diff
+    COARSE_PHASE = 'coarse_diff'
+
+    # Marks the placeholders left in place of pruned subtrees
+    PRUNED_ATTRIB = 'credo-pruned'
+    PRUNED_QRY = et.XPath(f'//*[@{PRUNED_ATTRIB}]')
+
     def __init__(self):
+        super().__init__()
         self.logger = logging.getLogger(__name__)
+        self.diff_options = dict(TreeComparison.DEFAULT_DIFF_OPTIONS)
+
+        # Skip identical measures, staves and layers when diffing
+        self.prune_identical = True
+        # Replace the hidden events of inserted layers with spaces
+        self.compact_hidden = True
+        self.total_nodes = 0
+        self.pruned_nodes = 0
         self.set_colours(
             TreeComparison.DEFAULT_A_RGB,
             TreeComparison.DEFAULT_B_RGB
@@ -48,46 +93,216 @@ class TreeComparison(ComparisonStrategy):
             int(self.b_colour_hls[1]*100)
         )
 
+    def cache_key(self) -> str:
+        return '{}:{}:{}:{}:{}:{}'.format(
+            super().cache_key(),
+            self.a_colour_str,
+            self.b_colour_str,
+            sorted(self.diff_options.items()),
+            self.prune_identical,
+            self.compact_hidden
+        )
+
+    @property
+    def coarse(self) -> bool:
+        return TreeComparison.COARSE_PHASE in self.trace.phases
+
+    @property
+    def pruned_percentage(self) -> float:
+        """
+        Percentage of the nodes of the last comparison that were skipped when
+        diffing, as they were in identical subtrees.
+        """
+        if self.total_nodes == 0:
+            return 0.0
+        return 100 * self.pruned_nodes / self.total_nodes
+
     def compare_trees(self, a: et.ElementTree, b: et.ElementTree) \
             -> t.Tuple[et.ElementTree, et.ElementTree, et.ElementTree]:
-
+        """
+        Compare a and b, returning the diff, a and b. The comparison takes
+        ownership of a and b, which are modified and returned rather than
+        copied. a and b may already be in the intermediate representation.
+        """
         a_transformer = MeiTransformer(a)
         b_transformer = MeiTransformer(b)
 
-        a_transformer.to_intermediate()
-        b_transformer.to_intermediate()
+        with self.trace.phase('to_intermediate') as phase:
+            for transformer, tree in [(a_transformer, a), (b_transformer, b)]:
+                if not transformer.is_intermediate:
+                    transformer.to_intermediate()
+                    phase.nodes += count_nodes(tree)
+
+        self.total_nodes = 0
+        self.pruned_nodes = 0
 
-        diff = self.__get_diff_tree(a_transformer.tree, b_transformer.tree)
+        # a and b are only modified temporarily while diffing, so are
+        # borrowed rather than copied
+        try:
+            diff = self._get_diff_tree(
+                a_transformer.borrow(),
+                b_transformer.borrow()
+            )
+        except ComparisonCancelled:
+            raise
+        except DeadlineExceeded:
+            self.logger.warning('Comparison deadline exceeded, falling back '
+                                'to a measure level diff')
+            diff = self._get_coarse_diff_tree(
+                a_transformer.borrow(),
+                b_transformer.borrow()
+            )
+
+        self.logger.info('Pruned {:.1f}% of {} nodes before diffing'.format(
+            self.pruned_percentage,
+            self.total_nodes
+        ))
 
         diff_transformer = MeiTransformer(diff)
 
-        diff_transformer.to_plain_mei()
-        a_transformer.to_plain_mei()
-        b_transformer.to_plain_mei()
-
-        diff_transformer.generate_ids(keep_existing=True)
-        a_transformer.generate_ids(keep_existing=False)
-        b_transformer.generate_ids(keep_existing=False)
-
-        return diff_transformer.tree, a_transformer.tree, b_transformer.tree
-
-    def __get_diff_tree(self, a: et.ElementTree, b: et.ElementTree, ):
-        # Get a list of actions to apply to tree a that
-        # when applied transform it into tree b
-        diff_actions = main.diff_trees(
-            a,
-            b,
-            diff_options={
-                'F': 0.5,
-                'ratio_mode': 'accurate',
-                'uniqueattrs': []  # Ignore xml:id attributes
-            }
+        with self.trace.phase('to_plain_mei'):
+            diff_transformer.to_plain_mei()
+            a_transformer.to_plain_mei()
+            b_transformer.to_plain_mei()
+
+        with self.trace.phase('generate_ids') as phase:
+            diff_transformer.generate_ids(keep_existing=True)
+            a_transformer.generate_ids(keep_existing=False)
+            b_transformer.generate_ids(keep_existing=False)
+            phase.nodes += count_nodes(diff)
+
+        return (
+            diff_transformer.take(),
+            a_transformer.take(),
+            b_transformer.take()
         )
 
-        patcher = TrackedPatcher()
-        a_modded = deepcopy(a)
-        b_modded = patcher.patch(diff_actions, a_modded)
+    def _get_diff_tree(self, a: et.ElementTree, b: et.ElementTree) \
+            -> et.ElementTree:
+
+        a_modded, b_modded = self._get_modded_trees(a, b)
+
+        self._log_trees([
+            ('A Original', a),
+            ('B Original', b),
+            ('A Modded', a_modded),
+            ('B Modded', b_modded)
+        ])
+
+        # Merge b_modded into a_modded, which becomes the diff tree
+        with self.trace.phase('merge'):
+            diff = self._naive_layer_merge(a_modded, b_modded)
+
+        self._log_trees([('Difference', diff)])
+
+        # TEMPORARY: Strip all trill tags from the diff
+        # TODO: Resolve trill IDs in _naive_layer_merge
+        for elem in queries.TRILLS(diff):
+            elem.getparent().remove(elem)
+
+        return diff
+
+    def _get_coarse_diff_tree(self, a: et.ElementTree, b: et.ElementTree) \
+            -> et.ElementTree:
+        """
+        Return a diff of a and b which only shows which measures differ,
+        as deleted from a and inserted into b, for when there is no time
+        left to diff them properly. Its cost is linear in the size of the
+        scores, and deadlines are not checked.
+        """
+        with self.trace.phase(TreeComparison.COARSE_PHASE) as phase:
+            a_modded = deepcopy(a)
+            b_modded = deepcopy(b)
+
+            changed = [
+                (a_bar, b_bar)
+                for a_bar, b_bar in self._pair_measures(a_modded, b_modded)
+                if self._measure_key(a_bar) != self._measure_key(b_bar)
+            ]
+
+            self._hide(b_modded)
+            layers = queries.descendant_query('layer')
+            for a_bar, b_bar in changed:
+                for layer in layers(a_bar):
+                    for elem in layer.iterdescendants(tag=et.Element):
+                        elem.set('color', self.a_colour_str)
+                for layer in layers(b_bar):
+                    for elem in layer.iterdescendants(tag=et.Element):
+                        elem.set('color', self.b_colour_str)
+                        elem.set('visible', 'true')
+            phase.nodes += len(changed)
+
+            # The deadline has passed, so must not be checked when merging
+            deadline = self.deadline
+            self.deadline = Deadline()
+            try:
+                diff = self._naive_layer_merge(a_modded, b_modded)
+            finally:
+                self.deadline = deadline
+
+        # TEMPORARY: Strip all trill tags from the diff
+        for elem in queries.TRILLS(diff):
+            elem.getparent().remove(elem)
+
+        return diff
+
+    def _get_modded_trees(self, a: et.ElementTree, b: et.ElementTree) \
+            -> t.Tuple[et.ElementTree, et.ElementTree]:
+        """
+        Diff a against b, returning a copy of a with deleted and updated nodes
+        coloured, and a hidden copy of b with inserted and updated nodes
+        coloured and visible.
+        """
+        if self.prune_identical:
+            with self.trace.phase('prune') as phase:
+                pruned_nodes = self.pruned_nodes
+                a_pruned, b_pruned = self._prune_identical(a, b)
+                phase.nodes += self.pruned_nodes - pruned_nodes
+        else:
+            a_pruned, b_pruned = {}, {}
 
+        try:
+            # Get a list of actions to apply to tree a that
+            # when applied transform it into tree b
+            with self.trace.phase('diff') as phase:
+                differ = DeadlineDiffer(self.deadline, **self.diff_options)
+                diff_actions = list(differ.diff(a, b))
+                phase.nodes += count_nodes(a, b)
+                phase.actions += len(diff_actions)
+
+            with self.trace.phase('patch') as phase:
+                patcher = TrackedPatcher(self.deadline)
+                a_modded = deepcopy(a)
+                b_modded = patcher.patch(diff_actions, a_modded)
+                phase.actions += len(diff_actions)
+        except DeadlineExceeded:
+            # a and b are borrowed, so must be whole again for the fallback
+            self._restore_pruned(a, a_pruned, copy=False)
+            self._restore_pruned(b, b_pruned, copy=False)
+            raise
+
+        # Copy identical subtrees into the modded trees before any colours
+        # and visibilities are applied, and put them back into a and b.
+        if self.prune_identical:
+            with self.trace.phase('restore_pruned'):
+                self._restore_pruned(a_modded, a_pruned, copy=True)
+                self._restore_pruned(b_modded, b_pruned, copy=True)
+                self._restore_pruned(a, a_pruned, copy=False)
+                self._restore_pruned(b, b_pruned, copy=False)
+
+        with self.trace.phase('colour') as phase:
+            phase.nodes += self._colour_modifications(patcher, b_modded)
+
+        return a_modded, b_modded
+
+    def _colour_modifications(
+            self,
+            patcher: TrackedPatcher,
+            b_modded: et.ElementTree) -> int:
+        """
+        Hide b_modded, then colour and show every node modified by the
+        patcher. Returns the number of modified nodes.
+        """
         action_classes = {
             'insert': [
                 actions.InsertNode,
@@ -108,28 +323,23 @@ class TreeComparison(ComparisonStrategy):
             ]
         }
 
-        # Make all nodes in b_modded invisible by default, except for layers.
-        # to avoid visual layer clashes
-        class_lookup = et.ElementDefaultClassLookup()
-        for elem in b_modded.iter():
-            # Ensure element can have attributes
-            if (not isinstance(elem, class_lookup.comment_class) and
-                    not isinstance(elem, class_lookup.entity_class)):
-                elem.set('visible', 'false')
-
-        # Set all layers to be visible
-        for elem in b_modded.findall('//mei:layer', MEI_NS):
-            elem.set('visible', 'true')
+        self._hide(b_modded)
 
         # Apply colours to modified nodes in a_modded and b_modded trees
         node_groups = ['chord', 'beam']
+        tracing = self.trace.tracing
+        modified = 0
         for node in patcher.nodes:
             if len(node.modifications) > 0:
-                self.logger.debug('\nOriginal: {}\nModified: {}\n{}\n'.format(
-                    node.original,
-                    node.modified,
-                    pformat(node.modifications)
-                ))
+                modified += 1
+                if tracing:
+                    self.logger.debug(
+                        '\nOriginal: {}\nModified: {}\n{}\n'.format(
+                            node.original,
+                            node.modified,
+                            pformat(node.modifications)
+                        )
+                    )
                 mod = node.modifications[0]
                 if type(mod) in action_classes['insert']:
                     # Set colours in b_modded
@@ -137,7 +347,7 @@ class TreeComparison(ComparisonStrategy):
                     node.modified.set('visible', 'true')
                     # If the modified node is in a chord or beam, mark all
                     # elements in the chord/beam as modified as well.
-                    self.__apply_color_to_group(
+                    self._apply_color_to_group(
                         node.modified,
                         node_groups,
                         self.b_colour_str
@@ -146,7 +356,7 @@ class TreeComparison(ComparisonStrategy):
                 elif type(mod) in action_classes['delete']:
                     # Set colours in a_modded
                     node.original.set('color', self.a_colour_str)
-                    self.__apply_color_to_group(
+                    self._apply_color_to_group(
                         node.original,
                         node_groups,
                         self.a_colour_str
@@ -157,163 +367,352 @@ class TreeComparison(ComparisonStrategy):
                     node.modified.set('visible', 'true')
                     # If the modified node is in a chord or beam, mark all
                     # elements in the chord/beam as modified as well.
-                    self.__apply_color_to_group(
+                    self._apply_color_to_group(
                         node.modified,
                         node_groups,
                         self.b_colour_str
                     )
                     # Set colours in a_modded
                     node.original.set('color', self.a_colour_str)
-                    self.__apply_color_to_group(
+                    self._apply_color_to_group(
                         node.original,
                         node_groups,
                         self.a_colour_str
                     )
 
-        # Merge a_modded and b_modded into a single diff tree
-        diff = self.__naive_layer_merge(a_modded, b_modded)
+        return modified
 
-        self.logger.debug('\n{}:\n{}\n'.format(
-            'A Original',
-            et.tostring(a, pretty_print=True).decode()
-        ))
-
-        self.logger.debug('\n{}:\n{}\n'.format(
-            'B Original',
-            et.tostring(b, pretty_print=True).decode()
-        ))
+    @staticmethod
+    def _hide(b_modded: et.ElementTree):
+        """
+        Make every node in b_modded invisible, except for layers, to avoid
+        visual layer clashes.
+        """
+        class_lookup = et.ElementDefaultClassLookup()
+        for elem in b_modded.iter():
+            # Ensure element can have attributes
+            if (not isinstance(elem, class_lookup.comment_class) and
+                    not isinstance(elem, class_lookup.entity_class)):
+                elem.set('visible', 'false')
 
-        self.logger.debug('\n{}:\n{}\n'.format(
-            'A Modded',
-            et.tostring(a_modded, pretty_print=True).decode()
-        ))
+        # Set all layers to be visible
+        for elem in queries.LAYERS(b_modded):
+            elem.set('visible', 'true')
 
-        self.logger.debug('\n{}:\n{}\n'.format(
-            'B Modded',
-            et.tostring(b_modded, pretty_print=True).decode()
-        ))
+    def _prune_identical(self, a: et.ElementTree, b: et.ElementTree) \
+            -> t.Tuple[t.Dict[str, list], t.Dict[str, list]]:
+        """
+        Remove the contents of identical measures, staves and layers from a
+        and b, working top down, so they are not diffed. Each pruned element
+        is left in place, marked with PRUNED_ATTRIB.
+
+        Returns the removed children of a and b, keyed by the value of
+        PRUNED_ATTRIB on the element they were removed from.
+        """
+        a_hashes = subtree_hashes(a)
+        b_hashes = subtree_hashes(b)
+
+        identical = []
+
+        def match_children(a_parent, b_parent, queries):
+            # Pair children by position, descending into differing pairs
+            qry, *child_queries = queries
+            for a_elem, b_elem in zip(qry(a_parent), qry(b_parent)):
+                if a_hashes[a_elem] == b_hashes[b_elem]:
+                    identical.append((a_elem, b_elem))
+                elif len(child_queries) > 0:
+                    match_children(a_elem, b_elem, child_queries)
+
+        # Align bars by their hashes, so that an inserted or deleted bar
+        # doesn't stop the bars after it from being pruned.
+        a_bars = queries.MEASURES(a)
+        b_bars = queries.MEASURES(b)
+        matcher = SequenceMatcher(
+            None,
+            [a_hashes[bar] for bar in a_bars],
+            [b_hashes[bar] for bar in b_bars],
+            autojunk=False
+        )
+        for op, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+            bar_pairs = zip(a_bars[a_start:a_end], b_bars[b_start:b_end])
+            if op == 'equal':
+                identical.extend(bar_pairs)
+            elif op == 'replace':
+                for a_bar, b_bar in bar_pairs:
+                    match_children(
+                        a_bar,
+                        b_bar,
+                        [queries.CHILD_STAFFS, queries.CHILD_LAYERS]
+                    )
 
-        self.logger.debug('\n{}:\n{}\n'.format(
-            'Difference',
-            et.tostring(diff, pretty_print=True).decode()
-        ))
+        self.total_nodes += sum(1 for _ in a.iter()) + sum(1 for _ in b.iter())
 
-        # TEMPORARY: Strip all trill tags from the diff
-        # TODO: Resolve trill IDs in __naive_layer_merge
-        for elem in diff.findall('//mei:trill', MEI_NS):
-            elem.getparent().remove(elem)
+        a_pruned = {}
+        b_pruned = {}
+        for idx, (a_elem, b_elem) in enumerate(identical):
+            key = str(idx)
+            for elem, pruned in [(a_elem, a_pruned), (b_elem, b_pruned)]:
+                pruned[key] = list(elem)
+                for child in pruned[key]:
+                    self.pruned_nodes += sum(1 for _ in child.iter())
+                    elem.remove(child)
+                elem.set(TreeComparison.PRUNED_ATTRIB, key)
 
-        return diff
+        return a_pruned, b_pruned
 
-    def __apply_color_to_group(self, node, group_tags, colour):
+    def _restore_pruned(
+            self,
+            tree: et.ElementTree,
+            pruned: t.Dict[str, list],
+            copy: bool):
+        """
+        Put pruned children back into the marked elements of a tree.
+        """
+        if len(pruned) == 0:
+            return
+
+        for elem in TreeComparison.PRUNED_QRY(tree):
+            key = elem.attrib.pop(TreeComparison.PRUNED_ATTRIB)
+            for child in pruned.get(key, []):
+                elem.append(deepcopy(child) if copy else child)
+
+    def _align_measures(
+            self,
+            a_bars: t.List[et.Element],
+            b_bars: t.List[et.Element]
+            ) -> t.List[t.Tuple[t.Optional[int], t.Optional[int]]]:
+        """
+        Align the measures of a and b by their contents, returning a list of
+        (a index, b index) pairs in score order. Measures without a
+        counterpart are paired with None.
+        """
+        a_keys = [self._measure_key(bar) for bar in a_bars]
+        b_keys = [self._measure_key(bar) for bar in b_bars]
+
+        matcher = SequenceMatcher(None, a_keys, b_keys, autojunk=False)
+
+        alignment = []
+        for op, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+            if op == 'equal' or op == 'replace':
+                # Pair up replaced measures in order, leaving any surplus
+                # measures unpaired.
+                paired = min(a_end - a_start, b_end - b_start)
+                for offset in range(paired):
+                    alignment.append((a_start + offset, b_start + offset))
+                for a_idx in range(a_start + paired, a_end):
+                    alignment.append((a_idx, None))
+                for b_idx in range(b_start + paired, b_end):
+                    alignment.append((None, b_idx))
+            elif op == 'delete':
+                for a_idx in range(a_start, a_end):
+                    alignment.append((a_idx, None))
+            elif op == 'insert':
+                for b_idx in range(b_start, b_end):
+                    alignment.append((None, b_idx))
+
+        return alignment
+
+    @staticmethod
+    def _measure_key(bar: et.Element) -> bytes:
+        # Measure attributes such as n are ignored, so that inserting a
+        # measure does not misalign every measure after it.
+        return b''.join(et.tostring(child) for child in bar)
+
+    @staticmethod
+    def _hollow_measure(bar: et.Element) -> et.Element:
+        """
+        Return a copy of a measure with the contents of its layers removed.
+        """
+        hollow = deepcopy(bar)
+        for staff in queries.CHILD_STAFFS(hollow):
+            for layer in queries.CHILD_LAYERS(staff):
+                for child in list(layer):
+                    layer.remove(child)
+        return hollow
+
+    def _pair_measures(self, a: et.ElementTree, b: et.ElementTree) \
+            -> t.List[t.Tuple[et.Element, et.Element]]:
+        """
+        Align the measures of a and b, adding a hollow copy of each measure
+        without a counterpart to the other tree, so that the measures of a
+        and b correspond one to one. Returns the pairs of measures.
+        """
+        a_bars = queries.MEASURES(a)
+        b_bars = queries.MEASURES(b)
+
+        pairs = []
+        a_previous = None
+        b_previous = None
+        for a_idx, b_idx in self._align_measures(a_bars, b_bars):
+            if a_idx is None:
+                a_bar = self._hollow_measure(b_bars[b_idx])
+                if not self._insert_measure(a_bar, a_previous, a_bars):
+                    continue
+            else:
+                a_bar = a_bars[a_idx]
+
+            if b_idx is None:
+                b_bar = self._hollow_measure(a_bar)
+                if not self._insert_measure(b_bar, b_previous, b_bars):
+                    continue
+            else:
+                b_bar = b_bars[b_idx]
+
+            pairs.append((a_bar, b_bar))
+            a_previous = a_bar
+            b_previous = b_bar
+
+        return pairs
+
+    @staticmethod
+    def _insert_measure(
+            bar: et.Element,
+            previous: t.Optional[et.Element],
+            bars: t.List[et.Element]) -> bool:
+        # Insert after the previously paired measure, or before the first
+        # measure if there is none. Returns False if there is nowhere to put
+        # the measure, as the tree has no measures.
+        if previous is not None:
+            previous.addnext(bar)
+        elif len(bars) > 0:
+            bars[0].addprevious(bar)
+        else:
+            return False
+        return True
+
+    def _log_trees(self, trees: t.List[t.Tuple[str, et.ElementTree]]):
+        # Serialising whole trees is expensive, so only done for tracing
+        if self.trace.tracing:
+            self.trace.trace_trees(trees)
+
+    def _apply_color_to_group(self, node, group_tags, colour):
         for g in group_tags:
-            g_qry = et.XPath(
-                f'ancestor-or-self::mei:{g}',
-                namespaces=MEI_NS
-            )
-            groups = g_qry(node)
+            groups = queries.ancestor_or_self_query(g)(node)
             if len(groups) > 0:
                 for elem in groups[0].iter():
                     elem.set('color', colour)
                     elem.set('visible', 'true')
 
-    def __naive_layer_merge(self, a: et.ElementTree, b: et.ElementTree) \
+    def _naive_layer_merge(self, a: et.ElementTree, b: et.ElementTree) \
             -> et.ElementTree:
-
-        base = deepcopy(a)
+        """
+        Merge the layers of b into a, returning a. Both trees are consumed,
+        as the layers of b are moved rather than copied.
+        """
+        base = a
         insert = b
-        base_id_prefix = 'a'
-        insert_id_prefix = 'b'
 
-        bar_qry = et.XPath('//mei:measure', namespaces=MEI_NS)
-        base_bars = bar_qry(base)
-        insert_bars = bar_qry(insert)
+        base_bars = queries.MEASURES(base)
+        insert_bars = queries.MEASURES(insert)
 
         # Loop through all bars in the piece
         id_idx = 0
         bar_idx = 0
         while bar_idx < min(len(base_bars), len(insert_bars)):  # TODO Rethink
-            base_bar = base_bars[bar_idx]
-            insert_bar = insert_bars[bar_idx]
+            id_idx = self._merge_measure(
+                base_bars[bar_idx],
+                insert_bars[bar_idx],
+                bar_idx,
+                id_idx
+            )
 
-            # Loop through each staff in the bar
-            staff_qry = et.XPath('child::mei:staff', namespaces=MEI_NS)
-            base_staffs = staff_qry(base_bar)
-            insert_staffs = staff_qry(insert_bar)
+            # TODO Merge trills. This is a large job, since they require
+            # specific element ids to render properly. This is more data
+            # to keep track of. For now, all trills are removed.
 
-            if len(base_staffs) != len(insert_staffs):
-                raise ValueError(
-                    'Unequal staff count in bar {}'.format(bar_idx)
-                )
+            bar_idx += 1
 
-            staff_idx = 0
-            while staff_idx < len(base_staffs):
-                base_staff = base_staffs[staff_idx]
-                insert_staff = insert_staffs[staff_idx]
-
-                # Loop through each layer in the staff
-                layer_qry = et.XPath('child::mei:layer', namespaces=MEI_NS)
-                base_layers = layer_qry(base_staff)
-                insert_layers = layer_qry(insert_staff)
-
-                if len(base_layers) != len(insert_layers):
-                    raise ValueError(
-                        'Unequal layer count in staff {}, bar {}'.format(
-                            staff_idx,
-                            bar_idx
-                        )
-                    )
+        return base
 
-                id_attrib = et.QName(MEI_NS['xml'], 'id')
-
-                layer_idx = 0
-                while layer_idx < len(base_layers):
-                    base_layer = base_layers[layer_idx]
-                    insert_layer = deepcopy(insert_layers[layer_idx])
-
-                    # Check if all elements in the insert layer are hidden.
-                    all_invisible = True
-                    for elem in insert_layer.iter():
-                        if elem.get('visible') == 'true' and \
-                                elem != insert_layer and \
-                                et.QName(elem).localname != 'space' and \
-                                et.QName(elem).localname != 'pad':
-                            all_invisible = False
-                            break
-
-                    if all_invisible:
-                        # Only add the base layer, as there are no differences
-                        base_layer.set(
-                            id_attrib.text,
-                            get_formatted_xml_id(id_idx, 'r')
-                        )
-                    else:
-                        base_layer.set(
-                            id_attrib.text,
-                            get_formatted_xml_id(id_idx, base_id_prefix)
-                        )
+    def _merge_measure(
+            self,
+            base_bar: et.Element,
+            insert_bar: et.Element,
+            bar_idx: int,
+            id_idx: int) -> int:
+        """
+        Merge the layers of insert_bar into base_bar, numbering the layer IDs
+        from id_idx. Returns the next unused layer ID number.
+
+        Layers with differences are moved from insert_bar, not copied.
+        """
+        self.deadline.check()
 
-                        insert_layer.set(
-                            id_attrib.text,
-                            get_formatted_xml_id(id_idx, insert_id_prefix)
-                        )
-                        # Update n tag on layer to allow trills
-                        # to connect properly
-                        insert_layer.set(
-                            'n',
-                            str(len(base_layers) + layer_idx + 1)
-                        )
-                        base_staff.append(insert_layer)
+        base_id_prefix = 'a'
+        insert_id_prefix = 'b'
 
-                    id_idx += 1
-                    layer_idx += 1
+        # Loop through each staff in the bar
+        base_staffs = queries.CHILD_STAFFS(base_bar)
+        insert_staffs = queries.CHILD_STAFFS(insert_bar)
 
-                staff_idx += 1
+        if len(base_staffs) != len(insert_staffs):
+            raise ValueError(
+                'Unequal staff count in bar {}'.format(bar_idx)
+            )
 
-            # TODO Merge trills. This is a large job, since they require
-            # specific element ids to render properly. This is more data
-            # to keep track of. For now, all trills are removed.
+        staff_idx = 0
+        while staff_idx < len(base_staffs):
+            base_staff = base_staffs[staff_idx]
+            insert_staff = insert_staffs[staff_idx]
 
-            bar_idx += 1
+            # Loop through each layer in the staff
+            base_layers = queries.CHILD_LAYERS(base_staff)
+            insert_layers = queries.CHILD_LAYERS(insert_staff)
 
-        return base
+            if len(base_layers) != len(insert_layers):
+                raise ValueError(
+                    'Unequal layer count in staff {}, bar {}'.format(
+                        staff_idx,
+                        bar_idx
+                    )
+                )
+
+            layer_idx = 0
+            while layer_idx < len(base_layers):
+                base_layer = base_layers[layer_idx]
+                insert_layer = insert_layers[layer_idx]
+
+                # Check if all elements in the insert layer are hidden.
+                all_invisible = True
+                for elem in insert_layer.iter():
+                    if elem.get('visible') == 'true' and \
+                            elem != insert_layer and \
+                            elem.tag != queries.SPACE and \
+                            elem.tag != queries.PAD:
+                        all_invisible = False
+                        break
+
+                if all_invisible:
+                    # Only add the base layer, as there are no differences
+                    base_layer.set(
+                        queries.XML_ID,
+                        get_formatted_xml_id(id_idx, 'r')
+                    )
+                else:
+                    base_layer.set(
+                        queries.XML_ID,
+                        get_formatted_xml_id(id_idx, base_id_prefix)
+                    )
+
+                    insert_layer.set(
+                        queries.XML_ID,
+                        get_formatted_xml_id(id_idx, insert_id_prefix)
+                    )
+                    # Update n tag on layer to allow trills
+                    # to connect properly
+                    insert_layer.set(
+                        'n',
+                        str(len(base_layers) + layer_idx + 1)
+                    )
+                    # Only the visible events of the insert layer are
+                    # shown, so the rest only need to keep them in time
+                    if self.compact_hidden:
+                        compact_hidden_events(insert_layer)
+                    base_staff.append(insert_layer)
+
+                id_idx += 1
+                layer_idx += 1
+
+            staff_idx += 1
+
+        return id_idx
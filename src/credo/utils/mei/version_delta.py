@@ -0,0 +1,136 @@
+import difflib
+import json
+import re
+import typing as t
+import zlib
+
+# Versions are diffed as sequences of chunks which each start at a measure,
+# so that an edit to one measure only changes one chunk
+CHUNK_START = re.compile(rb'(?=<measure\b)')
+
+# Normalisation numbers IDs in document order, so an edit moves the number of
+# every ID after it by the same offset, while references to IDs are left as
+# they are. Chunks are matched with the numbers of their IDs left out, and a
+# run of chunks whose IDs all moved by the same offset is stored as that
+# offset rather than as data.
+ID_NUMBER = re.compile(rb'( xml:id="m-)(0|[1-9][0-9]*)(?=")')
+
+COPY = 0
+INSERT = 1
+SHIFT = 2
+
+
+def split_chunks(data: bytes) -> t.List[bytes]:
+    """
+    Split a serialized MEI file into chunks at the start of each measure.
+    """
+    return CHUNK_START.split(data)
+
+
+def _get_offset(old: bytes, new: bytes) -> t.Optional[int]:
+    # Return the offset by which every ID number of a chunk moved, 0 if it
+    # has none, or None if they did not all move by the same offset
+    old_numbers = [int(m[2]) for m in ID_NUMBER.finditer(old)]
+    new_numbers = [int(m[2]) for m in ID_NUMBER.finditer(new)]
+    # An ID without a number leaves the same chunk once numbers are left out
+    if len(old_numbers) != len(new_numbers):
+        return None
+    offsets = {b - a for a, b in zip(old_numbers, new_numbers)}
+    if not offsets:
+        return 0
+    return offsets.pop() if len(offsets) == 1 else None
+
+
+def _shift(chunk: bytes, offset: int) -> bytes:
+    return ID_NUMBER.sub(
+        lambda m: m[1] + str(int(m[2]) + offset).encode(),
+        chunk
+    )
+
+
+def make_delta(old: bytes, new: bytes) -> bytes:
+    """
+    Return a compressed delta which rebuilds new from old, as a list of
+    operations which either copy a run of chunks of old, copy a run with
+    the numbers of their IDs moved by an offset, or insert new data.
+    """
+    old_chunks = split_chunks(old)
+    new_chunks = split_chunks(new)
+    matcher = difflib.SequenceMatcher(
+        None,
+        [ID_NUMBER.sub(rb'\1', chunk) for chunk in old_chunks],
+        [ID_NUMBER.sub(rb'\1', chunk) for chunk in new_chunks],
+        autojunk=False
+    )
+
+    operations = []
+
+    def insert(chunks):
+        # latin-1 maps every byte to a character, so any file survives being
+        # stored as JSON
+        operations.append([INSERT, b''.join(chunks).decode('latin-1')])
+
+    def copy(i1, i2, offset):
+        if i1 == i2:
+            return
+        if offset:
+            operations.append([SHIFT, i1, i2, offset])
+        else:
+            operations.append([COPY, i1, i2])
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            if j1 != j2:
+                insert(new_chunks[j1:j2])
+            continue
+
+        # Split the matched chunks into runs with the same offset. Chunks
+        # without IDs fit any run.
+        start, run_offset, run_has_ids = i1, 0, False
+        for i, j in zip(range(i1, i2), range(j1, j2)):
+            offset = _get_offset(old_chunks[i], new_chunks[j])
+            if offset is None:
+                copy(start, i, run_offset)
+                insert([new_chunks[j]])
+                start, run_offset, run_has_ids = i + 1, 0, False
+            elif ID_NUMBER.search(old_chunks[i]) is not None:
+                if run_has_ids and offset != run_offset:
+                    copy(start, i, run_offset)
+                    start = i
+                run_offset, run_has_ids = offset, True
+        copy(start, i2, run_offset)
+
+    return zlib.compress(json.dumps(operations).encode())
+
+
+def apply_delta(old: bytes, delta: bytes) -> bytes:
+    """
+    Rebuild a version from the version before it and the delta made between
+    them.
+    """
+    old_chunks = split_chunks(old)
+    parts = []
+    for operation in json.loads(zlib.decompress(delta)):
+        if operation[0] == COPY:
+            parts.extend(old_chunks[operation[1]:operation[2]])
+        elif operation[0] == SHIFT:
+            parts.extend(
+                _shift(chunk, operation[3])
+                for chunk in old_chunks[operation[1]:operation[2]]
+            )
+        elif operation[0] == INSERT:
+            parts.append(operation[1].encode('latin-1'))
+        else:
+            raise ValueError(f'Unknown delta operation {operation[0]}')
+    return b''.join(parts)
+
+
+def make_snapshot(data: bytes) -> bytes:
+    """
+    Return a compressed copy of a version.
+    """
+    return zlib.compress(data)
+
+
+def read_snapshot(snapshot: bytes) -> bytes:
+    return zlib.decompress(snapshot)
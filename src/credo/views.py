@@ -1,28 +1,51 @@
-from django.http import HttpResponse, \
+from django.http import FileResponse, \
+                        HttpResponse, \
                         HttpResponseBadRequest, \
                         HttpResponseForbidden, \
+                        HttpResponseNotFound, \
+                        HttpResponseNotModified, \
                         HttpResponseRedirect, \
-                        JsonResponse
+                        JsonResponse, \
+                        StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.views import View
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.core.files.base import ContentFile
 from django.contrib.auth import login as auth_login, authenticate
+from django.db import transaction
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
 
 from django.contrib.auth.signals import user_logged_out
 from django.dispatch import receiver
 from django.contrib import messages
+from django.conf import settings
 
 from lxml.etree import XMLSyntaxError
 
 import base64
 import json
+import secrets
 import lxml.etree as et
 
-from credo.utils.mei.tree_comparison import TreeComparison
-
-from .models import Comment, Edition, MEI, Revision, Song, Composer
-from credo.utils.mei.measure_utils import merge_measure_layers
+from credo.utils.mei.engines import AUTO_TIER, ENGINES, TIERS, choose_tier, \
+    get_engine, get_tier_engine
+from credo.utils.mei.comparison_cache import get_comparison_cache
+from credo.utils.mei.deadline import Deadline
+from credo.utils.mei.instrumentation import get_metrics_registry
+
+from .models import Comment, ComparisonJob, Edition, MEI, MEIVersion, \
+    Revision, Song, Composer
+from .comparison_jobs import cancel_comparison, encode_comparison, \
+    submit_comparison
+from .diff_bundle import CONTENT_TYPE as BUNDLE_CONTENT_TYPE, \
+    encode_comparison_bundle
+from .content_encoding import choose_encoding, encode_chunks
+from .json_stream import Base64Chunks, read_chunks, split_chunks, \
+    stream_json
+from .compute_pool import ComputeCrashed, ComputeTimeout, get_compute_pool
 from credo.utils.mei.resolve_utils import is_resolved
 
 from .forms import SignUpForm
@@ -81,11 +104,17 @@ def song(request, song_id):
 
 def song_compare_picker(request, song_id):
     song = Song.objects.get(id=song_id)
-    editions = Edition.objects.filter(song=song, mei__normalised=True)
+    # Files still being normalised, or which failed, cannot be compared
+    editions = Edition.objects.filter(
+        song=song,
+        mei__normalised=True,
+        mei__status=MEI.READY
+    )
     if request.user.is_authenticated:
         revisions = Revision.objects.filter(
             editions__in=editions,
             mei__normalised=True,
+            mei__status=MEI.READY,
             user=request.user
         ).distinct('id')
     else:
@@ -200,14 +229,7 @@ class RevisionView(View):
 
         revision = Revision.objects.get(id=revision_id)
 
-        # Delete existing comments
-        revision.comment_set.all().delete()
-
-        for comment in comments:
-            Comment(revision_id=revision_id,
-                    text=comments[comment],
-                    user=request.user,
-                    mei_element_id=comment).save()
+        _save_revision_comments(revision, comments, request.user)
 
         # This assumes that once the MEI is resolved, there
         # is no way for it to be un-resolved.
@@ -219,6 +241,114 @@ class RevisionView(View):
 
         return JsonResponse({'ok': True})
 
+    def patch(self, request, revision_id):
+        """
+        Save the measures of the revision changed since it was loaded, keyed
+        by their IDs, without re-sending or re-normalising the rest of it.
+        """
+        if not request.user.is_authenticated:
+            return HttpResponseForbidden()
+
+        try:
+            revision_id = int(revision_id)
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        try:
+            revision = Revision.objects.get(id=revision_id)
+        except Revision.DoesNotExist:
+            return HttpResponseNotFound()
+
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not isinstance(data, dict):
+            return HttpResponseBadRequest()
+        measures = data.get('measures', {})
+        comments = data.get('comments', {})
+        if not _is_string_map(measures) or not _is_string_map(comments):
+            return HttpResponseBadRequest()
+
+        mei = revision.mei
+        not_ready = _get_not_ready_response([mei])
+        if not_ready is not None:
+            return not_ready
+
+        if measures:
+            try:
+                mei.patch_measures(measures)
+            except ValueError:
+                return HttpResponseBadRequest()
+
+        if 'comments' in data:
+            _save_revision_comments(revision, comments, request.user)
+
+        # Once the last layer is resolved, the file is normalised as when it
+        # is saved in full, which renumbers its IDs
+        renormalised = not mei.normalised and mei.get_unresolved_layers() == 0
+        if renormalised:
+            mei.normalised = True
+            mei.save()
+
+        # With background normalisation, a renormalised revision must not be
+        # reloaded until its status URL reports it as ready
+        return JsonResponse({
+            'ok': True,
+            'resolved': mei.normalised,
+            'renormalised': renormalised,
+            'status': mei.status,
+            'status_url': f'/mei/{mei.id}/status'
+        })
+
+
+def _is_string_map(value) -> bool:
+    return isinstance(value, dict) and all(
+        isinstance(key, str) and isinstance(item, str)
+        for key, item in value.items()
+    )
+
+
+def _save_revision_comments(revision, comments, user):
+    """
+    Make the comments on a revision match the {element ID: text} map sent by
+    the revision page, only writing the comments which were added, changed or
+    removed, so unchanged comments keep their IDs and creation times.
+    """
+    with transaction.atomic():
+        stored = {}
+        removed = []
+        for comment in revision.comment_set.select_for_update().order_by('id'):
+            element_id = comment.mei_element_id
+            # Only one comment is kept per element
+            if element_id in comments and element_id not in stored:
+                stored[element_id] = comment
+            else:
+                removed.append(comment.id)
+
+        # bulk_update skips auto_now, which save would have set
+        now = timezone.now()
+        changed = []
+        for element_id, comment in stored.items():
+            if comment.text != comments[element_id]:
+                comment.text = comments[element_id]
+                comment.user = user
+                comment.updated_at = now
+                changed.append(comment)
+
+        Comment.objects.bulk_create([
+            Comment(
+                revision=revision,
+                text=text,
+                user=user,
+                mei_element_id=element_id
+            )
+            for element_id, text in comments.items()
+            if element_id not in stored
+        ])
+        Comment.objects.bulk_update(changed, ['text', 'user', 'updated_at'])
+        Comment.objects.filter(id__in=removed).delete()
+
 
 def revision_comments(request, revision_id):
     revision = Revision.objects.get(id=revision_id)
@@ -234,22 +364,155 @@ def revision_comments(request, revision_id):
     })
 
 
+def _get_mei_etag(mei, representation):
+    """
+    Return a strong ETag for a representation of the stored file of an MEI,
+    or None if its content hash may not be current.
+    """
+    # Each representation of the same contents is made of different bytes,
+    # so needs its own strong ETag
+    if not mei.is_ready:
+        return None
+    return f'"{mei.get_content_hash()}-{representation}"'
+
+
+def _get_not_modified_response(request, etag):
+    """
+    Return a 304 response if the request's If-None-Match header matches the
+    ETag, or None.
+    """
+    if etag is None:
+        return None
+
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag not in etags and '*' not in etags:
+        return None
+
+    response = HttpResponseNotModified()
+    _set_mei_cache_headers(response, etag)
+    return response
+
+
+def _set_mei_cache_headers(response, etag):
+    # Clients may cache MEI files, but must revalidate them, as the contents
+    # of an MEI change under the same URL
+    if etag is not None:
+        response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+
+
 def mei(request, mei_id):
     mei = MEI.objects.get(id=mei_id)
-    with mei.data.open() as f:
-        mei_data = f.read()
-    mei_data = str(base64.b64encode(mei_data), encoding='utf-8')
+    etag = _get_mei_etag(mei, 'json')
+    not_modified = _get_not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    f = mei.data.storage.open(mei.data.name, 'rb')
     data = {
         'content': {
             'mei': {
-                'detail': mei_data,
+                'detail': Base64Chunks(read_chunks(f)),
                 'encoding': 'base64'
             }
         }
     }
-    return HttpResponse(json.dumps(data), content_type='application/json')
+    response = StreamingHttpResponse(
+        stream_json(data),
+        content_type='application/json'
+    )
+    _set_mei_cache_headers(response, etag)
+    return response
+
+
+@require_http_methods(['GET'])
+def mei_raw(request, mei_id):
+    try:
+        mei = MEI.objects.get(id=int(mei_id))
+    except (ValueError, MEI.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    etag = _get_mei_etag(mei, f'xml-{encoding}' if encoding else 'xml')
+    not_modified = _get_not_modified_response(request, etag)
+    if not_modified is not None:
+        patch_vary_headers(not_modified, ['Accept-Encoding'])
+        return not_modified
+
+    # Open the file after reading its hash, so that if it is rewritten in
+    # between, the ETag sent is out of date rather than the contents
+    f = mei.data.storage.open(mei.data.name, 'rb')
+    if encoding is None:
+        response = FileResponse(f, content_type='application/xml')
+    else:
+        response = StreamingHttpResponse(
+            encode_chunks(f, encoding),
+            content_type='application/xml'
+        )
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    _set_mei_cache_headers(response, etag)
+    return response
+
+
+@require_http_methods(['GET'])
+def mei_status(request, mei_id):
+    try:
+        mei = MEI.objects.get(id=int(mei_id))
+    except (ValueError, MEI.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    return JsonResponse({'content': {'status': mei.status}})
 
 
+@require_http_methods(['GET'])
+def mei_versions(request, mei_id):
+    try:
+        mei = MEI.objects.get(id=int(mei_id))
+    except (ValueError, MEI.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    versions = mei.versions \
+        .order_by('number') \
+        .values('number', 'content_hash', 'size', 'created_at')
+    return JsonResponse({
+        'content': {
+            'versions': [
+                dict(version, created_at=version['created_at'].isoformat())
+                for version in versions
+            ]
+        }
+    })
+
+
+@require_http_methods(['GET'])
+def mei_version(request, mei_id, number):
+    try:
+        mei = MEI.objects.get(id=int(mei_id))
+        number = int(number)
+    except (ValueError, MEI.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    try:
+        mei_data = mei.get_version(number)
+    except MEIVersion.DoesNotExist:
+        return HttpResponseNotFound(content_type='application/json')
+
+    data = {
+        'content': {
+            'mei': {
+                'detail': Base64Chunks(split_chunks(mei_data)),
+                'encoding': 'base64'
+            }
+        }
+    }
+    return StreamingHttpResponse(
+        stream_json(data),
+        content_type='application/json'
+    )
+
+
+@ensure_csrf_cookie
 def compare(request):
     edition_ids = request.GET.getlist('e')
     revision_ids = request.GET.getlist('r')
@@ -279,12 +542,29 @@ def compare(request):
     if song:
         title = song.name
 
-    querystring = '&'.join(edition_queries + revision_queries)
+    # Pass on the choice of comparison engine or quality tier, if any
+    engine_queries = []
+    engine = request.GET.get('engine')
+    if engine in ENGINES:
+        engine_queries.append(f'engine={engine}')
+    quality = request.GET.get('quality')
+    if quality in TIERS or quality == AUTO_TIER:
+        engine_queries.append(f'quality={quality}')
+
+    querystring = '&'.join(
+        edition_queries + revision_queries + engine_queries
+    )
     mei_ids = [edition.mei.id for edition in editions] + \
               [revision.mei.id for revision in revisions]
     mei_queries = [f's={id}' for id in mei_ids]
-    mei_query_string = '&'.join(mei_queries)
-    mei_url = f'/diff?{mei_query_string}'
+    mei_query_string = '&'.join(mei_queries + engine_queries)
+    if settings.COMPARISON_JOBS['ENABLED']:
+        mei_url = f'/diff/jobs?{mei_query_string}'
+    else:
+        # The sources are fetched from /mei/<id>/raw, which the browser
+        # revalidates rather than downloads again
+        mei_url = f'/diff?{mei_query_string}' \
+            '&format=bundle&omit_sources=true'
 
     return render(request, 'song_compare.html', {
         'authenticated': request.user.is_authenticated,
@@ -303,48 +583,221 @@ def compare(request):
     })
 
 
-@require_http_methods(['GET'])
-def diff(request):
+def _get_diff_sources(request):
+    """
+    Return the two normalised MEIs given by the 's' query parameters, or None
+    if they are not valid sources for a comparison.
+    """
     sources = request.GET.getlist('s')
 
     try:
         sources = [int(s) for s in sources]
     except ValueError:
-        return HttpResponseBadRequest(content_type='application/json')
+        return None
 
     try:
         meis = [MEI.objects.get(id=s) for s in sources]
     except MEI.DoesNotExist:
-        return HttpResponseBadRequest(content_type='application/json')
+        return None
 
     if len(meis) != 2:
-        return HttpResponseBadRequest(content_type='application/json')
+        return None
 
     if not meis[0].normalised or not meis[1].normalised:
+        return None
+
+    return meis
+
+
+def _get_not_ready_response(meis):
+    """
+    Return a 409 response if any of the MEIs has not finished normalising,
+    giving whether they are still processing or have failed, or None if they
+    are all ready.
+    """
+    statuses = {mei.status for mei in meis}
+    if statuses == {MEI.READY}:
+        return None
+
+    status = MEI.FAILED if MEI.FAILED in statuses else MEI.PROCESSING
+    return JsonResponse({'content': {'status': status}}, status=409)
+
+
+def _choose_diff_engine(request, meis):
+    """
+    Return the name of the comparison engine given by the 'engine' or
+    'quality' query parameters, or of the default engine, and its quality
+    tier if it was chosen by one. Raises ValueError for an unknown engine or
+    tier.
+    """
+    name = request.GET.get('engine')
+    if name is not None:
+        if name not in ENGINES:
+            raise ValueError(f'Unknown comparison engine {name}')
+        return name, None
+
+    tier = request.GET.get('quality', settings.COMPARISON_QUALITY_TIER)
+    if tier is None:
+        return settings.COMPARISON_ENGINE, None
+
+    if tier == AUTO_TIER:
+        tier = choose_tier(sum(mei.get_node_count() for mei in meis))
+    if tier not in TIERS:
+        raise ValueError(f'Unknown quality tier {tier}')
+    return TIERS[tier][0], tier
+
+
+def _get_diff_engine(request, meis):
+    """
+    Return the comparison engine chosen by _choose_diff_engine, and its
+    quality tier if it was chosen by one. Raises ValueError for an unknown
+    engine or tier.
+    """
+    name, tier = _choose_diff_engine(request, meis)
+    if tier is not None:
+        return get_tier_engine(tier), tier
+    return get_engine(name), None
+
+
+@require_http_methods(['GET'])
+def diff(request):
+    meis = _get_diff_sources(request)
+    if meis is None:
         return HttpResponseBadRequest(content_type='application/json')
 
-    engine = TreeComparison()
-    out_meis = engine.compare_meis(meis[0], meis[1])
-    diff, *sources = [et.tostring(mei, encoding='utf-8') for mei in out_meis]
-    diff = str(base64.b64encode(diff), encoding='utf-8')
-    sources = [
-        {
-            'detail': str(base64.b64encode(s), encoding='utf-8'),
-            'encoding': 'base64'
-        }
-        for s in sources
-    ]
+    not_ready = _get_not_ready_response(meis)
+    if not_ready is not None:
+        return not_ready
+
+    # The bundle format sends the parts gzipped, and may refer to the
+    # sources instead of sending them, see credo.diff_bundle
+    response_format = request.GET.get('format', 'json')
+    omit_sources = request.GET.get('omit_sources') == 'true'
+    if response_format not in ['json', 'bundle'] or \
+            (omit_sources and response_format != 'bundle'):
+        return HttpResponseBadRequest(content_type='application/json')
+
+    try:
+        engine, tier = _get_diff_engine(request, meis)
+    except ValueError:
+        return HttpResponseBadRequest(content_type='application/json')
+    engine.deadline = Deadline(settings.COMPARISON_DEADLINE)
 
+    with engine.trace:
+        try:
+            out_meis = engine.compare_meis(meis[0], meis[1])
+        except (ComputeTimeout, ComputeCrashed):
+            return HttpResponse(status=503, content_type='application/json')
+
+        if response_format == 'bundle':
+            with engine.trace.phase('encode'):
+                data = encode_comparison_bundle(
+                    out_meis,
+                    tier,
+                    engine.coarse,
+                    source_meis=meis if omit_sources else None
+                )
+            return HttpResponse(data, content_type=BUNDLE_CONTENT_TYPE)
+
+        # The JSON envelope is encoded as it is sent, so the trace is only
+        # published once it has been
+        envelope = encode_comparison(out_meis, tier, engine.coarse)
+        chunks = engine.trace.stream_phase('encode', stream_json(envelope))
+
+    return StreamingHttpResponse(chunks, content_type='application/json')
+
+
+def _comparison_job_data(job, waiter=None):
     data = {
         'content': {
-            'diff': {
-                'detail': diff,
-                'encoding': 'base64'
-            },
-            'sources': sources
+            'job': {
+                'id': job.id,
+                'status': job.status,
+                'error': job.error,
+                'status_url': f'/diff/jobs/{job.id}',
+                'result_url': f'/diff/jobs/{job.id}/result'
+            }
         }
     }
-    return HttpResponse(json.dumps(data), content_type='application/json')
+    # Only the page that submitted the job may stop waiting on it
+    if waiter is not None:
+        data['content']['job']['cancel_url'] = \
+            f'/diff/jobs/{job.id}/cancel?waiter={waiter}'
+    return data
+
+
+@require_http_methods(['POST'])
+def submit_comparison_job(request):
+    meis = _get_diff_sources(request)
+    if meis is None:
+        return HttpResponseBadRequest(content_type='application/json')
+
+    not_ready = _get_not_ready_response(meis)
+    if not_ready is not None:
+        return not_ready
+
+    try:
+        engine, tier = _choose_diff_engine(request, meis)
+    except ValueError:
+        return HttpResponseBadRequest(content_type='application/json')
+
+    waiter = secrets.token_urlsafe()
+    job = submit_comparison(meis[0], meis[1], engine, waiter, tier)
+    return JsonResponse(_comparison_job_data(job, waiter), status=202)
+
+
+@require_http_methods(['GET'])
+def comparison_job_status(request, job_id):
+    try:
+        job = ComparisonJob.objects.get(id=int(job_id))
+    except (ValueError, ComparisonJob.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    return JsonResponse(_comparison_job_data(job))
+
+
+@require_http_methods(['POST'])
+def cancel_comparison_job(request, job_id):
+    try:
+        job = ComparisonJob.objects.get(id=int(job_id))
+    except (ValueError, ComparisonJob.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    # The job is shared by everyone comparing the same contents, so the
+    # caller only stops waiting on it
+    waiter = request.GET.get('waiter')
+    if waiter is None or not job.waiters.filter(token=waiter).exists():
+        return HttpResponseForbidden(content_type='application/json')
+
+    job = cancel_comparison(job, waiter)
+    return JsonResponse(_comparison_job_data(job))
+
+
+@require_http_methods(['GET'])
+def comparison_job_result(request, job_id):
+    try:
+        job = ComparisonJob.objects.get(id=int(job_id))
+    except (ValueError, ComparisonJob.DoesNotExist):
+        return HttpResponseNotFound(content_type='application/json')
+
+    if job.status != ComparisonJob.DONE:
+        return JsonResponse(_comparison_job_data(job), status=409)
+
+    return FileResponse(job.result.open(), content_type='application/json')
+
+
+@require_http_methods(['GET'])
+def comparison_cache_stats(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden(content_type='application/json')
+    return JsonResponse({'content': get_comparison_cache().stats()})
+
+
+@require_http_methods(['GET'])
+def comparison_metrics(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden(content_type='application/json')
+    return JsonResponse({'content': get_metrics_registry().snapshot()})
 
 
 @require_http_methods(['POST'])
@@ -359,10 +812,12 @@ def merge_measure_layers_json(request):
     except KeyError:
         return HttpResponseBadRequest(content_type='application/json')
 
-    measure_tree = et.XML(measure)
-
     try:
-        merged_measure_tree = merge_measure_layers(measure_tree)
+        merged_measure = get_compute_pool().merge_measure_layers(
+            measure.encode()
+        )
+    except (ComputeTimeout, ComputeCrashed):
+        return HttpResponse(status=503, content_type='application/json')
     except ValueError:
         data = {
             'content': {
@@ -374,7 +829,6 @@ def merge_measure_layers_json(request):
             content_type='application/json'
         )
 
-    merged_measure = et.tostring(merged_measure_tree, encoding='utf-8')
     measure_b64 = str(base64.b64encode(merged_measure), encoding='utf-8')
 
     data = {
@@ -418,24 +872,18 @@ def make_revision(request):
     meis = [edition.mei for edition in editions] + \
            [revision.mei for revision in revisions]
 
-    file_content = None
-
-    new_mei = MEI()
+    not_ready = _get_not_ready_response(meis)
+    if not_ready is not None:
+        return not_ready
 
     if len(meis) == 1:
         # Ensure the MEI we are copying is normalised.
         if not meis[0].normalised:
             return HttpResponseBadRequest(content_type='application/json')
 
-        # Ensure we normalise before saving
-        new_mei.normalised = True
-
-        # copy if just revising a single MEI
-        file_content = ContentFile(meis[0].data.file.read())
-        new_mei.data.save('mei', file_content)
-
-        # IMPORTANT - must close the file, otherwise Django breaks
-        meis[0].data.file.close()
+        # The revision shares the file of the MEI it revises until either is
+        # edited, so nothing is read, written or normalised here
+        new_mei = meis[0].fork()
 
     elif len(meis) == 2:
         # Ensure the MEIs we are generating the diff from are normalised
@@ -444,19 +892,25 @@ def make_revision(request):
 
         # Do not normalise, since we are making a revision from a comparison.
         # Normalisation occurs after resolving the revision.
-        new_mei.normalised = False
+        new_mei = MEI(normalised=False)
 
         # Compare
-        engine = TreeComparison()
-        out_meis = engine.compare_meis(meis[0], meis[1])
+        try:
+            engine, _ = _get_diff_engine(request, meis)
+        except ValueError:
+            return HttpResponseBadRequest(content_type='application/json')
+        engine.deadline = Deadline(settings.COMPARISON_DEADLINE)
+        try:
+            out_meis = engine.compare_meis(meis[0], meis[1])
+        except (ComputeTimeout, ComputeCrashed):
+            return HttpResponse(status=503, content_type='application/json')
         diff, *sources = [et.tostring(mei, encoding='utf-8')
                           for mei in out_meis]
+        # Saving the file saves the MEI
         new_mei.data.save('mei', ContentFile(diff))
     else:
         return HttpResponseBadRequest(content_type='application/json')
 
-    new_mei.save()
-
     new_revision = Revision(user=request.user, mei=new_mei, name=name)
     new_revision.save()
     new_revision.editions.set(base_editions)
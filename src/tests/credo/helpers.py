@@ -0,0 +1,58 @@
+import tempfile
+import typing as t
+
+from django.core.files.base import ContentFile
+from django.test import Client, override_settings
+
+from credo.models import MEI, User
+
+
+def create_meis() -> t.List[MEI]:
+    """
+    Save the two test scores as MEIs.
+    """
+    meis = []
+    for name in ['test_a.mei', 'test_b.mei']:
+        with open(f'tests/credo/utils/mei/data/{name}') as f:
+            mei = MEI()
+            mei.data.save(name, ContentFile(f.read()))
+            meis.append(mei)
+    return meis
+
+
+class TemporaryMediaRoot:
+    """
+    Mixin for test cases which store files, keeping them in a temporary
+    MEDIA_ROOT which is deleted after the tests.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._media_root = tempfile.TemporaryDirectory()
+        cls._media_settings = override_settings(
+            MEDIA_ROOT=cls._media_root.name
+        )
+        cls._media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_settings.disable()
+        cls._media_root.cleanup()
+
+
+class LoggedInClient:
+    """
+    Mixin for test cases which make requests as a logged in user, which is
+    created before each test.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User(username='testuser')
+        self.user.set_password('12345')
+        self.user.save()
+
+        self.client = Client()
+        self.client.login(username='testuser', password='12345')
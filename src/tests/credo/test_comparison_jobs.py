@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import json
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from credo.comparison_jobs import cancel_comparison, \
+    claim_comparison_job, clean_comparison_jobs, run_comparison_job, \
+    submit_comparison
+from credo.compute_pool import ComputePool
+from credo.models import ComparisonJob
+from credo.utils.mei.comparison_cache import ComparisonCache
+from credo.utils.mei.tree_comparison import TreeComparison
+from tests.credo.helpers import LoggedInClient, TemporaryMediaRoot, \
+    create_meis
+
+
+class TestComparisonJobs(LoggedInClient, TemporaryMediaRoot, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.meis = create_meis()
+
+    def test_submit_deduplicates(self):
+        """Ensure submitting the same pair twice returns the same job."""
+        first = submit_comparison(self.meis[0], self.meis[1])
+        second = submit_comparison(self.meis[0], self.meis[1])
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(ComparisonJob.objects.count(), 1)
+
+    def test_submit_per_engine(self):
+        """Ensure the same pair compared by another engine is a new job."""
+        first = submit_comparison(self.meis[0], self.meis[1])
+        second = submit_comparison(self.meis[0], self.meis[1], 'sequence')
+
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(first.engine, 'tree')
+        self.assertEqual(second.engine, 'sequence')
+
+    def test_submit_quality(self):
+        """Ensure a job submitted with a quality tier runs that tier's engine,
+        is only shared with submissions of the same tier, and reports it.
+        """
+        sources = f's={self.meis[0].id}&s={self.meis[1].id}'
+
+        def submit(query):
+            return self.client.post(f'/diff/jobs?{sources}&{query}')
+
+        def submit_id(query):
+            return submit(query).json()['content']['job']['id']
+
+        job_id = submit_id('quality=balanced')
+        self.assertEqual(submit_id('quality=balanced'), job_id)
+        self.assertNotEqual(submit_id('quality=fast'), job_id)
+        self.assertEqual(submit('quality=best').status_code, 400)
+
+        job = ComparisonJob.objects.get(id=job_id)
+        self.assertEqual((job.engine, job.tier), ('measure', 'balanced'))
+
+        while True:
+            claimed = claim_comparison_job('test')
+            if claimed is None:
+                break
+            run_comparison_job(claimed)
+        response = self.client.get(f'/diff/jobs/{job_id}/result')
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content))
+            ['content']['tier'],
+            'balanced'
+        )
+
+    def test_rewrite_creates_new_job(self):
+        """Ensure rewriting an MEI gives a new job for the new contents."""
+        first = submit_comparison(self.meis[0], self.meis[1])
+
+        with open('tests/credo/utils/mei/data/test_b.mei') as f:
+            self.meis[0].data.save('test_a.mei', ContentFile(f.read()))
+
+        second = submit_comparison(self.meis[0], self.meis[1])
+        self.assertNotEqual(first.id, second.id)
+
+    def test_superseded(self):
+        """Ensure a job fails, without a result, if either MEI is rewritten
+        before or while it is compared.
+        """
+        def rewrite(mei, name):
+            with open(f'tests/credo/utils/mei/data/{name}') as f:
+                mei.data.save(name, ContentFile(f.read()))
+
+        job = submit_comparison(self.meis[0], self.meis[1])
+        rewrite(self.meis[0], 'test_b.mei')
+        run_comparison_job(claim_comparison_job('test'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ComparisonJob.FAILED)
+        self.assertTrue(job.error.startswith('Superseded'))
+        self.assertFalse(job.result)
+
+        job = submit_comparison(self.meis[1], self.meis[0])
+        compare_meis = TreeComparison.compare_meis
+
+        def compare_and_rewrite(engine, *meis):
+            result = compare_meis(engine, *meis)
+            rewrite(self.meis[1], 'test_a.mei')
+            return result
+
+        with mock.patch.object(
+                TreeComparison,
+                'compare_meis',
+                compare_and_rewrite):
+            run_comparison_job(claim_comparison_job('test'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ComparisonJob.FAILED)
+        self.assertFalse(job.result)
+
+    def test_claim_and_run(self):
+        """Ensure a claimed job is run to completion and not claimed twice."""
+        job = submit_comparison(self.meis[0], self.meis[1])
+
+        claimed = claim_comparison_job('test')
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, ComparisonJob.RUNNING)
+        self.assertIsNone(claim_comparison_job('test'))
+
+        run_comparison_job(claimed)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, ComparisonJob.DONE)
+
+        with claimed.result.open() as f:
+            result = json.loads(f.read())
+        self.assertIn('diff', result['content'])
+        self.assertEqual(len(result['content']['sources']), 2)
+
+    @override_settings(
+        COMPARISON_JOBS=dict(settings.COMPARISON_JOBS, DEADLINE=30)
+    )
+    def test_deadline_outlasts_pool_timeout(self):
+        """Ensure a job may run for longer than the compute pool's timeout,
+        as long as it is within its own deadline.
+        """
+        compare_trees = TreeComparison.compare_trees
+
+        def slow_compare_trees(engine, a, b):
+            time.sleep(0.3)
+            return compare_trees(engine, a, b)
+
+        submit_comparison(self.meis[0], self.meis[1])
+        # An empty cache, so the pair is compared rather than looked up
+        with mock.patch(
+                'credo.utils.mei.comparison_strategy.get_comparison_cache',
+                return_value=ComparisonCache()), \
+                mock.patch(
+                    'credo.utils.mei.comparison_strategy.get_compute_pool',
+                    return_value=ComputePool(timeout=0.1)), \
+                mock.patch.object(
+                    TreeComparison,
+                    'compare_trees',
+                    slow_compare_trees):
+            job = claim_comparison_job('test')
+            run_comparison_job(job)
+
+        self.assertEqual(job.status, ComparisonJob.DONE, job.error)
+
+    def test_cancel(self):
+        """Ensure a cancelled job is not run, and is re-queued when submitted
+        again.
+        """
+        sources = f's={self.meis[0].id}&s={self.meis[1].id}'
+        response = self.client.post(f'/diff/jobs?{sources}')
+        cancel_url = response.json()['content']['job']['cancel_url']
+        response = self.client.post(cancel_url)
+        self.assertEqual(
+            response.json()['content']['job']['status'],
+            ComparisonJob.CANCELLED
+        )
+        self.assertIsNone(claim_comparison_job('test'))
+
+        job = submit_comparison(self.meis[0], self.meis[1])
+        self.assertEqual(job.status, ComparisonJob.PENDING)
+
+        # A job cancelled while running is not marked as done
+        claimed = claim_comparison_job('test')
+        cancel_comparison(claimed)
+        run_comparison_job(claimed)
+        self.assertEqual(claimed.status, ComparisonJob.CANCELLED)
+        self.assertFalse(claimed.result)
+
+    def test_cancel_shared(self):
+        """Ensure a job shared by two pages is only cancelled once neither
+        is waiting on it, and cannot be cancelled by anyone else.
+        """
+        sources = f's={self.meis[0].id}&s={self.meis[1].id}'
+        jobs = [
+            self.client.post(f'/diff/jobs?{sources}').json()['content']['job']
+            for _ in range(2)
+        ]
+        self.assertEqual(jobs[0]['id'], jobs[1]['id'])
+        self.assertNotEqual(jobs[0]['cancel_url'], jobs[1]['cancel_url'])
+        self.assertNotIn('cancel_url', self.client.get(
+            jobs[0]['status_url']
+        ).json()['content']['job'])
+
+        for url in [
+                f'/diff/jobs/{jobs[0]["id"]}/cancel',
+                f'/diff/jobs/{jobs[0]["id"]}/cancel?waiter=guess']:
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, 403)
+
+        response = self.client.post(jobs[0]['cancel_url'])
+        self.assertEqual(
+            response.json()['content']['job']['status'],
+            ComparisonJob.PENDING
+        )
+        # Cancelling twice does not count as the other page
+        response = self.client.post(jobs[0]['cancel_url'])
+        self.assertEqual(response.status_code, 403)
+
+        run_comparison_job(claim_comparison_job('test'))
+        response = self.client.get(jobs[1]['status_url'])
+        self.assertEqual(
+            response.json()['content']['job']['status'],
+            ComparisonJob.DONE
+        )
+        response = self.client.get(jobs[1]['result_url'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_cancel_last_waiter(self):
+        """Ensure a job is cancelled when its last waiter stops waiting, and
+        waiters from before it was cancelled do not keep it running after it
+        is re-queued.
+        """
+        job = submit_comparison(self.meis[0], self.meis[1], waiter='a')
+        submit_comparison(self.meis[0], self.meis[1], waiter='b')
+        self.assertEqual(cancel_comparison(job, 'a').status, 'pending')
+        self.assertEqual(cancel_comparison(job, 'b').status, 'cancelled')
+
+        job = submit_comparison(self.meis[0], self.meis[1], waiter='c')
+        self.assertEqual(job.status, ComparisonJob.PENDING)
+        self.assertEqual(
+            list(job.waiters.values_list('token', flat=True)),
+            ['c']
+        )
+        self.assertEqual(cancel_comparison(job, 'c').status, 'cancelled')
+
+    def test_result_replaced(self):
+        """Ensure the result of an earlier run of a job is deleted when the
+        job is run again.
+        """
+        job = submit_comparison(self.meis[0], self.meis[1])
+        run_comparison_job(claim_comparison_job('test'))
+        job.refresh_from_db()
+        previous = job.result.name
+        self.assertTrue(job.result.storage.exists(previous))
+
+        ComparisonJob.objects.filter(pk=job.pk) \
+            .update(status=ComparisonJob.FAILED)
+        submit_comparison(self.meis[0], self.meis[1])
+        run_comparison_job(claim_comparison_job('test'))
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, ComparisonJob.DONE)
+        self.assertNotEqual(job.result.name, previous)
+        self.assertTrue(job.result.storage.exists(job.result.name))
+        self.assertFalse(job.result.storage.exists(previous))
+
+    def test_clean(self):
+        """Ensure expired and superseded jobs are deleted with their results,
+        and pending jobs are kept.
+        """
+        job = submit_comparison(self.meis[0], self.meis[1])
+        run_comparison_job(claim_comparison_job('test'))
+        job.refresh_from_db()
+        self.assertEqual(clean_comparison_jobs(), 0)
+
+        with open('tests/credo/utils/mei/data/test_b.mei') as f:
+            self.meis[0].data.save('test_a.mei', ContentFile(f.read()))
+        self.assertEqual(clean_comparison_jobs(), 1)
+        self.assertFalse(ComparisonJob.objects.filter(pk=job.pk).exists())
+        self.assertFalse(job.result.storage.exists(job.result.name))
+
+        job = submit_comparison(self.meis[0], self.meis[1])
+        run_comparison_job(claim_comparison_job('test'))
+        self.assertEqual(clean_comparison_jobs(), 0)
+
+        pending = submit_comparison(self.meis[1], self.meis[0])
+        stdout = StringIO()
+        call_command('clean_comparison_jobs', ttl=0, stdout=stdout)
+        self.assertIn('Deleted 1 comparison jobs', stdout.getvalue())
+        self.assertEqual(
+            list(ComparisonJob.objects.values_list('pk', flat=True)),
+            [pending.pk]
+        )
+
+    def test_endpoints(self):
+        """Ensure jobs can be submitted, polled and collected over HTTP."""
+        sources = f's={self.meis[0].id}&s={self.meis[1].id}'
+        response = self.client.post(f'/diff/jobs?{sources}')
+        self.assertEqual(response.status_code, 202)
+        job = response.json()['content']['job']
+        self.assertEqual(job['status'], ComparisonJob.PENDING)
+
+        response = self.client.get(job['result_url'])
+        self.assertEqual(response.status_code, 409)
+
+        run_comparison_job(claim_comparison_job('test'))
+
+        response = self.client.get(job['status_url'])
+        self.assertEqual(response.json()['content']['job']['status'], 'done')
+
+        response = self.client.get(job['result_url'])
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(b''.join(response.streaming_content))
+        self.assertIn('diff', result['content'])
+
+        response = self.client.get('/diff/jobs/0')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestComparisonWorker(TemporaryMediaRoot, TransactionTestCase):
+    # The worker closes stale database connections between jobs, so it
+    # cannot run inside the transaction wrapping each TestCase.
+
+    def test_worker_command(self):
+        """Ensure the worker command drains the queue when run with --once."""
+        meis = create_meis()
+        job = submit_comparison(meis[0], meis[1])
+
+        call_command('comparison_worker', once=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ComparisonJob.DONE)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import time
+from unittest import TestCase, mock
+
+import lxml.etree as et
+
+from credo.compute_pool import ComputeCrashed, ComputePool, ComputeTimeout
+from credo.utils.mei.deadline import ComparisonCancelled, Deadline
+from credo.utils.mei.tree_comparison import TreeComparison
+from utils.mei.mei_transformer import MeiTransformer
+
+
+def sleep_task(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def crash_task():
+    os._exit(1)
+
+
+def normalised_bytes(name):
+    transformer = MeiTransformer.from_xml_file(
+        f'./tests/credo/utils/mei/data/{name}'
+    )
+    transformer.normalise()
+    return et.tostring(transformer.tree, encoding='utf-8')
+
+
+class TestComputePool(TestCase):
+    def setUp(self):
+        self.pool = ComputePool(processes=1, timeout=30)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_compare_matches_inline(self):
+        """Ensure a comparison in the pool matches one run inline."""
+        a = normalised_bytes('test_a.mei')
+        b = normalised_bytes('test_b.mei')
+
+        pooled, phases = self.pool.compare(TreeComparison(), a, b)
+        inline, _ = ComputePool().compare(TreeComparison(), a, b)
+        self.assertEqual(pooled, inline)
+        self.assertIn('diff', [phase['phase'] for phase in phases])
+
+    def test_timeout(self):
+        """Ensure a slow task times out without breaking the pool."""
+        with self.assertRaises(ComputeTimeout):
+            self.pool.run(sleep_task, 5, timeout=0.2)
+        self.assertEqual(self.pool.run(sleep_task, 0), 0)
+
+    def test_inline_timeout(self):
+        """Ensure a task run inline times out, and the process's SIGALRM
+        handler is restored afterwards.
+        """
+        def handler(signum, frame):
+            pass
+
+        previous = signal.signal(signal.SIGALRM, handler)
+        try:
+            pool = ComputePool(timeout=30)
+            with self.assertRaises(ComputeTimeout):
+                pool.run(sleep_task, 5, timeout=0.2)
+            self.assertIs(signal.getsignal(signal.SIGALRM), handler)
+            self.assertEqual(pool.run(sleep_task, 0), 0)
+            self.assertIs(signal.getsignal(signal.SIGALRM), handler)
+        finally:
+            signal.signal(signal.SIGALRM, previous)
+
+    def test_deadline_timeout(self):
+        """Ensure a task with a deadline may outlast the pool's timeout until
+        the grace period after its deadline, both in the pool and inline.
+        """
+        for pool in [ComputePool(processes=1, timeout=0.1),
+                     ComputePool(timeout=0.1)]:
+            with mock.patch('credo.compute_pool.DEADLINE_GRACE', 0.2):
+                self.assertEqual(
+                    pool.run(sleep_task, 0.3, deadline=Deadline(0.5)),
+                    0.3
+                )
+                with self.assertRaises(ComputeTimeout):
+                    pool.run(sleep_task, 5, deadline=Deadline(0.1))
+                # Tasks without a deadline still use the pool's timeout
+                with self.assertRaises(ComputeTimeout):
+                    pool.run(sleep_task, 5, deadline=Deadline())
+            pool.shutdown()
+
+    def test_cancel(self):
+        """Ensure a cancelled task is not waited for."""
+        deadline = Deadline()
+        deadline.cancel()
+        started = time.monotonic()
+        with self.assertRaises(ComparisonCancelled):
+            self.pool.run(sleep_task, 1, deadline=deadline)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_crash(self):
+        """Ensure a dead worker is reported, and the pool is restarted."""
+        with self.assertRaises(ComputeCrashed):
+            self.pool.run(crash_task)
+        self.assertEqual(self.pool.run(sleep_task, 0), 0)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import gzip
+from io import BytesIO
+from unittest import TestCase, mock
+
+from credo import content_encoding
+from credo.content_encoding import choose_encoding, encode_chunks
+
+
+class TestContentEncoding(TestCase):
+    def test_choose_encoding(self):
+        """Ensure the preferred accepted encoding is chosen."""
+        with mock.patch.object(content_encoding, 'brotli', None):
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'gzip')
+            self.assertEqual(choose_encoding('br'), None)
+            self.assertEqual(choose_encoding('*'), 'gzip')
+            self.assertEqual(choose_encoding('gzip;q=0, *'), None)
+            self.assertEqual(choose_encoding('GZIP;q=0.5'), 'gzip')
+            self.assertEqual(choose_encoding(''), None)
+
+        with mock.patch.object(content_encoding, 'brotli', object()):
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+            self.assertEqual(choose_encoding('gzip, br;q=0'), 'gzip')
+
+    def test_encode_chunks(self):
+        """Ensure files are compressed as they are read."""
+        data = b'<measure/>' * 2**16
+        chunks = list(encode_chunks(BytesIO(data), 'gzip'))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), data)
+
+        if content_encoding.brotli is not None:
+            chunks = encode_chunks(BytesIO(data), 'br')
+            self.assertEqual(
+                content_encoding.brotli.decompress(b''.join(chunks)),
+                data
+            )
+
+        with self.assertRaises(ValueError):
+            list(encode_chunks(BytesIO(data), 'compress'))
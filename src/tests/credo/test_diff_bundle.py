@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+from unittest import TestCase
+
+from credo.diff_bundle import MAGIC, decode_bundle, encode_bundle
+
+
+class TestDiffBundle(TestCase):
+    def test_round_trip(self):
+        """Ensure bundles decode to the header and payloads they were
+        encoded from.
+        """
+        header = {'version': 1, 'parts': [{'name': 'diff'}]}
+        payloads = [b'\x00\xff' * 100, b'', b'<mei/>']
+
+        data = encode_bundle(header, payloads)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(decode_bundle(data), (header, payloads))
+
+    def test_invalid(self):
+        """Ensure anything but a whole bundle is rejected."""
+        data = encode_bundle({}, [b'<mei/>'])
+        for invalid in [b'', b'{}', MAGIC, data[:-1], data + b'\x00']:
+            with self.assertRaises(ValueError):
+                decode_bundle(invalid)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import base64
+import json
+from io import BytesIO
+from unittest import TestCase
+
+import lxml.etree as et
+
+from credo import json_stream
+from credo.json_stream import Base64Chunks, encode_base64_chunks, \
+    read_chunks, serialise_chunks, split_chunks, stream_json
+
+
+class TestJsonStream(TestCase):
+    def test_encode_base64_chunks(self):
+        """Ensure chunks of any size are encoded as one base64 string."""
+        data = bytes(range(256)) * 7
+        for size in [1, 2, 3, 4, 5, 100]:
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(
+                b''.join(encode_base64_chunks(chunks)),
+                base64.b64encode(data)
+            )
+        self.assertEqual(b''.join(encode_base64_chunks([])), b'')
+
+    def test_stream_json(self):
+        """Ensure values are encoded as json.dumps would, streaming any
+        Base64Chunks.
+        """
+        data = b'<measure/>' * 2**14
+        value = {
+            'content': {
+                'mei': {'detail': None, 'encoding': 'base64'},
+                'sources': [],
+                'tier': 'fast',
+                'coarse': False,
+                'numbers': (1, 2.5, -3),
+                'text': 'café "quoted"'
+            }
+        }
+        expected = json.dumps(value).replace(
+            'null',
+            json.dumps(str(base64.b64encode(data), encoding='utf-8'))
+        )
+
+        value['content']['mei']['detail'] = Base64Chunks(
+            read_chunks(BytesIO(data))
+        )
+        chunks = list(stream_json(value))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(
+            len(chunk) <= 2 * json_stream.CHUNK_SIZE for chunk in chunks
+        ))
+        self.assertEqual(b''.join(chunks).decode(), expected)
+
+    def test_serialise_chunks(self):
+        """Ensure trees are serialised in chunks as they would be by
+        et.tostring, with or without a doctype.
+        """
+        body = (
+            '<mei xmlns="http://www.music-encoding.org/ns/mei" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink">'
+            + '<measure xlink:href="&amp;&#10;">\u00e9<!-- c --></measure>'
+            * 2**13
+            + '</mei><!-- after -->'
+        )
+        for prolog in ['<?pi?>', '<!DOCTYPE mei [<!ENTITY e "x">]>']:
+            tree = et.ElementTree(et.fromstring((prolog + body).encode()))
+            chunks = list(serialise_chunks(tree))
+            self.assertGreater(len(chunks), 1)
+            self.assertTrue(all(
+                len(chunk) <= 2 * json_stream.CHUNK_SIZE for chunk in chunks
+            ))
+            self.assertEqual(
+                b''.join(chunks),
+                et.tostring(tree, encoding='utf-8')
+            )
+        self.assertEqual(list(split_chunks(b'')), [])
@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
-from django.test import TestCase
-from credo.models import MEI
+import threading
+from unittest import mock
+from django.db import connection
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from credo.models import Comment, MEI, MEIVersion, Revision, User
+from credo.utils.mei.comparison_cache import content_digest, \
+    get_comparison_cache
+from credo.utils.mei.measure_patch import patch_measures
+from credo.utils.mei.resolve_utils import count_unresolved_layers
+from credo.utils.mei.tree_comparison import TreeComparison
 from django.core.files.base import ContentFile
+from utils.mei import queries
+from utils.mei.stream_normaliser import StreamNormaliser
+from tests.credo.helpers import TemporaryMediaRoot
+from io import BytesIO, StringIO
+import lxml.etree as et
 import re
 
 
-class TestMEI(TestCase):
+class TestMEI(TemporaryMediaRoot, TestCase):
     def setUp(self):
         pass
 
@@ -22,3 +38,310 @@ class TestMEI(TestCase):
 
         data = mei.data.open('r').read().decode()
         self.assertIsNone(re.search('<meiHead', data))
+
+    def test_content_hash_on_save(self):
+        """Ensure the content hash tracks the stored file, and cached
+        comparisons of the old contents are invalidated on rewrite.
+        """
+        mei = MEI()
+
+        with open('credo/migrations/seed_mei/diffA.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        with mei.data.storage.open(mei.data.name, 'rb') as f:
+            digest = content_digest(f.read())
+        self.assertEqual(mei.content_hash, digest)
+        self.assertEqual(MEI.objects.get(pk=mei.pk).content_hash, digest)
+
+        cache = get_comparison_cache()
+        key = cache.make_key(digest, digest, 'TreeComparison')
+        cache.put(key, (b'<diff/>', b'<a/>', b'<b/>'))
+
+        with open('tests/credo/utils/mei/data/test_b.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        self.assertNotEqual(mei.content_hash, digest)
+        self.assertIsNone(cache.get(key))
+
+    def test_intermediate_on_save(self):
+        """Ensure the intermediate representation and structural summary are
+        stored on save, and cleared when the file is rewritten unnormalised.
+        """
+        mei = MEI()
+
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        self.assertTrue(mei.has_intermediate())
+        stored = MEI.objects.get(pk=mei.pk)
+        self.assertTrue(stored.has_intermediate())
+
+        with mei.data.open('rb') as f:
+            tree = et.parse(f)
+        self.assertEqual(stored.measure_count, len(queries.MEASURES(tree)))
+        self.assertEqual(stored.staff_count, len(queries.STAFFS(tree)))
+        self.assertEqual(stored.layer_count, len(queries.LAYERS(tree)))
+
+        with mei.intermediate.open('rb') as f:
+            intermediate = f.read().decode()
+        self.assertIsNone(re.search('pname=', intermediate))
+        self.assertIsNone(re.search('xml:id=', intermediate))
+        self.assertIsNotNone(re.search('octname=', intermediate))
+
+        mei.normalised = False
+        with open('tests/credo/utils/mei/data/test_b.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        self.assertFalse(mei.has_intermediate())
+        stored = MEI.objects.get(pk=mei.pk)
+        self.assertFalse(stored.has_intermediate())
+        self.assertIsNone(stored.measure_count)
+
+    def test_compare_intermediate(self):
+        """Ensure comparing the stored intermediate representations gives the
+        same result as comparing the stored files.
+        """
+        meis = []
+        for filename in ['test_a.mei', 'test_b.mei']:
+            mei = MEI()
+            with open(f'tests/credo/utils/mei/data/{filename}') as f:
+                mei.data.save(filename, ContentFile(f.read()))
+            get_comparison_cache().invalidate(mei.content_hash)
+            meis.append(mei)
+
+        engine = TreeComparison()
+        with engine.trace:
+            from_intermediate = engine.compare_meis(*meis)
+            # Neither file needed converting
+            self.assertEqual(engine.trace.phases['to_intermediate'].nodes, 0)
+
+        parser = et.XMLParser(remove_blank_text=True)
+        trees = []
+        for mei in meis:
+            with mei.data.open('rb') as f:
+                trees.append(et.parse(f, parser))
+        from_data = TreeComparison().compare_trees(*trees)
+
+        for expected, actual in zip(from_data, from_intermediate):
+            self.assertEqual(et.tostring(expected), et.tostring(actual))
+
+    def test_rekey_comments(self):
+        """Ensure comments are re-keyed to the new IDs of their elements with
+        the same number of queries, whatever the number of comments.
+        """
+        user = User.objects.create(username='testuser')
+        query_counts = []
+
+        for count in [1, 50]:
+            # Store the file without new IDs, so normalising it changes them
+            mei = MEI(normalised=False)
+            with open('credo/migrations/seed_mei/diffA.mei') as f:
+                mei.data.save('test_file.mei', ContentFile(f.read()))
+
+            with mei.data.open('rb') as f:
+                content = f.read()
+            ids = re.findall(r'<note[^>]* xml:id="([^"]+)"', content.decode())
+            ids = ids[:count]
+            normaliser = StreamNormaliser(BytesIO(content))
+            normaliser.normalise(BytesIO(), tracked_ids=ids)
+            id_map = normaliser.get_id_map()
+            self.assertNotEqual(list(id_map), list(id_map.values()))
+
+            revision = Revision.objects.create(user=user, mei=mei)
+            Comment.objects.bulk_create(
+                Comment(
+                    revision=revision,
+                    user=user,
+                    text='',
+                    mei_element_id=id
+                )
+                for id in ids
+            )
+
+            mei.normalised = True
+            with CaptureQueriesContext(connection) as queries_made:
+                mei.save()
+            query_counts.append(len(queries_made))
+
+            self.assertEqual(
+                sorted(revision.comment_set.values_list(
+                    'mei_element_id',
+                    flat=True
+                )),
+                sorted(id_map[id] for id in ids)
+            )
+
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_fork(self):
+        """Ensure forks share the stored file and intermediate
+        representation until either MEI is rewritten.
+        """
+        mei = MEI()
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+        with mei.data.open('rb') as f:
+            content = f.read()
+        with mei.intermediate.open('rb') as f:
+            intermediate = f.read()
+
+        with CaptureQueriesContext(connection) as queries_made:
+            fork = mei.fork()
+        self.assertEqual(len(queries_made), 1)
+
+        fork = MEI.objects.get(pk=fork.pk)
+        self.assertEqual(fork.data.name, mei.data.name)
+        self.assertEqual(fork.content_hash, mei.content_hash)
+        self.assertTrue(fork.is_ready)
+        self.assertTrue(fork.has_intermediate())
+
+        with fork.data.open('rb') as f:
+            tree = et.parse(f)
+        measure = queries.MEASURES(tree)[0]
+        measure.set('label', 'forked')
+        fork.patch_measures({
+            measure.get(queries.XML_ID):
+                et.tostring(measure, with_tail=False)
+        })
+
+        self.assertNotEqual(fork.data.name, mei.data.name)
+        self.assertEqual(
+            MEI.objects.get(pk=fork.pk).data.name,
+            fork.data.name
+        )
+        self.assertNotEqual(fork.content_hash, mei.content_hash)
+        with fork.data.open('rb') as f:
+            self.assertIn(b'label="forked"', f.read())
+
+        mei.refresh_from_db()
+        with mei.data.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertTrue(mei.has_intermediate())
+        with mei.intermediate.open('rb') as f:
+            self.assertEqual(f.read(), intermediate)
+
+    @override_settings(
+        MEI_VERSIONS=dict(
+            settings.MEI_VERSIONS, ENABLED=True, SNAPSHOT_INTERVAL=3
+        )
+    )
+    def test_version_history(self):
+        """Ensure every change to the stored file is kept, as deltas between
+        periodic snapshots, and can be rebuilt until it is compacted away.
+        """
+        mei = MEI(normalised=False)
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        contents = []
+        with mei.data.open('rb') as f:
+            contents.append(f.read())
+        tree = et.ElementTree(et.fromstring(contents[0]))
+        measures = queries.MEASURES(tree)
+
+        for label in ['a', 'b', 'c', 'd']:
+            measures[0].set('label', label)
+            mei.patch_measures({
+                measures[0].get(queries.XML_ID):
+                    et.tostring(measures[0], with_tail=False)
+            })
+            with mei.data.open('rb') as f:
+                contents.append(f.read())
+        # Saving an unchanged file adds no version
+        mei.save()
+
+        versions = list(mei.versions.order_by('number'))
+        self.assertEqual(
+            [version.is_snapshot for version in versions],
+            [True, False, False, True, False]
+        )
+        for version, content in zip(versions, contents):
+            self.assertEqual(version.size, len(content))
+            self.assertEqual(mei.get_version(version.number), content)
+        for version in versions[1:3] + versions[4:]:
+            self.assertLess(len(version.data) * 4, len(versions[0].data))
+
+        call_command('compact_mei_versions', keep=2, stdout=StringIO())
+        self.assertEqual(
+            list(
+                mei.versions
+                .order_by('number')
+                .values_list('number', 'is_snapshot')
+            ),
+            [(4, True), (5, False)]
+        )
+        self.assertEqual(mei.get_version(5), contents[4])
+        with self.assertRaises(MEIVersion.DoesNotExist):
+            mei.get_version(3)
+
+
+class TestPatchMeasures(TemporaryMediaRoot, TransactionTestCase):
+    # The patches are made on two connections, so each must be committed
+    # rather than run inside the transaction wrapping each TestCase.
+
+    @override_settings(
+        MEI_VERSIONS=dict(settings.MEI_VERSIONS, ENABLED=True)
+    )
+    def test_interleaved_patches(self):
+        """Ensure a patch made while another is rewriting the file waits for
+        it, so that neither patched measure nor the count of unresolved
+        layers is lost.
+        """
+        mei = MEI(normalised=False)
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test', ContentFile(f.read()))
+        unresolved = mei.get_unresolved_layers()
+
+        with mei.data.open('rb') as f:
+            measures = queries.MEASURES(et.parse(f))[:2]
+        resolved = sum(map(count_unresolved_layers, measures))
+        self.assertGreater(resolved, 0)
+        patches = []
+        layer_ids = []
+        for measure in measures:
+            for layer in measure.iter(queries.LAYER):
+                layer_id = 'm-r' + layer.get(queries.XML_ID)[2:]
+                layer.set(queries.XML_ID, layer_id)
+                layer_ids.append(layer_id)
+            patches.append({
+                measure.get(queries.XML_ID):
+                    et.tostring(measure, with_tail=False).decode()
+            })
+
+        errors = []
+
+        def patch_second():
+            try:
+                MEI.objects.get(pk=mei.pk).patch_measures(patches[1])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        second = threading.Thread(target=patch_second)
+        calls = []
+
+        def patch_first(*args, **kwargs):
+            # Once the first patch has read the file, give the second patch
+            # time to run to completion, if nothing makes it wait
+            calls.append(args)
+            if len(calls) == 1:
+                second.start()
+                second.join(timeout=0.5)
+            return patch_measures(*args, **kwargs)
+
+        with mock.patch(
+                'credo.models.patch_measures',
+                side_effect=patch_first):
+            mei.patch_measures(patches[0])
+            second.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(calls), 2)
+        mei.refresh_from_db()
+        self.assertEqual(mei.unresolved_layers, unresolved - resolved)
+        with mei.data.open('r') as f:
+            data = f.read()
+        for layer_id in layer_ids:
+            self.assertIn(f'xml:id="{layer_id}"', data)
+        self.assertEqual(mei.versions.count(), 3)
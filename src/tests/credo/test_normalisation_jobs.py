@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+from io import StringIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from credo.models import MEI, Revision
+from credo.normalisation_jobs import claim_normalisation, run_normalisation
+from tests.credo.helpers import LoggedInClient, TemporaryMediaRoot, \
+    create_meis
+
+NORMALISATION_JOBS = dict(settings.NORMALISATION_JOBS, ENABLED=True)
+
+
+def read_data(mei):
+    with mei.data.open('rb') as f:
+        return f.read()
+
+
+@override_settings(NORMALISATION_JOBS=NORMALISATION_JOBS)
+class TestNormalisationJobs(LoggedInClient, TemporaryMediaRoot, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.meis = create_meis()
+
+    def test_save_queues(self):
+        """Ensure saving an MEI leaves it processing and unnormalised until a
+        worker normalises it, and that it is only claimed once.
+        """
+        mei = MEI()
+        with open('credo/migrations/seed_mei/diffA.mei') as f:
+            mei.data.save('test_file.mei', ContentFile(f.read()))
+
+        self.assertEqual(mei.status, MEI.PROCESSING)
+        self.assertEqual(MEI.objects.get(pk=mei.pk).status, MEI.PROCESSING)
+        with mei.data.open('r') as f:
+            self.assertIn('<meiHead', f.read())
+
+        claimed = [claim_normalisation('test') for _ in self.meis + [mei]]
+        self.assertIsNone(claim_normalisation('test'))
+
+        for claimed_mei in claimed:
+            run_normalisation(claimed_mei)
+            self.assertEqual(claimed_mei.status, MEI.READY)
+
+        mei.refresh_from_db()
+        self.assertTrue(mei.has_intermediate())
+        with mei.data.open('r') as f:
+            self.assertNotIn('<meiHead', f.read())
+
+    def test_failure(self):
+        """Ensure an MEI which cannot be normalised is marked as failed."""
+        mei = MEI()
+        mei.data.save('test_file.mei', ContentFile('<mei'))
+
+        claimed = claim_normalisation('test')
+        while claimed.pk != mei.pk:
+            run_normalisation(claimed)
+            claimed = claim_normalisation('test')
+
+        run_normalisation(claimed)
+        self.assertEqual(claimed.status, MEI.FAILED)
+        self.assertIn('XMLSyntaxError', claimed.normalisation_error)
+
+    def test_resave_requeues(self):
+        """Ensure an MEI saved again while it is normalised is not marked as
+        ready by the earlier claim.
+        """
+        for mei in self.meis:
+            claimed = claim_normalisation('test')
+            mei.save()
+            run_normalisation(claimed)
+            self.assertEqual(claimed.status, MEI.PROCESSING)
+
+        self.assertIsNotNone(claim_normalisation('test'))
+
+    @override_settings(
+        MEI_VERSIONS=dict(settings.MEI_VERSIONS, ENABLED=True)
+    )
+    def test_stale_claim_dropped(self):
+        """Ensure a claim which another worker has since taken over writes
+        neither the file nor any derived fields, and leaves the MEI to the
+        newer claim.
+        """
+        stale = claim_normalisation('test')
+        contents = read_data(stale)
+        with override_settings(
+                NORMALISATION_JOBS=dict(NORMALISATION_JOBS, STALE_AFTER=0)):
+            fresh = claim_normalisation('test')
+        self.assertEqual(fresh.pk, stale.pk)
+
+        run_normalisation(stale)
+        self.assertEqual(stale.status, MEI.PROCESSING)
+        self.assertEqual(stale.content_hash, '')
+        self.assertEqual(stale.versions.count(), 0)
+        self.assertFalse(stale.intermediate)
+        self.assertEqual(read_data(stale), contents)
+
+        run_normalisation(fresh)
+        self.assertEqual(fresh.status, MEI.READY)
+        self.assertNotEqual(fresh.content_hash, '')
+        self.assertEqual(fresh.versions.count(), 1)
+        self.assertTrue(fresh.has_intermediate())
+
+    def test_patch_reports_status(self):
+        """Ensure a save which resolves the last layer of a revision reports
+        that it is being normalised, until a worker has normalised it.
+        """
+        mei = MEI(normalised=False)
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test', ContentFile(f.read()))
+        revision = Revision.objects.create(user=self.user, mei=mei)
+        # Leave the queue empty, with the revision ready and each of its
+        # layers resolved, as a save of its last measure would
+        while claim_normalisation('test') is not None:
+            pass
+        MEI.objects.update(status=MEI.READY, claimed_at=None)
+        MEI.objects.filter(pk=mei.pk).update(unresolved_layers=0)
+
+        response = self.client.patch(
+            f'/revisions/{revision.id}',
+            '{}',
+            content_type='application/json'
+        )
+        content = response.json()
+        self.assertTrue(content['renormalised'])
+        self.assertEqual(content['status'], MEI.PROCESSING)
+        status_url = content['status_url']
+        self.assertEqual(
+            self.client.get(status_url).json()['content']['status'],
+            MEI.PROCESSING
+        )
+
+        run_normalisation(claim_normalisation('test'))
+        self.assertEqual(
+            self.client.get(status_url).json()['content']['status'],
+            MEI.READY
+        )
+        self.assertEqual(self.client.get('/mei/0/status').status_code, 404)
+
+    def test_views_check_status(self):
+        """Ensure views refuse MEIs which are still processing."""
+        sources = f's={self.meis[0].id}&s={self.meis[1].id}'
+        response = self.client.get(f'/diff?{sources}')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()['content']['status'],
+            MEI.PROCESSING
+        )
+
+        response = self.client.post(f'/diff/jobs?{sources}')
+        self.assertEqual(response.status_code, 409)
+
+        while True:
+            claimed = claim_normalisation('test')
+            if claimed is None:
+                break
+            run_normalisation(claimed)
+
+        response = self.client.get(f'/diff?{sources}')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(NORMALISATION_JOBS=NORMALISATION_JOBS)
+class TestNormalisationWorker(TemporaryMediaRoot, TransactionTestCase):
+    # The worker closes stale database connections between MEIs, so it
+    # cannot run inside the transaction wrapping each TestCase.
+
+    def test_worker_command(self):
+        """Ensure the worker command drains the queue when run with --once."""
+        meis = create_meis()
+
+        call_command('normalisation_worker', once=True, stdout=StringIO())
+
+        for mei in meis:
+            mei.refresh_from_db()
+            self.assertEqual(mei.status, MEI.READY)
@@ -1,14 +1,36 @@
 #!/usr/bin/env python3
 
+import base64
+import gzip
 import logging
 import json
+from unittest import mock
 
-from django.test import TestCase, Client
+import lxml.etree as et
+
+from django.conf import settings
+from django.test import TestCase, Client, override_settings
 from django.core.files.base import ContentFile
+from credo.compute_pool import ComputeCrashed, ComputeTimeout
 from credo.models import Comment, Revision, User, Edition, Composer, Song, MEI
+from credo.diff_bundle import CONTENT_TYPE as BUNDLE_CONTENT_TYPE, \
+    decode_bundle
+from credo.utils.mei.comparison_cache import get_comparison_cache
+from credo.utils.mei.comparison_strategy import ComparisonStrategy
+from credo.utils.mei.instrumentation import get_metrics_registry
+from credo.utils.mei.resolve_utils import count_unresolved_layers
+from utils.mei import queries
+from tests.credo.helpers import TemporaryMediaRoot
+
+
+def read_json(response):
+    """Read the JSON of a response, which may be streamed."""
+    if response.streaming:
+        return json.loads(b''.join(response.streaming_content))
+    return response.json()
 
 
-class TestServerBlackBox(TestCase):
+class TestServerBlackBox(TemporaryMediaRoot, TestCase):
     def setUp(self):
         logging.basicConfig(filename='/tmp/credo-test.log')
         self.logger = logging.getLogger(__name__)
@@ -106,6 +128,214 @@ class TestServerBlackBox(TestCase):
                                    mei_element_id='m-2').exists()
         )
 
+    def test_save_revision_upserts_comments(self):
+        """Ensure saving a revision only writes the comments which were added,
+        changed or removed, and keeps the rest as they were.
+        """
+        url = f'/revisions/{self.revision_owned.id}'
+
+        def save(comments):
+            response = self.authed_client.post(
+                url,
+                json.dumps({
+                    'comments': comments,
+                    'mei': '<music xml:id="m-22"></music>'
+                }),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+            return {
+                comment.mei_element_id: comment
+                for comment in self.revision_owned.comment_set.all()
+            }
+
+        first = save({'m-1': 'kept', 'm-2': 'changed', 'm-3': 'removed'})
+        second = save({'m-1': 'kept', 'm-2': 'updated', 'm-4': 'added'})
+
+        self.assertEqual(set(second), {'m-1', 'm-2', 'm-4'})
+        self.assertEqual(second['m-1'].id, first['m-1'].id)
+        self.assertEqual(second['m-1'].updated_at, first['m-1'].updated_at)
+        self.assertEqual(second['m-2'].id, first['m-2'].id)
+        self.assertEqual(second['m-2'].text, 'updated')
+        self.assertGreater(second['m-2'].updated_at, first['m-2'].updated_at)
+        self.assertEqual(second['m-4'].text, 'added')
+
+    def test_patch_revision_measures(self):
+        """Ensure measures can be saved on their own, and the revision is
+        normalised once every layer has been resolved.
+        """
+        mei = MEI(normalised=False)
+        with open('tests/credo/utils/mei/data/test_a.mei') as f:
+            mei.data.save('test', ContentFile(f.read()))
+        revision = Revision.objects.create(user=self.user, mei=mei)
+        url = f'/revisions/{revision.id}'
+
+        with mei.data.open('rb') as f:
+            tree = et.parse(f)
+        measures = queries.MEASURES(tree)
+        unresolved = mei.get_unresolved_layers()
+        self.assertGreater(unresolved, 0)
+        self.assertEqual(unresolved, count_unresolved_layers(tree))
+
+        def resolve(measure):
+            layer_ids = []
+            for layer in measure.iter(queries.LAYER):
+                layer_id = 'm-r' + layer.get(queries.XML_ID)[2:]
+                layer.set(queries.XML_ID, layer_id)
+                layer_ids.append(layer_id)
+            return layer_ids, et.tostring(measure, with_tail=False).decode()
+
+        layer_ids, first = resolve(measures[0])
+        response = self.authed_client.patch(
+            url,
+            json.dumps({
+                'measures': {measures[0].get(queries.XML_ID): first},
+                'comments': {'m-1': 'hello'}
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['renormalised'])
+
+        mei.refresh_from_db()
+        self.assertEqual(
+            mei.unresolved_layers,
+            unresolved - len(layer_ids)
+        )
+        with mei.data.open('r') as f:
+            data = f.read()
+        for layer_id in layer_ids:
+            self.assertIn(f'xml:id="{layer_id}"', data)
+        self.assertTrue(
+            revision.comment_set.filter(mei_element_id='m-1').exists()
+        )
+
+        response = self.authed_client.patch(
+            url,
+            json.dumps({'measures': {'m-missing': first}}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.authed_client.patch(
+            url,
+            json.dumps({
+                'measures': {
+                    measure.get(queries.XML_ID): resolve(measure)[1]
+                    for measure in measures[1:]
+                }
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json(), {
+            'ok': True,
+            'resolved': True,
+            'renormalised': True,
+            'status': MEI.READY,
+            'status_url': f'/mei/{mei.id}/status'
+        })
+        mei.refresh_from_db()
+        self.assertTrue(mei.normalised)
+
+    def test_patch_revision_invalid(self):
+        """Ensure malformed saves are refused with a 400, and saves of
+        unknown revisions with a 404.
+        """
+        revision = Revision.objects.create(user=self.user, mei=self.mei)
+        url = f'/revisions/{revision.id}'
+        for body in ['{', '[]', '{"measures": []}',
+                     '{"measures": {"m-1": 1}}', '{"comments": "text"}']:
+            response = self.authed_client.patch(
+                url,
+                body,
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400, body)
+
+        response = self.authed_client.patch(
+            f'/revisions/{revision.id + 1}',
+            '{}',
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_mei_raw(self):
+        """Ensure the raw MEI is sent, compressed if accepted, and that
+        clients revalidating it with its ETag are sent a 304.
+        """
+        url = f'/mei/{self.mei.id}/raw'
+        with self.mei.data.open('rb') as f:
+            data = f.read()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        etag = response['ETag']
+        self.assertIn(self.mei.content_hash, etag)
+        self.assertFalse(etag.startswith('W/'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.decompress(b''.join(response.streaming_content)),
+            data
+        )
+        self.assertNotEqual(response['ETag'], etag)
+
+        # The ETag of the uncompressed file does not match the compressed one
+        response = self.client.get(
+            url,
+            HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+
+        # The JSON envelope has its own ETag
+        response = self.client.get(f'/mei/{self.mei.id}')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+            base64.b64decode(read_json(response)['content']['mei']['detail']),
+            data
+        )
+        response = self.client.get(
+            f'/mei/{self.mei.id}',
+            HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_mei_versions(self):
+        """Ensure the versions of an MEI can be listed and fetched."""
+        with override_settings(
+                MEI_VERSIONS=dict(settings.MEI_VERSIONS, ENABLED=True)):
+            self.mei.record_version()
+
+        response = self.client.get(f'/mei/{self.mei.id}/versions')
+        self.assertEqual(response.status_code, 200)
+        versions = response.json()['content']['versions']
+        self.assertEqual(len(versions), 1)
+        self.assertEqual(versions[0]['number'], 1)
+        self.assertEqual(versions[0]['content_hash'], self.mei.content_hash)
+
+        response = self.client.get(f'/mei/{self.mei.id}/versions/1')
+        self.assertEqual(response.status_code, 200)
+        content = read_json(response)['content']
+        with self.mei.data.open('rb') as f:
+            self.assertEqual(
+                base64.b64decode(content['mei']['detail']),
+                f.read()
+            )
+
+        response = self.client.get(f'/mei/{self.mei.id}/versions/2')
+        self.assertEqual(response.status_code, 404)
+
     def test_save_revision_auth(self):
         """Ensure comments cannot be added if a user is not logged in."""
 
@@ -136,6 +366,145 @@ class TestServerBlackBox(TestCase):
         self.assertEquals(response.status_code, 302)
         self.assertEquals(Revision.objects.count(), num_revisions + 1)
 
+        # The revision shares the file of the edition
+        revision = Revision.objects.latest('id')
+        edition = Edition.objects.get(id=1)
+        self.assertEqual(revision.mei.data.name, edition.mei.data.name)
+        self.assertTrue(revision.mei.is_ready)
+
+    def test_make_revision_compute_errors(self):
+        """Ensure a revision is not made, and a 503 is returned, when its
+        comparison times out or crashes.
+        """
+        num_revisions = Revision.objects.count()
+        url = f'/revise?e={self.edition.id}&r={self.revision_owned.id}'
+        for error in [ComputeTimeout, ComputeCrashed]:
+            with mock.patch.object(
+                    ComparisonStrategy,
+                    'compare_meis',
+                    side_effect=error):
+                response = self.authed_client.get(url)
+            self.assertEqual(response.status_code, 503)
+        self.assertEqual(Revision.objects.count(), num_revisions)
+
+    def test_diff_cached(self):
+        """Ensure repeated comparisons of the same MEIs are cached."""
+        cache = get_comparison_cache()
+        cache.clear()
+        misses = cache.stats()['misses']
+
+        url = f'/diff?s={self.mei.id}&s={self.mei.id}'
+        first = self.authed_client.get(url)
+        second = self.authed_client.get(url)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(read_json(first), read_json(second))
+        self.assertEqual(cache.stats()['misses'], misses + 1)
+
+    def test_diff_bundle(self):
+        """Ensure diffs can be sent as a bundle, with or without their
+        sources.
+        """
+        url = f'/diff?s={self.mei.id}&s={self.mei.id}'
+        envelope = read_json(self.authed_client.get(url))['content']
+
+        response = self.authed_client.get(f'{url}&format=bundle')
+        self.assertEqual(response['Content-Type'], BUNDLE_CONTENT_TYPE)
+        header, payloads = decode_bundle(response.content)
+        self.assertEqual(header['coarse'], envelope['coarse'])
+        self.assertEqual(
+            [part['name'] for part in header['parts']],
+            ['diff', 'source', 'source']
+        )
+        self.assertEqual(
+            [gzip.decompress(payload) for payload in payloads],
+            [
+                base64.b64decode(part['detail'])
+                for part in [envelope['diff']] + envelope['sources']
+            ]
+        )
+
+        response = self.authed_client.get(
+            f'{url}&format=bundle&omit_sources=true'
+        )
+        header, payloads = decode_bundle(response.content)
+        self.assertEqual(len(payloads), 1)
+        for part in header['parts'][1:]:
+            self.assertEqual(part['mei'], self.mei.id)
+            self.assertEqual(part['content_hash'], self.mei.content_hash)
+            self.assertEqual(part['url'], f'/mei/{self.mei.id}/raw')
+
+        for query in ['format=xml', 'omit_sources=true']:
+            response = self.authed_client.get(f'{url}&{query}')
+            self.assertEqual(response.status_code, 400)
+
+    def test_diff_engine(self):
+        """Ensure the comparison engine can be chosen per request."""
+        for engine in ['tree', 'measure', 'sequence']:
+            response = self.authed_client.get(
+                f'/diff?s={self.mei.id}&s={self.mei.id}&engine={engine}'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('diff', read_json(response)['content'])
+
+        response = self.authed_client.get(
+            f'/diff?s={self.mei.id}&s={self.mei.id}&engine=unknown'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_diff_quality(self):
+        """Ensure a quality tier can be requested, or chosen automatically,
+        and is reported in the response.
+        """
+        sources = f's={self.mei.id}&s={self.mei.id}'
+        for tier in ['fast', 'balanced', 'accurate']:
+            response = self.authed_client.get(
+                f'/diff?{sources}&quality={tier}'
+            )
+            self.assertEqual(read_json(response)['content']['tier'], tier)
+
+        with self.settings(COMPARISON_LATENCY_BUDGET=60):
+            response = self.authed_client.get(f'/diff?{sources}&quality=auto')
+            self.assertEqual(
+                read_json(response)['content']['tier'],
+                'accurate'
+            )
+
+        with self.settings(COMPARISON_LATENCY_BUDGET=0):
+            response = self.authed_client.get(f'/diff?{sources}&quality=auto')
+            self.assertEqual(read_json(response)['content']['tier'], 'fast')
+
+        response = self.authed_client.get(f'/diff?{sources}')
+        self.assertIsNone(read_json(response)['content']['tier'])
+
+        response = self.authed_client.get(f'/diff?{sources}&quality=unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_diff_metrics(self):
+        """Ensure comparison phases are recorded, and only shown to staff."""
+        registry = get_metrics_registry()
+        registry.clear()
+        get_comparison_cache().clear()
+
+        response = self.authed_client.get(
+            f'/diff?s={self.mei.id}&s={self.mei.id}'
+        )
+        # The trace is published once the streamed response has been sent
+        self.assertEqual(registry.snapshot()['comparisons'], 0)
+        read_json(response)
+        self.assertEqual(registry.snapshot()['comparisons'], 1)
+        self.assertIn('diff', registry.snapshot()['phases'])
+        self.assertIn('encode', registry.snapshot()['phases'])
+
+        response = self.authed_client.get('/diff/metrics')
+        self.assertEqual(response.status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.authed_client.get('/diff/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['content']['comparisons'], 1)
+
     def test_download_edition(self):
         # Unauthed user => 403
         response = self.client.get(f'/editions/{self.edition.id}/download')
@@ -0,0 +1,103 @@
+from unittest import TestCase, main
+import os
+import tempfile
+
+from credo.utils.mei.comparison_cache import ComparisonCache, content_digest
+
+
+class TestComparisonCache(TestCase):
+
+    def setUp(self):
+        self.disk_dir = tempfile.TemporaryDirectory()
+        self.result = (b'<diff/>', b'<a/>', b'<b/>')
+        self.digest_a = content_digest(b'a')
+        self.digest_b = content_digest(b'b')
+        self.key = ComparisonCache.make_key(
+            self.digest_a,
+            self.digest_b,
+            'TreeComparison'
+        )
+
+    def tearDown(self):
+        self.disk_dir.cleanup()
+
+    def test_memory_lru(self):
+        """Ensure the memory tier evicts the least recently used entry."""
+        cache = ComparisonCache(memory_entries=2)
+        cache.put('1', self.result)
+        cache.put('2', self.result)
+        cache.get('1')
+        cache.put('3', self.result)
+
+        self.assertIsNotNone(cache.get('1'))
+        self.assertIsNone(cache.get('2'))
+        self.assertIsNotNone(cache.get('3'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['memory_hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_disk_tier_shared(self):
+        """Ensure results written to disk can be read by another cache."""
+        writer = ComparisonCache(memory_entries=0, disk_dir=self.disk_dir.name)
+        reader = ComparisonCache(memory_entries=4, disk_dir=self.disk_dir.name)
+
+        writer.put(self.key, self.result)
+
+        self.assertEqual(reader.get(self.key), self.result)
+        self.assertEqual(reader.stats()['disk_hits'], 1)
+
+        # The second read is served from memory
+        self.assertEqual(reader.get(self.key), self.result)
+        self.assertEqual(reader.stats()['memory_hits'], 1)
+
+    def test_disk_size_bound(self):
+        """Ensure the disk tier stays under its size limit."""
+        entry_size = ComparisonCache._HEADER.size + \
+            sum(len(part) for part in self.result)
+        cache = ComparisonCache(
+            memory_entries=0,
+            disk_dir=self.disk_dir.name,
+            disk_max_bytes=entry_size * 2
+        )
+
+        for i in range(5):
+            cache.put(str(i), self.result)
+            # Ensure modification times are ordered
+            path = cache._disk_path(str(i))
+            os.utime(path, (i, i))
+
+        stats = cache.stats()
+        self.assertLessEqual(stats['disk_bytes'], entry_size * 2)
+        self.assertIsNone(cache.get('0'))
+        self.assertEqual(cache.get('4'), self.result)
+
+    def test_invalidate(self):
+        """Ensure invalidating a digest removes entries from both tiers."""
+        cache = ComparisonCache(memory_entries=4, disk_dir=self.disk_dir.name)
+        other_key = ComparisonCache.make_key(
+            self.digest_b,
+            self.digest_b,
+            'TreeComparison'
+        )
+        cache.put(self.key, self.result)
+        cache.put(other_key, self.result)
+
+        cache.invalidate(self.digest_a)
+
+        self.assertIsNone(cache.get(self.key))
+        self.assertEqual(cache.get(other_key), self.result)
+
+    def test_engine_options_in_key(self):
+        """Ensure different engine options produce different keys."""
+        other_key = ComparisonCache.make_key(
+            self.digest_a,
+            self.digest_b,
+            'TreeComparison:red'
+        )
+        self.assertNotEqual(self.key, other_key)
+
+
+if __name__ == '__main__':
+    main()
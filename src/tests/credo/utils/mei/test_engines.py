@@ -0,0 +1,46 @@
+from unittest import TestCase, main
+
+from credo.utils.mei.engines import TIERS, choose_tier, estimate_cost, \
+    get_engine, get_tier_engine
+from credo.utils.mei.measure_comparison import MeasureAlignedComparison
+from credo.utils.mei.tree_comparison import TreeComparison
+
+
+class TestEngines(TestCase):
+
+    def test_get_engine(self):
+        """Ensure engines and tiers are found by name, and unknown names are
+        rejected.
+        """
+        self.assertIsInstance(get_engine('measure'), MeasureAlignedComparison)
+        self.assertEqual(
+            get_tier_engine('accurate').diff_options,
+            TreeComparison.DEFAULT_DIFF_OPTIONS
+        )
+        self.assertEqual(
+            get_tier_engine('balanced').diff_options['ratio_mode'],
+            'faster'
+        )
+
+        with self.assertRaises(ValueError):
+            get_engine('unknown')
+        with self.assertRaises(ValueError):
+            get_tier_engine('unknown')
+
+    def test_choose_tier(self):
+        """Ensure the most accurate tier within the budget is chosen, falling
+        back to the fastest tier.
+        """
+        fast, balanced, accurate = TIERS
+        self.assertEqual(choose_tier(1000, budget=60), accurate)
+
+        nodes = 1000
+        while estimate_cost(accurate, nodes) <= 1:
+            nodes *= 2
+        self.assertEqual(choose_tier(nodes, budget=1), balanced)
+
+        self.assertEqual(choose_tier(nodes, budget=0), fast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+from unittest import TestCase, main, mock
+
+from credo.utils.mei.instrumentation import ComparisonTrace, \
+    InstrumentationSink, get_metrics_registry
+from credo.utils.mei.tree_comparison import TreeComparison
+from utils.mei.mei_transformer import MeiTransformer
+
+
+class RecordingSink(InstrumentationSink):
+    def __init__(self, traces_trees=False):
+        self.traces_trees = traces_trees
+        self.published = []
+        self.trees = []
+
+    def publish(self, phases):
+        self.published.append(phases)
+
+    def trace_tree(self, title, tree):
+        self.trees.append(title)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        mei_transformer_a = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_a.mei'
+        )
+        mei_transformer_b = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_b.mei'
+        )
+        mei_transformer_a.normalise()
+        mei_transformer_b.normalise()
+
+        self.tree_a = mei_transformer_a.tree
+        self.tree_b = mei_transformer_b.tree
+
+    def _compare(self, sink):
+        engine = TreeComparison()
+        with mock.patch(
+                'credo.utils.mei.instrumentation.get_sinks',
+                return_value=[sink]):
+            with engine.trace:
+                engine.compare_trees(self.tree_a, self.tree_b)
+        return engine
+
+    def test_phases_recorded(self):
+        """Ensure each phase of a comparison is timed and counted."""
+        sink = RecordingSink()
+        self._compare(sink)
+
+        self.assertEqual(len(sink.published), 1)
+        phases = {phase['phase']: phase for phase in sink.published[0]}
+        for name in ['to_intermediate', 'diff', 'patch', 'colour', 'merge']:
+            self.assertIn(name, phases)
+            self.assertEqual(phases[name]['calls'], 1)
+            self.assertGreaterEqual(phases[name]['wall'], 0)
+        self.assertGreater(phases['diff']['actions'], 0)
+        self.assertEqual(
+            phases['diff']['actions'],
+            phases['patch']['actions']
+        )
+
+    def test_trees_traced_only_when_active(self):
+        """Ensure trees are only dumped when a sink traces them."""
+        sink = RecordingSink()
+        self._compare(sink)
+        self.assertEqual(sink.trees, [])
+
+        sink = RecordingSink(traces_trees=True)
+        self._compare(sink)
+        self.assertIn('Difference', sink.trees)
+
+    def test_nested_publish(self):
+        """Ensure a trace is published once, when the outer block exits."""
+        sink = RecordingSink()
+        trace = ComparisonTrace()
+        with mock.patch(
+                'credo.utils.mei.instrumentation.get_sinks',
+                return_value=[sink]):
+            with trace:
+                with trace:
+                    with trace.phase('inner'):
+                        pass
+                self.assertEqual(sink.published, [])
+                with trace.phase('outer'):
+                    pass
+
+        self.assertEqual(len(sink.published), 1)
+        self.assertEqual(
+            [phase['phase'] for phase in sink.published[0]],
+            ['inner', 'outer']
+        )
+        self.assertEqual(len(trace.phases), 0)
+
+    def test_stream_phase(self):
+        """Ensure a streamed phase is published once its chunks are read."""
+        sink = RecordingSink()
+        trace = ComparisonTrace()
+        with mock.patch(
+                'credo.utils.mei.instrumentation.get_sinks',
+                return_value=[sink]):
+            with trace:
+                with trace.phase('diff'):
+                    pass
+                chunks = trace.stream_phase('encode', [b'a', b'b'])
+            self.assertEqual(sink.published, [])
+            self.assertEqual(list(chunks), [b'a', b'b'])
+
+        self.assertEqual(len(sink.published), 1)
+        phases = {phase['phase']: phase for phase in sink.published[0]}
+        self.assertEqual(list(phases), ['diff', 'encode'])
+        self.assertEqual(phases['encode']['calls'], 1)
+
+    def test_metrics_registry(self):
+        """Ensure the registry sums phases across comparisons."""
+        registry = get_metrics_registry()
+        registry.clear()
+        phase = {
+            'phase': 'diff',
+            'calls': 1,
+            'wall': 0.5,
+            'cpu': 0.25,
+            'nodes': 10,
+            'actions': 2
+        }
+        registry.record([phase])
+        registry.record([dict(phase, wall=1.5)])
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['comparisons'], 2)
+        self.assertEqual(snapshot['phases']['diff']['calls'], 2)
+        self.assertEqual(snapshot['phases']['diff']['wall'], 2.0)
+        self.assertEqual(snapshot['phases']['diff']['wall_max'], 1.5)
+        self.assertEqual(snapshot['phases']['diff']['actions'], 4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+from unittest import TestCase, main
+from copy import deepcopy
+
+from credo.utils.mei.measure_comparison import MeasureAlignedComparison
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
+
+
+class TestMeasureAlignedComparison(TestCase):
+
+    def setUp(self):
+        mei_transformer_a = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_a.mei'
+        )
+        mei_transformer_b = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_b.mei'
+        )
+        mei_transformer_a.normalise()
+        mei_transformer_b.normalise()
+
+        self.tree_a = mei_transformer_a.tree
+        self.tree_b = mei_transformer_b.tree
+
+        self.engine = MeasureAlignedComparison()
+
+    def test_identical_trees(self):
+        """Ensure comparing a tree with itself marks nothing as different."""
+        diff, a, b = self.engine.compare_trees(
+            self.tree_a,
+            deepcopy(self.tree_a)
+        )
+        self.assertIsNone(diff.find('.//*[@color]'))
+        for layer in diff.findall('.//mei:layer', MEI_NS):
+            self.assertRegex(layer.get(f'{{{MEI_NS["xml"]}}}id'), 'm-r[0-9]+')
+
+    def test_inserted_measure(self):
+        """Ensure a measure inserted into b is aligned, and does not cause the
+        measures after it to be marked as different.
+        """
+        tree_b = deepcopy(self.tree_a)
+        measures = tree_b.findall('.//mei:measure', MEI_NS)
+        measures[2].addnext(deepcopy(measures[5]))
+
+        diff, a, b = self.engine.compare_trees(self.tree_a, tree_b)
+        diff_measures = diff.findall('.//mei:measure', MEI_NS)
+        self.assertEqual(len(diff_measures), len(measures) + 1)
+
+        changed = [
+            i for i, measure in enumerate(diff_measures)
+            if measure.find('.//*[@color]') is not None
+        ]
+        self.assertEqual(changed, [3])
+
+    def test_compare_trees(self):
+        """Ensure every layer in the diff has a unique ID."""
+        diff, a, b = self.engine.compare_trees(self.tree_a, self.tree_b)
+        id_attrib = f'{{{MEI_NS["xml"]}}}id'
+        ids = [
+            layer.get(id_attrib)
+            for layer in diff.findall('.//mei:layer', MEI_NS)
+        ]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertIsNotNone(diff.find('.//*[@color]'))
+
+
+if __name__ == '__main__':
+    main()
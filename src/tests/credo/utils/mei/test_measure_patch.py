@@ -0,0 +1,92 @@
+from unittest import TestCase, main
+from io import BytesIO
+
+import lxml.etree as et
+
+from credo.utils.mei.measure_patch import find_measure, get_namespaces, \
+    parse_measure, patch_measures
+from utils.mei import queries
+from utils.mei.stream_normaliser import StreamNormaliser
+
+
+class TestMeasurePatch(TestCase):
+
+    def setUp(self):
+        # A file as it is stored after normalisation
+        output = BytesIO()
+        StreamNormaliser('./tests/credo/utils/mei/data/test_a.mei') \
+            .normalise(output)
+        self.data = output.getvalue()
+        self.tree = et.ElementTree(et.fromstring(self.data))
+        self.measures = queries.MEASURES(self.tree)
+        self.namespaces = get_namespaces(self.data)
+
+    def test_find_measure(self):
+        """Ensure measures are found by their IDs in the stored bytes."""
+        for measure in self.measures:
+            start, end = find_measure(self.data, measure.get(queries.XML_ID))
+            found = parse_measure(self.data[start:end], self.namespaces)
+            self.assertEqual(
+                et.tostring(found, with_tail=False),
+                et.tostring(measure, with_tail=False)
+            )
+
+        with self.assertRaises(ValueError):
+            find_measure(self.data, 'm-missing')
+
+    def test_patch_unchanged(self):
+        """Ensure patching measures with themselves leaves the file as it
+        was.
+        """
+        measures = {
+            measure.get(queries.XML_ID): et.tostring(measure, with_tail=False)
+            for measure in self.measures[::3]
+        }
+        data, _, old_measures = patch_measures(self.data, measures)
+
+        self.assertEqual(data, self.data)
+        self.assertEqual(len(old_measures), len(measures))
+
+    def test_patch(self):
+        """Ensure only the patched measures are changed."""
+        first = self.measures[0]
+        last = self.measures[-1]
+        patched = {}
+        for measure in [last, first]:
+            measure_id = measure.get(queries.XML_ID)
+            measure.set('label', 'patched')
+            measure.set('color', 'red')
+            patched[measure_id] = et.tostring(measure, with_tail=False)
+            del measure.attrib['color']
+
+        data, new_measures, _ = patch_measures(
+            self.data,
+            patched,
+            attribs=['color']
+        )
+        self.assertEqual(
+            [measure.get(queries.XML_ID) for measure in new_measures],
+            [first.get(queries.XML_ID), last.get(queries.XML_ID)]
+        )
+        tree = et.ElementTree(et.fromstring(data))
+        measures = queries.MEASURES(tree)
+
+        self.assertEqual(len(measures), len(self.measures))
+        for measure, expected in zip(measures, self.measures):
+            self.assertEqual(
+                et.tostring(measure, with_tail=False),
+                et.tostring(expected, with_tail=False)
+            )
+        # The namespace is declared once, on the root
+        self.assertEqual(data.count(b'xmlns='), self.data.count(b'xmlns='))
+
+    def test_invalid_measure(self):
+        """Ensure anything other than a single measure is rejected."""
+        with self.assertRaises(ValueError):
+            parse_measure('<staff/>')
+        with self.assertRaises(ValueError):
+            parse_measure('<measure>')
+
+
+if __name__ == '__main__':
+    main()
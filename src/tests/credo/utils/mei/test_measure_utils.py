@@ -0,0 +1,116 @@
+from unittest import TestCase, main
+from copy import deepcopy
+
+import lxml.etree as et
+
+from credo.utils.mei.measure_utils import compact_hidden_events, \
+    merge_measure_layers
+from credo.utils.mei.tree_comparison import TreeComparison
+from utils.mei import queries
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
+
+MEASURE = f'''
+<measure xmlns="{MEI_NS['mei']}" xmlns:xml="{MEI_NS['xml']}">
+  <staff n="1">
+    <layer xml:id="m-a0" n="1">
+      <note dur="4" pname="c" oct="4"/>
+      <note dur="4" pname="d" oct="4"/>
+      <note dur="4" pname="e" oct="4" visible="false"/>
+      <note dur="4" pname="f" oct="4"/>
+    </layer>
+    <layer xml:id="m-b0" n="2" visible="true">
+      <note dur="8" dots="1" pname="c" oct="4" visible="false"/>
+      <note dur="16" pname="c" oct="4" visible="false"/>
+      <beam visible="false">
+        <note dur="8" pname="d" oct="4" visible="false"/>
+        <note dur="8" pname="d" oct="4" visible="false"/>
+      </beam>
+      <note dur="4" pname="g" oct="4" visible="true"/>
+      <clef shape="F" line="4" visible="false"/>
+      <chord dur="4" visible="false">
+        <note pname="f" oct="4" visible="false"/>
+        <note pname="a" oct="4" visible="false"/>
+      </chord>
+    </layer>
+  </staff>
+</measure>
+'''
+
+
+class TestMeasureUtils(TestCase):
+
+    def setUp(self):
+        parser = et.XMLParser(remove_blank_text=True)
+        self.measure = et.fromstring(MEASURE, parser)
+        self.layer = queries.LAYERS(self.measure)[1]
+
+    def test_compact_hidden_events(self):
+        """Ensure runs of hidden events are replaced by spaces of the same
+        duration, leaving visible events and clefs in place.
+        """
+        self.assertEqual(compact_hidden_events(self.layer), 4)
+        self.assertEqual(
+            [
+                (et.QName(child).localname, child.get('dur'))
+                for child in self.layer
+            ],
+            [
+                ('space', '2'),
+                ('note', '4'),
+                ('clef', None),
+                ('space', '4'),
+            ]
+        )
+        # Spaces share the namespace declared on the measure
+        self.assertEqual(et.tostring(self.measure).count(b'xmlns='), 1)
+
+    def test_merge_unchanged(self):
+        """Ensure merging layers gives the same result with the hidden
+        events compacted.
+        """
+        expected = merge_measure_layers(deepcopy(self.measure))
+        compact_hidden_events(self.layer)
+        self.assertEqual(
+            et.tostring(merge_measure_layers(self.measure)),
+            et.tostring(expected)
+        )
+
+    def test_compact_diff(self):
+        """Ensure diffs made with hidden events compacted merge the same, and
+        are smaller.
+        """
+        trees = []
+        for name in ['test_a.mei', 'test_b.mei']:
+            transformer = MeiTransformer.from_xml_file(
+                f'./tests/credo/utils/mei/data/{name}'
+            )
+            transformer.normalise()
+            trees.append(transformer.tree)
+
+        diffs = []
+        for compact_hidden in [False, True]:
+            engine = TreeComparison()
+            engine.compact_hidden = compact_hidden
+            diff, _, _ = engine.compare_trees(*deepcopy(trees))
+            diffs.append(diff)
+
+        self.assertLess(len(et.tostring(diffs[1])), len(et.tostring(diffs[0])))
+        self.assertIsNotNone(diffs[1].find('.//mei:space', MEI_NS))
+
+        def merge(measure):
+            measure = deepcopy(measure)
+            try:
+                merged = merge_measure_layers(measure)
+            except ValueError:
+                return None
+            for elem in merged.iter(tag=et.Element):
+                elem.attrib.pop(queries.XML_ID, None)
+            return et.tostring(merged)
+
+        for measure, compacted in zip(*map(queries.MEASURES, diffs)):
+            self.assertEqual(merge(compacted), merge(measure))
+
+
+if __name__ == '__main__':
+    main()
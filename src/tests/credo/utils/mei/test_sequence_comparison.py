@@ -0,0 +1,126 @@
+from unittest import TestCase, main
+from copy import deepcopy
+from itertools import product
+
+import numpy as np
+
+from credo.utils.mei.sequence_comparison import SequenceAlignmentComparison, \
+    lcs_matches
+from credo.utils.mei import sequence_comparison
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
+
+
+def lcs_length(a, b) -> int:
+    # Textbook dynamic programming, to check the vectorised version
+    table = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i, j in product(range(len(a)), range(len(b))):
+        if a[i] == b[j]:
+            table[i + 1][j + 1] = table[i][j] + 1
+        else:
+            table[i + 1][j + 1] = max(table[i][j + 1], table[i + 1][j])
+    return table[-1][-1]
+
+
+class TestSequenceAlignmentComparison(TestCase):
+
+    def setUp(self):
+        mei_transformer_a = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_a.mei'
+        )
+        mei_transformer_b = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_b.mei'
+        )
+        mei_transformer_a.normalise()
+        mei_transformer_b.normalise()
+
+        self.tree_a = mei_transformer_a.tree
+        self.tree_b = mei_transformer_b.tree
+
+        self.engine = SequenceAlignmentComparison()
+
+    def test_lcs_matches(self):
+        """Ensure the matches are a longest common subsequence, with and
+        without the LCS table being kept.
+        """
+        random = np.random.RandomState(0)
+        full_table_cells = sequence_comparison.FULL_TABLE_CELLS
+        try:
+            for cells in [full_table_cells, 16]:
+                sequence_comparison.FULL_TABLE_CELLS = cells
+                for _ in range(50):
+                    a = random.randint(0, 4, random.randint(0, 30))
+                    b = random.randint(0, 4, random.randint(0, 30))
+                    matches = lcs_matches(a, b)
+
+                    self.assertEqual(len(matches), lcs_length(a, b))
+                    for (a_idx, b_idx), (a_next, b_next) in zip(
+                            matches, matches[1:]):
+                        self.assertLess(a_idx, a_next)
+                        self.assertLess(b_idx, b_next)
+                    for a_idx, b_idx in matches:
+                        self.assertEqual(a[a_idx], b[b_idx])
+        finally:
+            sequence_comparison.FULL_TABLE_CELLS = full_table_cells
+
+    def test_identical_trees(self):
+        """Ensure comparing a tree with itself marks nothing as different."""
+        diff, a, b = self.engine.compare_trees(
+            self.tree_a,
+            deepcopy(self.tree_a)
+        )
+        self.assertIsNone(diff.find('.//*[@color]'))
+        for layer in diff.findall('.//mei:layer', MEI_NS):
+            self.assertRegex(layer.get(f'{{{MEI_NS["xml"]}}}id'), 'm-r[0-9]+')
+
+    def test_changed_note(self):
+        """Ensure a note changed in b is marked as different in a and b, and
+        nothing outside its measure is.
+        """
+        tree_b = deepcopy(self.tree_a)
+        note = tree_b.findall('.//mei:note', MEI_NS)[10]
+        note.set('dur', '1' if note.get('dur') != '1' else '2')
+
+        diff, a, b = self.engine.compare_trees(self.tree_a, tree_b)
+        changed = [
+            measure for measure in diff.findall('.//mei:measure', MEI_NS)
+            if measure.find('.//*[@color]') is not None
+        ]
+        self.assertEqual(len(changed), 1)
+
+        colours = {elem.get('color') for elem in changed[0].iter()}
+        self.assertIn(self.engine.a_colour_str, colours)
+        self.assertIn(self.engine.b_colour_str, colours)
+
+    def test_inserted_measure(self):
+        """Ensure a measure inserted into b is aligned, and only it is marked
+        as different.
+        """
+        tree_b = deepcopy(self.tree_a)
+        measures = tree_b.findall('.//mei:measure', MEI_NS)
+        measures[2].addnext(deepcopy(measures[5]))
+
+        diff, a, b = self.engine.compare_trees(self.tree_a, tree_b)
+        diff_measures = diff.findall('.//mei:measure', MEI_NS)
+        self.assertEqual(len(diff_measures), len(measures) + 1)
+
+        changed = [
+            i for i, measure in enumerate(diff_measures)
+            if measure.find('.//*[@color]') is not None
+        ]
+        self.assertEqual(changed, [3])
+
+    def test_compare_trees(self):
+        """Ensure every layer in the diff has a unique ID."""
+        diff, a, b = self.engine.compare_trees(self.tree_a, self.tree_b)
+        id_attrib = f'{{{MEI_NS["xml"]}}}id'
+        ids = [
+            layer.get(id_attrib)
+            for layer in diff.findall('.//mei:layer', MEI_NS)
+        ]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertIsNotNone(diff.find('.//*[@color]'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+from unittest import TestCase, main
+from copy import deepcopy
+
+import lxml.etree as et
+
+from credo.utils.mei.subtree_hash import subtree_hashes
+from credo.utils.mei.tree_comparison import TreeComparison
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
+
+
+class TestSubtreeHash(TestCase):
+
+    def setUp(self):
+        mei_transformer_a = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_a.mei'
+        )
+        mei_transformer_b = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_b.mei'
+        )
+        mei_transformer_a.normalise()
+        mei_transformer_b.normalise()
+
+        self.tree_a = mei_transformer_a.tree
+        self.tree_b = mei_transformer_b.tree
+
+    def _measure_hashes(self, tree):
+        hashes = subtree_hashes(tree)
+        return [hashes[bar] for bar in tree.iterfind('//mei:measure', MEI_NS)]
+
+    def test_ids_ignored(self):
+        """Ensure subtrees differing only by xml:id hash equally."""
+        tree = deepcopy(self.tree_a)
+        for idx, elem in enumerate(tree.iterfind('//mei:note', MEI_NS)):
+            elem.set(f'{{{MEI_NS["xml"]}}}id', f'other-{idx}')
+
+        self.assertEqual(
+            self._measure_hashes(self.tree_a),
+            self._measure_hashes(tree)
+        )
+
+    def test_attribute_order_ignored(self):
+        """Ensure the order of attributes does not affect the hash."""
+        template = '<measure xmlns="{}"><staff {} /></measure>'
+        a = et.fromstring(template.format(MEI_NS['mei'], 'n="1" lines="5"'))
+        b = et.fromstring(template.format(MEI_NS['mei'], 'lines="5" n="1"'))
+        self.assertEqual(subtree_hashes(a)[a], subtree_hashes(b)[b])
+
+    def test_changes_detected(self):
+        """Ensure changing a note changes the hash of its measure only."""
+        tree = deepcopy(self.tree_a)
+        bar = tree.findall('//mei:measure', MEI_NS)[1]
+        bar.find('.//mei:note', MEI_NS).set('pname', 'x')
+
+        before = self._measure_hashes(self.tree_a)
+        after = self._measure_hashes(tree)
+        changed = [i for i, (x, y) in enumerate(zip(before, after)) if x != y]
+        self.assertEqual(changed, [1])
+
+    def test_pruned_comparison(self):
+        """Ensure identical subtrees are pruned, and never marked as
+        different.
+        """
+        engine = TreeComparison()
+        diff, a, b = engine.compare_trees(self.tree_a, self.tree_b)
+        self.assertGreater(engine.pruned_percentage, 0)
+        self.assertIsNone(diff.find('//*[@credo-pruned]'))
+
+        diff, a, b = engine.compare_trees(self.tree_a, deepcopy(self.tree_a))
+        self.assertIsNone(diff.find('.//*[@color]'))
+
+
+if __name__ == '__main__':
+    main()
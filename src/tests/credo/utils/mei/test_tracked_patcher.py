@@ -1,5 +1,7 @@
 from unittest import TestCase, main, skip
+import lxml.etree as et
 from xmldiff import main as xmldiff_main
+from xmldiff.patch import Patcher
 
 from credo.utils.mei.tracked_patcher import TrackedPatcher
 from utils.mei.mei_transformer import MeiTransformer
@@ -43,6 +45,28 @@ class TestTrackedPatcher(TestCase):
         self.assertEqual(result, self.tree_b)
         self.assertIsNot(result, self.tree_b)
 
+    def test_matches_patcher(self):
+        """Ensure the patcher produces the same tree as xmldiff's patcher,
+        whose paths are resolved without caching.
+        """
+        expected = Patcher().patch(self.diff_actions, self.tree_a)
+        result = TrackedPatcher().patch(self.diff_actions, self.tree_a)
+        self.assertEqual(et.tostring(result), et.tostring(expected))
+
+    def test_modifications_tracked(self):
+        """Ensure every action is registered against exactly one node."""
+        patcher = TrackedPatcher()
+        patcher.patch(self.diff_actions, self.tree_a)
+        modifications = [
+            action
+            for node in patcher.nodes
+            for action in node.modifications
+        ]
+        self.assertEqual(len(modifications), len(self.diff_actions))
+
+        modified = [node.modified for node in patcher.nodes]
+        self.assertEqual(len(modified), len(set(modified)))
+
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,59 @@
 from unittest import TestCase, main
+from copy import deepcopy
+
+from credo.utils.mei.deadline import ComparisonCancelled, Deadline
+from credo.utils.mei.tree_comparison import TreeComparison
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.xml_namespaces import MEI_NS
 
 
 class TestTreeComparison(TestCase):
 
     def setUp(self):
-        return
+        mei_transformer_a = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_a.mei'
+        )
+        mei_transformer_b = MeiTransformer.from_xml_file(
+            './tests/credo/utils/mei/data/test_b.mei'
+        )
+        mei_transformer_a.normalise()
+        mei_transformer_b.normalise()
+
+        self.tree_a = mei_transformer_a.tree
+        self.tree_b = mei_transformer_b.tree
+
+        self.engine = TreeComparison()
+
+    def test_deadline_fallback(self):
+        """Ensure a comparison past its deadline falls back to marking whole
+        measures as different, leaving a and b intact.
+        """
+        expected_a = deepcopy(self.tree_a)
+        self.engine.compare_trees(expected_a, deepcopy(self.tree_b))
+
+        self.engine.deadline = Deadline(0)
+        with self.engine.trace:
+            diff, a, b = self.engine.compare_trees(self.tree_a, self.tree_b)
+            self.assertTrue(self.engine.coarse)
+
+        self.assertEqual(len(a.getroot()), len(expected_a.getroot()))
+        self.assertIsNone(a.find('.//*[@credo-pruned]'))
+
+        changed = 0
+        for measure in diff.findall('.//mei:measure', MEI_NS):
+            notes = measure.findall('.//mei:note', MEI_NS)
+            coloured = measure.findall('.//mei:note[@color]', MEI_NS)
+            # Every note of a changed measure is marked
+            self.assertIn(len(coloured), [0, len(notes)])
+            changed += len(coloured) > 0
+        self.assertGreater(changed, 0)
+
+    def test_cancel(self):
+        """Ensure a cancelled comparison is stopped, not given a fallback."""
+        self.engine.deadline = Deadline()
+        self.engine.deadline.cancel()
+        with self.assertRaises(ComparisonCancelled):
+            self.engine.compare_trees(self.tree_a, self.tree_b)
 
 
 if __name__ == '__main__':
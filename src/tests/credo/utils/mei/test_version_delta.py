@@ -0,0 +1,96 @@
+from copy import deepcopy
+from unittest import TestCase, main
+from io import BytesIO
+
+import lxml.etree as et
+
+from credo.utils.mei.version_delta import apply_delta, make_delta, \
+    make_snapshot, read_snapshot, split_chunks
+from utils.mei import queries
+from utils.mei.stream_normaliser import StreamNormaliser
+
+
+class TestVersionDelta(TestCase):
+
+    def setUp(self):
+        self.data = self.normalise('./tests/credo/utils/mei/data/test_a.mei')
+
+    def normalise(self, source) -> bytes:
+        output = BytesIO()
+        StreamNormaliser(source).normalise(output)
+        return output.getvalue()
+
+    def add_note(self) -> bytes:
+        # Copy a note in the second measure, and renormalise, which
+        # renumbers every ID after it
+        tree = et.ElementTree(et.fromstring(self.data))
+        note = next(queries.MEASURES(tree)[1].iter(queries.NOTE))
+        copy = deepcopy(note)
+        for node in copy.iter():
+            node.attrib.pop(queries.XML_ID, None)
+        note.addnext(copy)
+        return self.normalise(BytesIO(et.tostring(tree, encoding='utf-8')))
+
+    def test_split_chunks(self):
+        """Ensure chunks start at measures and join back into the file."""
+        chunks = split_chunks(self.data)
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(
+            len(chunks) - 1,
+            self.data.count(b'<measure ')
+        )
+        for chunk in chunks[1:]:
+            self.assertTrue(chunk.startswith(b'<measure'))
+
+    def test_round_trip(self):
+        """Ensure deltas rebuild the newer version, whatever changed."""
+        chunks = split_chunks(self.data)
+        versions = [
+            self.data,
+            # A changed measure
+            self.data.replace(b'<measure ', b'<measure label="x" ', 1),
+            # Measures removed, and another moved to the end
+            b''.join(chunks[:2] + chunks[4:] + chunks[2:3]),
+            # IDs renumbered
+            self.add_note(),
+            # IDs renumbered, and one renumbered differently
+            self.add_note().replace(b'"m-50"', b'"m-1000"'),
+            # An ID without a number
+            self.data.replace(b'"m-1"', b'"m-"'),
+            b'',
+            # Not UTF-8
+            self.data + b'\xff',
+        ]
+        for old in versions:
+            for new in versions:
+                self.assertEqual(apply_delta(old, make_delta(old, new)), new)
+
+        self.assertEqual(read_snapshot(make_snapshot(self.data)), self.data)
+
+    def test_delta_size(self):
+        """Ensure a delta for a changed measure is much smaller than a
+        snapshot.
+        """
+        new = self.data.replace(b'<measure ', b'<measure label="x" ', 1)
+        self.assertLess(
+            len(make_delta(self.data, new)) * 4,
+            len(make_snapshot(new))
+        )
+
+    def test_renumbered_delta_size(self):
+        """Ensure a delta for an edit which renumbers the IDs after it is
+        much smaller than a snapshot.
+        """
+        new = self.add_note()
+        self.assertNotEqual(
+            split_chunks(self.data)[-1],
+            split_chunks(new)[-1]
+        )
+        self.assertLess(
+            len(make_delta(self.data, new)) * 4,
+            len(make_snapshot(new))
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+from copy import deepcopy
 from unittest import TestCase, main
+from lxml import etree
 from utils.mei.mei_transformer import MeiTransformer
 from utils.mei.xml_namespaces import MEI_NS
 
@@ -102,6 +104,95 @@ class TestMeiTransformer(TestCase):
 
         self.assertFalse(self.meiTransformer.is_intermediate)
 
+    def test_normalise_matches_separate_passes(self):
+        """Verify combined normalisation matches the separate passes
+
+        Asserts that normalise produces byte-identical output and the same ID
+        map as removing metadata, stripping attributes and generating IDs in
+        turn, for the test scores and a tree with comments and trills
+        referencing elements before and after them.
+        """
+        trills = MeiTransformer.from_xml_string(
+            '<mei xmlns="http://www.music-encoding.org/ns/mei" '
+            'xmlns:xml="http://www.w3.org/XML/1998/namespace">'
+            '<meiHead><title xml:id="h1"/></meiHead>'
+            '<music><!-- comment --><measure xml:id="m1" color="red">'
+            '<trill startid="#n2"/><trill startid="#n1"/>'
+            '<note xml:id="n1" pnum="60" visible="false"/><!-- comment -->'
+            '<instrDef xml:id="i1"><note xml:id="n3"/></instrDef>'
+            '<note xml:id="n2"/><trill startid="#n2"/>'
+            '<trill startid="missing"/></measure></music></mei>'
+        ).tree
+
+        trees = [trills] + [
+            MeiTransformer.from_xml_file(filename).tree
+            for filename in [
+                './tests/utils/mei/data/test.mei',
+                './tests/credo/utils/mei/data/test_a.mei',
+                './tests/credo/utils/mei/data/test_b.mei',
+                './credo/migrations/seed_mei/diffA.mei'
+            ]
+        ]
+
+        for tree in trees:
+            fused = MeiTransformer(deepcopy(tree))
+            fused.normalise()
+
+            separate = MeiTransformer(deepcopy(tree))
+            separate.remove_metadata()
+            separate.strip_attribs(['color', 'visible'])
+            separate.generate_ids()
+
+            self.assertEqual(
+                etree.tostring(fused.tree),
+                etree.tostring(separate.tree)
+            )
+            self.assertEqual(fused.get_id_map(), separate.get_id_map())
+
+    def test_borrow_take_copy(self):
+        """Verify the ownership of the tree is respected
+
+        Asserts that borrowing returns the internal tree, copying and the
+        tree property return independent copies, and taking returns the
+        internal tree and stops the transformer from being used.
+        """
+        borrowed = self.meiTransformer.borrow()
+        self.assertIs(self.meiTransformer.borrow(), borrowed)
+
+        copied = self.meiTransformer.copy()
+        self.assertIsNot(copied, borrowed)
+        self.assertIsNot(self.meiTransformer.tree, borrowed)
+        self.assertEqual(etree.tostring(copied), etree.tostring(borrowed))
+
+        self.meiTransformer.normalise()
+        self.assertIsNone(borrowed.find('.//mei:meiHead', MEI_NS))
+        self.assertIsNotNone(copied.find('.//mei:meiHead', MEI_NS))
+
+        self.assertIs(self.meiTransformer.take(), borrowed)
+        with self.assertRaises(ValueError):
+            self.meiTransformer.borrow()
+        with self.assertRaises(ValueError):
+            self.meiTransformer.normalise()
+
+    def test_copy_on_write(self):
+        """Verify a copy on write transformer leaves its tree unchanged
+
+        Asserts that the tree is only copied when it is first modified, and
+        that taking the tree before then returns a copy.
+        """
+        tree = self.meiTransformer.take()
+        before = etree.tostring(tree)
+
+        transformer = MeiTransformer(tree, copy_on_write=True)
+        self.assertIs(transformer.borrow(), tree)
+        transformer.normalise()
+        self.assertIsNot(transformer.borrow(), tree)
+        self.assertEqual(etree.tostring(tree), before)
+        self.assertIsNone(transformer.borrow().find('.//mei:meiHead', MEI_NS))
+
+        unmodified = MeiTransformer(tree, copy_on_write=True)
+        self.assertIsNot(unmodified.take(), tree)
+
 
 if __name__ == '__main__':
     main()
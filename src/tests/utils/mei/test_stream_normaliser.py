@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+from unittest import TestCase, main
+from lxml import etree
+from utils.mei import queries
+from utils.mei.mei_transformer import MeiTransformer
+from utils.mei.stream_normaliser import StreamIntermediate, StreamNormaliser
+
+TRILLS_MEI = (
+    b'<?xml version="1.0"?>\n'
+    b'<!DOCTYPE mei SYSTEM "mei.dtd">\n'
+    b'<?xml-model href="mei.rng"?>\n'
+    b'<mei xmlns="http://www.music-encoding.org/ns/mei" '
+    b'xmlns:xlink="http://www.w3.org/1999/xlink" xml:id="r">\n'
+    b'<meiHead><title xml:id="h1"/></meiHead>\n'
+    b'<music><!-- comment --><measure xml:id="m1" color="red">'
+    b'<trill startid="#n2"/><trill startid="#n1"/>'
+    b'<note xml:id="n1" pnum="60" visible="false" xlink:href="a&amp;b" '
+    b'label="&lt;&quot;&#10;&#9;&#233;&gt;">t&amp;&lt;&gt;</note>'
+    b'<!-- comment -->'
+    b'<instrDef xml:id="i1"><note xml:id="n3"/></instrDef>tail'
+    b'<note xml:id="n2"/><trill startid="#n2"/><chord><meiHead/></chord>'
+    b'<trill startid="missing"/></measure></music></mei>\n'
+    b'<!-- after -->\n'
+)
+
+# A doctype with an internal subset, after a comment
+SUBSET_MEI = (
+    b'<?xml version="1.0"?>\n'
+    b'<!-- before -->\n'
+    b'<!DOCTYPE mei SYSTEM "mei.dtd" [\n'
+    b'  <!ENTITY   title "a &amp; b">\n'
+    b'  <!-- within ]> -->\n'
+    b'  <?subset pi?>\n'
+    b']>\n'
+    b'<mei xmlns="http://www.music-encoding.org/ns/mei" xml:id="r">'
+    b'<music><measure xml:id="m1"><note xml:id="n1" label="&title;"/>'
+    b'</measure></music></mei>\n'
+)
+
+
+class TestStreamNormaliser(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _save(self, transformer: MeiTransformer) -> bytes:
+        filename = os.path.join(self.directory.name, 'saved.mei')
+        transformer.save_xml_file(filename)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def _sources(self):
+        trills = os.path.join(self.directory.name, 'trills.mei')
+        with open(trills, 'wb') as f:
+            f.write(TRILLS_MEI)
+        subset = os.path.join(self.directory.name, 'subset.mei')
+        with open(subset, 'wb') as f:
+            f.write(SUBSET_MEI)
+
+        return [
+            trills,
+            subset,
+            './tests/utils/mei/data/test.mei',
+            './tests/credo/utils/mei/data/test_a.mei',
+            './tests/credo/utils/mei/data/test_b.mei',
+            './credo/migrations/seed_mei/diffA.mei'
+        ]
+
+    def test_matches_normalise(self):
+        """Verify streaming normalisation matches normalise
+
+        Asserts that the streamed output is byte-identical to normalising the
+        whole tree and saving it, and that the tracked IDs are mapped to the
+        same new IDs. 'none' is not an ID in any of the sources.
+        """
+        for source in self._sources():
+            transformer = MeiTransformer.from_xml_file(source)
+            transformer.normalise()
+            id_map = transformer.get_id_map()
+
+            output = io.BytesIO()
+            normaliser = StreamNormaliser(source)
+            normaliser.normalise(output, tracked_ids=['n1', 'm-5', 'none'])
+
+            self.assertEqual(output.getvalue(), self._save(transformer))
+            # The map also contains the IDs referenced by trills
+            stream_id_map = normaliser.get_id_map()
+            for old_id, new_id in stream_id_map.items():
+                self.assertEqual(id_map[old_id], new_id)
+            for old_id in ['n1', 'm-5']:
+                if old_id in id_map:
+                    self.assertIn(old_id, stream_id_map)
+
+    def test_matches_remove_metadata(self):
+        """Verify streaming without generating IDs matches remove_metadata
+        """
+        for source in self._sources():
+            transformer = MeiTransformer.from_xml_file(source)
+            transformer.remove_metadata()
+
+            output = io.BytesIO()
+            with open(source, 'rb') as f:
+                StreamNormaliser(f, attribs=(), generate_ids=False) \
+                    .normalise(output)
+
+            self.assertEqual(output.getvalue(), self._save(transformer))
+
+    def test_matches_to_intermediate(self):
+        """Verify streaming conversion matches to_intermediate
+
+        Asserts that the streamed intermediate representation, and the counts
+        of measures, staffs and layers, match converting the whole tree, for
+        both the sources and their intermediate representations, which are
+        written as they are.
+        """
+        for source in self._sources():
+            for intermediate in [False, True]:
+                transformer = MeiTransformer.from_xml_file(source)
+                if intermediate:
+                    transformer.to_intermediate()
+                    source = io.BytesIO(
+                        etree.tostring(transformer.borrow(), encoding='utf-8')
+                    )
+                else:
+                    transformer.to_intermediate()
+                tree = transformer.take()
+
+                output = io.BytesIO()
+                converter = StreamIntermediate(source)
+                converter.convert(output)
+
+                self.assertEqual(
+                    output.getvalue(),
+                    etree.tostring(tree, encoding='utf-8')
+                )
+                self.assertEqual(
+                    converter.measure_count,
+                    len(queries.MEASURES(tree))
+                )
+                self.assertEqual(
+                    converter.staff_count,
+                    len(queries.STAFFS(tree))
+                )
+                self.assertEqual(
+                    converter.layer_count,
+                    len(queries.LAYERS(tree))
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Precompiled XPath queries and tag names shared by the MEI utilities.
+#
+# Compiling an XPath is far more expensive than evaluating it on a small
+# subtree, so queries are compiled once here rather than in loops. Queries
+# parameterised by a tag name are compiled on first use and then reused.
+
+from functools import lru_cache
+
+from lxml import etree
+
+from .xml_namespaces import MEI_NS
+
+
+def mei_tag(localname: str) -> str:
+    """
+    Return the qualified tag name of an MEI element, as used by lxml.
+    """
+    return etree.QName(MEI_NS['mei'], localname).text
+
+
+# Attribute names
+XML_ID = etree.QName(MEI_NS['xml'], 'id').text
+
+# Tag names
+MEASURE = mei_tag('measure')
+STAFF = mei_tag('staff')
+LAYER = mei_tag('layer')
+NOTE = mei_tag('note')
+REST = mei_tag('rest')
+SPACE = mei_tag('space')
+PAD = mei_tag('pad')
+CHORD = mei_tag('chord')
+BEAM = mei_tag('beam')
+TUPLET = mei_tag('tuplet')
+GRACE_GRP = mei_tag('graceGrp')
+TRILL = mei_tag('trill')
+MEI_HEAD = mei_tag('meiHead')
+INSTR_DEF = mei_tag('instrDef')
+
+# Queries over a whole tree
+MEASURES = etree.XPath('//mei:measure', namespaces=MEI_NS)
+STAFFS = etree.XPath('//mei:staff', namespaces=MEI_NS)
+LAYERS = etree.XPath('//mei:layer', namespaces=MEI_NS)
+TRILLS = etree.XPath('//mei:trill', namespaces=MEI_NS)
+MEI_HEADS = etree.XPath('mei:meiHead', namespaces=MEI_NS)
+INSTR_DEFS = etree.XPath('.//mei:instrDef', namespaces=MEI_NS)
+PLAIN_NOTES = etree.XPath('.//mei:note[@oct][@pname]', namespaces=MEI_NS)
+INTERMEDIATE_NOTES = etree.XPath('.//mei:note[@octname]', namespaces=MEI_NS)
+HAS_INTERMEDIATE_NOTES = etree.XPath(
+    'boolean(.//mei:note[@octname])',
+    namespaces=MEI_NS
+)
+MIDI_NOTES = etree.XPath('.//mei:note[@pnum]', namespaces=MEI_NS)
+
+# Queries relative to an element
+CHILD_STAFFS = etree.XPath('child::mei:staff', namespaces=MEI_NS)
+CHILD_LAYERS = etree.XPath('child::mei:layer', namespaces=MEI_NS)
+
+
+@lru_cache(maxsize=None)
+def child_query(localname: str) -> etree.XPath:
+    """
+    Return a query for the MEI children of an element with a given name.
+    """
+    return etree.XPath(f'child::mei:{localname}', namespaces=MEI_NS)
+
+
+@lru_cache(maxsize=None)
+def descendant_query(localname: str) -> etree.XPath:
+    """
+    Return a query for the MEI descendants of an element with a given name.
+    """
+    return etree.XPath(f'.//mei:{localname}', namespaces=MEI_NS)
+
+
+@lru_cache(maxsize=None)
+def ancestor_query(localname: str) -> etree.XPath:
+    """
+    Return a query for the MEI ancestors of an element with a given name.
+    """
+    return etree.XPath(f'ancestor::mei:{localname}', namespaces=MEI_NS)
+
+
+@lru_cache(maxsize=None)
+def ancestor_or_self_query(localname: str) -> etree.XPath:
+    """
+    Return a query for the element, and its MEI ancestors, with a given name.
+    """
+    return etree.XPath(f'ancestor-or-self::mei:{localname}', namespaces=MEI_NS)
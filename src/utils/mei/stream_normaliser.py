@@ -0,0 +1,535 @@
+from __future__ import annotations
+
+import io
+import re
+import typing as t
+
+from lxml import etree
+
+from . import queries
+from .id_formatters import get_formatted_xml_id
+
+# A filename, or a seekable binary file, as the source is read once per pass
+Source = t.Union[str, t.BinaryIO]
+
+EVENTS = ('start', 'end', 'comment', 'pi')
+# The namespace declarations at the start of a serialised element
+NAMESPACE_DECLARATIONS = re.compile(r'(?: xmlns(?::[^=]+)?="[^"]*")*')
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+# Characters escaped by libxml2 when serializing text and attribute values
+TEXT_ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '\r': '&#13;'
+})
+ATTRIB_ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    '\n': '&#10;',
+    '\r': '&#13;',
+    '\t': '&#9;'
+})
+
+
+class _StreamWriter:
+    """
+    Rewrite an MEI file without loading it into memory, serialising it as
+    libxml2 would. Subclasses choose which subtrees are removed and how the
+    attributes of each element are rewritten.
+    """
+
+    def __init__(self, source: Source):
+        self._source = source
+
+    def _events(self) -> t.Iterator[t.Tuple[str, etree._Element]]:
+        """
+        Iterate over the parse events of the nodes which are kept, in
+        document order.
+
+        Each element is cleared, and its earlier siblings removed, once the
+        event after its end event has been handled, as its tail is not parsed
+        until then. The parsed tree therefore never grows beyond the current
+        element's ancestors.
+        """
+        if hasattr(self._source, 'seek'):
+            self._source.seek(0)
+
+        context = etree.iterparse(
+            self._source,
+            events=EVENTS,
+            remove_blank_text=True
+        )
+
+        # Depth within the document, and within a removed subtree
+        depth = 0
+        removed_depth = 0
+        ended = None
+        for event, node in context:
+            if removed_depth > 0:
+                if event == 'start':
+                    removed_depth += 1
+                    depth += 1
+                elif event == 'end':
+                    removed_depth -= 1
+                    depth -= 1
+                    if removed_depth == 0:
+                        node.clear()
+                continue
+
+            if event == 'start':
+                depth += 1
+                if self._is_removed(node, depth):
+                    removed_depth = 1
+                    continue
+            elif event == 'end':
+                depth -= 1
+
+            yield event, node
+
+            if ended is not None:
+                _drop(ended)
+                ended = None
+            if event == 'end':
+                ended = node
+
+    def _is_removed(self, node: etree._Element, depth: int) -> bool:
+        return False
+
+    def _rewrite_attribs(
+            self,
+            node: etree._Element,
+            index: int) -> t.Dict[str, str]:
+        """
+        Return the attributes to write for an element, given its position in
+        document order.
+        """
+        return dict(node.attrib)
+
+    def _write(self, f: t.BinaryIO) -> None:
+        out = io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+        # The wrapper is detached even if writing fails, so that it does not
+        # close the file when it is collected
+        try:
+            for part in self._serialise():
+                out.write(part)
+        finally:
+            out.flush()
+            out.detach()
+
+    def _get_prolog(self, root: etree._Element) -> str:
+        """
+        Return what is written before the root element, given its start
+        event.
+        """
+        return _get_prolog(root)
+
+    def _serialise_node(
+            self,
+            node: etree._Element,
+            nsmap: t.Dict[t.Optional[str], str]) -> str:
+        """
+        Serialise a node which is written whole, given the namespaces of its
+        parent.
+        """
+        return etree.tostring(node, encoding='unicode', with_tail=False)
+
+    def _serialise(self) -> t.Iterator[str]:
+        """
+        Serialise the document in parts, as it is parsed.
+        """
+        index = 0
+        started = False
+        # The node whose start tag, text or tail is yet to be finished
+        pending = None
+        pending_part = None
+        # Qualified names of the open elements, and their namespaces
+        open_tags = []
+        nsmaps = [{}]
+        qnames = {}
+
+        for event, node in self._events():
+            if not started:
+                # Comments and processing instructions before the root,
+                # including those within the internal subset of the doctype,
+                # are written with it as part of the prolog
+                if event != 'start':
+                    continue
+                yield self._get_prolog(node)
+                started = True
+
+            if pending_part == 'start':
+                if event == 'end' and node is pending and node.text is None:
+                    # Elements without content are written as <tag/>
+                    yield '/>'
+                    open_tags.pop()
+                    nsmaps.pop()
+                    pending, pending_part = node, 'tail'
+                    continue
+                yield '>'
+                pending_part = 'text'
+            if pending_part == 'text' and pending.text is not None:
+                yield pending.text.translate(TEXT_ESCAPES)
+            elif pending_part == 'tail' and pending.tail is not None:
+                yield pending.tail.translate(TEXT_ESCAPES)
+            pending = pending_part = None
+
+            if event == 'start':
+                nsmap = node.nsmap
+                prefix = node.prefix
+                qname = qnames.get((node.tag, prefix))
+                if qname is None:
+                    qname = qnames[(node.tag, prefix)] = _qname(
+                        node.tag, prefix
+                    )
+
+                parts = ['<', qname, _declare_namespaces(nsmap, nsmaps[-1])]
+
+                attrib = self._rewrite_attribs(node, index)
+                for name, value in attrib.items():
+                    if name[0] == '{':
+                        name = _attrib_qname(name, nsmap)
+                    parts.append(f' {name}="')
+                    parts.append(value.translate(ATTRIB_ESCAPES))
+                    parts.append('"')
+
+                yield ''.join(parts)
+                open_tags.append(qname)
+                nsmaps.append(nsmap)
+                pending, pending_part = node, 'start'
+                index += 1
+            elif event == 'end':
+                yield f'</{open_tags.pop()}>'
+                nsmaps.pop()
+                pending, pending_part = node, 'tail'
+            else:
+                yield self._serialise_node(node, nsmaps[-1])
+                if node.getparent() is not None:
+                    pending, pending_part = node, 'tail'
+                    index += 1
+
+
+class StreamNormaliser(_StreamWriter):
+    """
+    Normalise an MEI file without loading it into memory, writing the same
+    bytes as MeiTransformer.normalise followed by save_xml_file.
+
+    The source is parsed three times, and only the ancestors of the current
+    element are kept in memory by each pass:
+        1. Find the IDs referenced by trills
+        2. Find the new IDs of those elements, and of any tracked IDs
+        3. Write the normalised MEI, renumbering IDs as it goes
+
+    As the full mapping of old to new IDs is not kept, get_id_map only
+    contains the IDs passed to normalise as tracked IDs, and those referenced
+    by trills.
+    """
+
+    def __init__(
+            self,
+            source: Source,
+            attribs: t.Sequence[str] = ('color', 'visible'),
+            generate_ids: bool = True):
+        super().__init__(source)
+        self._attribs = attribs
+        self._generate_ids = generate_ids
+        self._id_map = {}
+        self._trill_refs = {}
+        self._trill_position = 0
+
+    def normalise(
+            self,
+            output: t.Union[str, t.BinaryIO],
+            tracked_ids: t.Iterable[str] = ()) -> None:
+        """
+        Write the normalised MEI to a filename or binary file, which must not
+        be the source.
+        """
+        self._id_map = {}
+        self._trill_refs = {}
+        self._trill_position = 0
+        if self._generate_ids:
+            self._trill_refs = self._find_trill_refs()
+            wanted = set(tracked_ids)
+            wanted.update(
+                ref[1:] for ref in self._trill_refs if ref.startswith('#')
+            )
+            self._id_map = self._find_new_ids(wanted)
+
+        if isinstance(output, str):
+            with open(output, 'wb') as f:
+                self._write(f)
+        else:
+            self._write(output)
+
+    def get_id_map(self) -> t.Dict[str, str]:
+        """
+        Return the mapping of tracked MEI IDs to new MEI IDs.
+        """
+        return self._id_map
+
+    def _is_removed(self, node: etree._Element, depth: int) -> bool:
+        return node.tag == queries.INSTR_DEF or \
+            (node.tag == queries.MEI_HEAD and depth == 2)
+
+    def _find_trill_refs(self) -> t.Dict[str, int]:
+        """
+        Return the position, among the trills with references, of the last
+        trill to reference each ID. As in MeiTransformer.generate_ids, only
+        that trill's reference is updated.
+        """
+        refs = {}
+        position = 0
+        for event, node in self._events():
+            if event == 'start' and node.tag == queries.TRILL:
+                referenced_id = node.get('startid')
+                if referenced_id is not None:
+                    refs[referenced_id] = position
+                    position += 1
+        return refs
+
+    def _find_new_ids(self, wanted: t.Set[str]) -> t.Dict[str, str]:
+        id_map = {}
+        index = 0
+        for event, node in self._events():
+            if event == 'start':
+                id_val = node.get(queries.XML_ID)
+                if id_val in wanted:
+                    id_map[id_val] = get_formatted_xml_id(index)
+                index += 1
+            elif event != 'end' and node.getparent() is not None:
+                # Comments and processing instructions within the root
+                index += 1
+        return id_map
+
+    def _rewrite_attribs(
+            self,
+            node: etree._Element,
+            index: int) -> t.Dict[str, str]:
+        attrib = dict(node.attrib)
+
+        if node.tag == queries.NOTE:
+            attrib.pop('pnum', None)
+        for name in self._attribs:
+            attrib.pop(name, None)
+
+        if self._generate_ids:
+            attrib[queries.XML_ID] = get_formatted_xml_id(index)
+
+        if node.tag == queries.TRILL and 'startid' in attrib:
+            self._update_trill_ref(attrib, self._trill_position)
+            self._trill_position += 1
+
+        return attrib
+
+    def _update_trill_ref(self, attrib: t.Dict[str, str], position: int):
+        referenced_id = attrib['startid']
+        if self._trill_refs.get(referenced_id) == position and \
+                referenced_id.startswith('#') and \
+                referenced_id[1:] in self._id_map:
+            attrib['startid'] = self._id_map[referenced_id[1:]]
+
+
+class _AlreadyIntermediate(Exception):
+    pass
+
+
+class StreamIntermediate(_StreamWriter):
+    """
+    Convert an MEI file to the intermediate representation without loading it
+    into memory, writing the same bytes as MeiTransformer.to_intermediate
+    followed by etree.tostring, and counting its measures, staffs and layers
+    as it goes.
+
+    Like MeiTransformer, a file which is already in the intermediate
+    representation is written as it is. This is only found once a note with
+    an octname is reached, so the output is then rewritten from the start.
+    """
+
+    def __init__(self, source: Source):
+        super().__init__(source)
+        self._convert = True
+        self.measure_count = 0
+        self.staff_count = 0
+        self.layer_count = 0
+
+    def convert(self, output: t.BinaryIO) -> None:
+        """
+        Write the intermediate representation to a seekable binary file,
+        which must not be the source.
+        """
+        self._convert = True
+        start = output.tell()
+        try:
+            self._write_counted(output)
+        except _AlreadyIntermediate:
+            output.seek(start)
+            output.truncate()
+            self._convert = False
+            self._write_counted(output)
+
+    def _write_counted(self, output: t.BinaryIO) -> None:
+        self.measure_count = 0
+        self.staff_count = 0
+        self.layer_count = 0
+        self._write(output)
+
+    def _rewrite_attribs(
+            self,
+            node: etree._Element,
+            index: int) -> t.Dict[str, str]:
+        tag = node.tag
+        if tag == queries.MEASURE:
+            self.measure_count += 1
+        elif tag == queries.STAFF:
+            self.staff_count += 1
+        elif tag == queries.LAYER:
+            self.layer_count += 1
+
+        attrib = dict(node.attrib)
+        if not self._convert:
+            return attrib
+
+        if tag == queries.NOTE:
+            if 'octname' in attrib:
+                raise _AlreadyIntermediate()
+            if 'oct' in attrib and 'pname' in attrib:
+                pname = attrib.pop('pname')
+                octave = attrib.pop('oct')
+                attrib['octname'] = f'{octave}:{pname}'
+        attrib.pop(queries.XML_ID, None)
+        return attrib
+
+
+class TreeSerialiser(_StreamWriter):
+    """
+    Serialise an MEI tree which is already in memory in parts, writing the
+    same bytes as etree.tostring, so that the serialised file is never held
+    in memory whole.
+
+    Measures, which hold most of a score, are each serialised by libxml2,
+    and the rest of the tree as the MEI files are streamed. libxml2 only
+    writes the internal subset of a doctype as part of the whole document, so
+    a tree with a doctype is serialised whole instead.
+    """
+
+    def __init__(self, tree: etree._ElementTree):
+        super().__init__(None)
+        self._tree = tree
+
+    def serialise(self) -> t.Iterator[str]:
+        """
+        Serialise the tree in parts, as they are read.
+        """
+        if self._tree.docinfo.internalDTD is not None:
+            yield etree.tostring(self._tree, encoding='unicode')
+        else:
+            yield from self._serialise()
+
+    def _events(self) -> t.Iterator[t.Tuple[str, etree._Element]]:
+        root = self._tree.getroot()
+        walker = etree.iterwalk(root, events=EVENTS)
+        for event, node in walker:
+            if node.tag == queries.MEASURE:
+                if event == 'start':
+                    walker.skip_subtree()
+                    yield 'subtree', node
+                continue
+            yield event, node
+        for node in root.itersiblings():
+            yield 'comment' if node.tag is etree.Comment else 'pi', node
+
+    def _serialise_node(
+            self,
+            node: etree._Element,
+            nsmap: t.Dict[t.Optional[str], str]) -> str:
+        text = etree.tostring(node, encoding='unicode', with_tail=False)
+        if not isinstance(node.tag, str):
+            return text
+
+        # Serialised alone, an element declares every namespace in scope,
+        # after its own, where within the tree it only declares those its
+        # parent does not
+        start = len(_qname(node.tag, node.prefix)) + 1
+        end = NAMESPACE_DECLARATIONS.match(text, start).end()
+        return text[:start] \
+            + _declare_namespaces(node.nsmap, nsmap) \
+            + text[end:]
+
+    def _get_prolog(self, root: etree._Element) -> str:
+        # Without a doctype, only the comments and processing instructions
+        # before the root are written
+        return ''.join(
+            etree.tostring(node, encoding='unicode', with_tail=False)
+            for node in reversed(list(root.itersiblings(preceding=True)))
+        )
+
+
+def _get_prolog(root: etree._Element) -> str:
+    # Return what libxml2 writes before the root element: the doctype, with
+    # its internal subset, and the comments and processing instructions
+    # around it. Only the tree parsed so far, which is no more than the
+    # parser has buffered, is serialised.
+    tree = root.getroottree()
+    text = etree.tostring(tree, encoding='unicode')
+
+    # Give the root an attribute which is not in the prolog, to find where it
+    # starts. The tree is not copied, as copies lose the processing
+    # instructions of the internal subset.
+    marker = 'prolog'
+    while marker in text:
+        marker += '_'
+    root.set(marker, '')
+    try:
+        text = etree.tostring(tree, encoding='unicode')
+    finally:
+        del root.attrib[marker]
+    return text[:text.rindex('<', 0, text.index(f' {marker}=""'))]
+
+
+def _declare_namespaces(
+        nsmap: t.Dict[t.Optional[str], str],
+        parent_nsmap: t.Dict[t.Optional[str], str]) -> str:
+    # Return the declarations of the namespaces of an element which its
+    # parent does not declare
+    parts = []
+    for prefix, uri in nsmap.items():
+        if parent_nsmap.get(prefix) != uri:
+            parts.append(
+                ' xmlns="' if prefix is None else f' xmlns:{prefix}="'
+            )
+            parts.append(uri.translate(ATTRIB_ESCAPES))
+            parts.append('"')
+    return ''.join(parts)
+
+
+def _drop(elem: etree._Element) -> None:
+    # Clear an element, and remove the elements before it from its parent
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def _qname(tag: str, prefix: t.Optional[str]) -> str:
+    localname = etree.QName(tag).localname
+    if prefix is None:
+        return localname
+    return f'{prefix}:{localname}'
+
+
+def _attrib_qname(name: str, nsmap: t.Dict[t.Optional[str], str]) -> str:
+    qname = etree.QName(name)
+    if qname.namespace == XML_NS:
+        return f'xml:{qname.localname}'
+    # Attributes are never in the default namespace
+    prefix = next(
+        prefix for prefix, uri in nsmap.items()
+        if uri == qname.namespace and prefix is not None
+    )
+    return f'{prefix}:{qname.localname}'